@@ -1,7 +1,13 @@
+import hashlib
+import threading
+import time
 from dataclasses import dataclass
 from typing import List, Optional
 
 import jwt
+from app.auth.jwks import JWKSCache
+from app.utils.cache import TTLCache
+from app.utils.tracing import span
 from auth0.authentication import GetToken
 from auth0.management import Auth0
 from fastapi import Depends, HTTPException, status
@@ -40,6 +46,8 @@ class VerifyToken:
         auth0_api_audience: str,
         auth0_issuer: str,
         auth0_algorithms: list[str],
+        token_cache_max_size: int = 10000,
+        token_cache_max_ttl: float = 300.0,
     ):
         self.config = {
             "auth0_domain": auth0_domain,
@@ -48,10 +56,15 @@ class VerifyToken:
             "auth0_algorithms": auth0_algorithms,
         }
 
-        # This gets the JWKS from a given URL and does processing so you can
+        # This keeps the JWKS from a given URL in memory so you can
         # use any of the keys available
         jwks_url = f"https://{self.config['auth0_domain']}/.well-known/jwks.json"
-        self.jwks_client = jwt.PyJWKClient(jwks_url)
+        self.jwks_cache = JWKSCache(jwks_url)
+
+        # Already validated token payloads, each kept at most until the token expires.
+        self.token_cache: TTLCache[str, dict] = TTLCache(
+            maxsize=token_cache_max_size, ttl=token_cache_max_ttl
+        )
 
     async def verify(
         self,
@@ -61,10 +74,44 @@ class VerifyToken:
         if token is None:
             raise UnauthenticatedException
 
+        token_key = hashlib.sha256(token.credentials.encode()).hexdigest()
+        payload = self.token_cache.get(token_key)
+
+        if payload is None:
+            # Includes fetching the JWKS when the signing key isn't cached.
+            with span("auth.decode_token"):
+                payload = await self._decode(token.credentials)
+
+            if "exp" in payload:
+                self.token_cache.set(
+                    token_key,
+                    payload,
+                    ttl=min(payload["exp"] - time.time(), self.token_cache.ttl),
+                )
+
+        if len(security_scopes.scopes) > 0:
+            self._check_claims(payload, "scope", security_scopes.scopes)
+
+        return payload["sub"]
+
+    async def _decode(self, token: str) -> dict:
+        """Validate a token and return its payload.
+
+        Args:
+            token (str): The encoded token.
+
+        Raises:
+            UnauthorizedException: The token is invalid.
+
+        Returns:
+            dict: The token payload.
+        """
         # This gets the 'kid' from the passed token
         try:
-            signing_key = self.jwks_client.get_signing_key_from_jwt(
-                token.credentials
+            signing_key = (
+                await self.jwks_cache.get_signing_key(
+                    jwt.get_unverified_header(token).get("kid")
+                )
             ).key
         except jwt.exceptions.PyJWKClientError as error:
             raise UnauthorizedException(str(error))
@@ -72,8 +119,8 @@ class VerifyToken:
             raise UnauthorizedException(str(error))
 
         try:
-            payload = jwt.decode(
-                token.credentials,
+            return jwt.decode(
+                token,
                 signing_key,
                 algorithms=self.config["auth0_algorithms"],
                 audience=self.config["auth0_api_audience"],
@@ -82,11 +129,6 @@ class VerifyToken:
         except Exception as error:
             raise UnauthorizedException(str(error))
 
-        if len(security_scopes.scopes) > 0:
-            self._check_claims(payload, "scope", security_scopes.scopes)
-
-        return payload["sub"]
-
     def _check_claims(self, payload, claim_name, expected_value):
         if claim_name not in payload:
             raise UnauthorizedException(
@@ -112,8 +154,11 @@ class Auth0Client:
         self.get_token = GetToken(
             self.config.auth0_domain, self.client_id, client_secret=self.client_secret
         )
-        self.mgmt_api_token = self.get_management_token()
-        self.auth0 = Auth0(self.config.auth0_domain, self.mgmt_api_token)
+        # The management API client is created on first use, so importing the app
+        # doesn't wait on Auth0, and recreated when its token expires.
+        self._auth0: Optional[Auth0] = None
+        self._mgmt_api_token_expires_at = 0.0
+        self._auth0_lock = threading.Lock()
         self.verify_token = VerifyToken(
             self.config.auth0_domain,
             self.config.auth0_api_audience,
@@ -121,11 +166,23 @@ class Auth0Client:
             self.config.auth0_algorithms,
         )
 
+    @property
+    def auth0(self) -> Auth0:
+        with self._auth0_lock:
+            if self._auth0 is None or time.time() >= self._mgmt_api_token_expires_at:
+                token = self.get_management_token()
+                self._auth0 = Auth0(self.config.auth0_domain, token["access_token"])
+                # Renew the token a minute before it expires.
+                self._mgmt_api_token_expires_at = (
+                    time.time() + token.get("expires_in", 86400) - 60
+                )
+
+            return self._auth0
+
     def get_management_token(self):
-        token = self.get_token.client_credentials(
+        return self.get_token.client_credentials(
             f"https://{self.config.auth0_domain}/api/v2/"
         )
-        return token["access_token"]
 
     def get_token_verifier(self):
         return self.verify_token
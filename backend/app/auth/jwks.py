@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import jwt
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSCache:
+    """Keeps the JSON Web Key Set of the issuer in memory.
+
+    Keys are fetched off the event loop, refreshed periodically in the background
+    and refetched when a token is signed with an unknown key id. Refetches are
+    rate limited so tokens with made up key ids can't hammer the JWKS endpoint.
+    """
+
+    def __init__(
+        self,
+        jwks_url: str,
+        refresh_interval: float = 3600.0,
+        min_refetch_interval: float = 30.0,
+        timeout: float = 10.0,
+    ):
+        """Initialize the JWKS cache.
+
+        Args:
+            jwks_url (str): URL of the JWKS endpoint.
+            refresh_interval (float): Seconds between background refreshes.
+            min_refetch_interval (float): Minimum seconds between two fetches.
+            timeout (float): Timeout of a fetch in seconds.
+        """
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        # Only used to fetch the key set, caching is handled here.
+        self.jwks_client = jwt.PyJWKClient(
+            jwks_url, cache_keys=False, cache_jwk_set=False, timeout=timeout
+        )
+        self._keys: dict[str, jwt.PyJWK] = {}
+        self._last_fetch_attempt: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def get_signing_key(self, kid: Optional[str]) -> jwt.PyJWK:
+        """Get the signing key matching a key id.
+
+        Args:
+            kid (Optional[str]): Key id from the token header.
+
+        Raises:
+            jwt.exceptions.PyJWKClientError: No signing key matches the key id.
+
+        Returns:
+            jwt.PyJWK: The signing key.
+        """
+        self.start()
+
+        signing_key = self._keys.get(kid)
+
+        if signing_key is None:
+            # The issuer may have rotated its keys since the last fetch.
+            await self.refresh()
+            signing_key = self._keys.get(kid)
+
+        if signing_key is None:
+            raise jwt.exceptions.PyJWKClientError(
+                f'Unable to find a signing key that matches: "{kid}"'
+            )
+
+        return signing_key
+
+    async def refresh(self):
+        """Fetch the key set unless it was fetched too recently.
+
+        Concurrent callers share a single fetch.
+        """
+        async with self._lock:
+            if (
+                self._last_fetch_attempt is not None
+                and time.monotonic() - self._last_fetch_attempt
+                < self.min_refetch_interval
+            ):
+                return
+
+            self._last_fetch_attempt = time.monotonic()
+
+            data = await asyncio.to_thread(self.jwks_client.fetch_data)
+            jwk_set = jwt.PyJWKSet.from_dict(data)
+
+            self._keys = {key.key_id: key for key in jwk_set.keys}
+
+    def start(self):
+        """Start the background refresh if it isn't running yet."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self):
+        """Stop the background refresh."""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+
+            self._refresh_task = None
+
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                # Keep serving the keys we have, the next run will retry.
+                logger.exception("Failed to refresh the JWKS")
+
+            await asyncio.sleep(self.refresh_interval)
@@ -1,10 +1,30 @@
-from app.ingest.faiss import load_or_create_index
+import os
+from typing import Optional
+
+from app.chains.retrievers import (
+    HYBRID_RETRIEVAL_ENABLED,
+    MULTI_QUERY_ENABLED,
+    RERANK_ENABLED,
+    RERANK_FETCH_K,
+    RETRIEVAL_K,
+    CachingRetriever,
+    HybridRetriever,
+    MultiQueryVectorRetriever,
+    RerankingRetriever,
+    load_cross_encoder,
+)
+from app.chains.search import (
+    KNOWLEDGE_RETRIEVER_TOOL_NAME,
+    SearchBackend,
+    create_online_search_tool,
+)
+from app.ingest.lexical import LexicalIndex
 from langchain.agents import AgentExecutor, create_react_agent
-from langchain.retrievers.multi_query import MultiQueryRetriever
 from langchain.tools.retriever import create_retriever_tool
-from langchain_community.tools.tavily_search import TavilySearchResults
+from langchain_core.language_models import BaseChatModel
 from langchain_core.prompts import PromptTemplate
-from langchain_core.tools import Tool
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
 from langchain_openai import ChatOpenAI
 
 # https://smith.langchain.com/hub/hwchase17/react-chat
@@ -77,48 +97,92 @@ agentic_prompt = PromptTemplate.from_template(
     """
 )
 
-search_tool = TavilySearchResults()
-
-# Define Online Search Tool using search_tool
-online_search_tool = Tool(
-    name="Online Search Tool",
-    description="""Search the web for information related to diabetes management.
-    This tool should be used when you are unable to find the required diabetes management information using the Diabetes Knowledge retriever tool.
-    Its important to note that the information retrieved from the web may not always be accurate or up-to-date.
-    So always make sure to verify the information from a reliable source before using it. Use the retrieved information to enhance your knowledge and provide better support to your patient.
-    """,
-    func=search_tool.run,
-)
-
-# Load or create the knowledge index.
-retriever = load_or_create_index().as_retriever()
+# Tag used to pick the agent's own LLM tokens out of the streamed events.
+AGENT_LLM_TAG = "agent_llm"
+# Set to "true" to print every agent step, the stage timings are in /metrics.
+AGENT_VERBOSE = os.getenv("AGENT_VERBOSE", "false").lower() == "true"
 
-# Create a multiquery retriever using the local knowledge base retriever.
-multi_query_retriever = MultiQueryRetriever.from_llm(
-    retriever=retriever,
-    llm=ChatOpenAI(temperature=0),  # temperature=0 to get the most relevant results
-)
 
-# Create a knowledge retriever tool using the multiquery retriever.
-knowledge_retriever_tool = create_retriever_tool(
-    retriever,
-    "Diabetes Knowledge retriever tool",
-    """Search knowledge about diabetes management.
-    You must use this tool to find information related to diabetes management.
-    However, if you are unable to find the required information that you need, you can always use another tool.
-    Use the retrieved information to enhance your knowledge and provide better support to your patient.
-    """,
-)
+def create_knowledge_retriever(
+    vector_store: VectorStore, lexical_index: Optional[LexicalIndex] = None
+) -> CachingRetriever:
+    """Create the retriever of the agent's knowledge retriever tool.
 
-tools = [
-    knowledge_retriever_tool,
-    online_search_tool,
-]
+    Args:
+        vector_store (VectorStore): The knowledge index.
+        lexical_index (Optional[LexicalIndex]): BM25 index over the same chunks,
+            the knowledge index is only searched by vector if None.
 
-llm = ChatOpenAI()
-
-agent = create_react_agent(llm, tools, agentic_prompt)
-
-agent_executor = AgentExecutor(
-    agent=agent, tools=tools, verbose=True, handle_parsing_errors=True
-)
+    Returns:
+        CachingRetriever: The knowledge retriever.
+    """
+    # Over-fetch when the chunks are reranked.
+    k = RERANK_FETCH_K if RERANK_ENABLED else RETRIEVAL_K
+
+    if not HYBRID_RETRIEVAL_ENABLED:
+        lexical_index = None
+
+    if MULTI_QUERY_ENABLED:
+        retriever = MultiQueryVectorRetriever(
+            vector_store=vector_store, lexical_index=lexical_index, k=k
+        )
+    elif lexical_index is not None:
+        retriever = HybridRetriever(
+            vector_store=vector_store, lexical_index=lexical_index, k=k
+        )
+    else:
+        retriever = vector_store.as_retriever(search_kwargs={"k": k})
+
+    if RERANK_ENABLED:
+        retriever = RerankingRetriever(
+            retriever=retriever, cross_encoder=load_cross_encoder()
+        )
+
+    # Repeated and concurrent lookups share one embedding and index search.
+    return CachingRetriever(retriever=retriever)
+
+
+def create_agent_executor(
+    knowledge_retriever: BaseRetriever,
+    llm: Optional[BaseChatModel] = None,
+    search_backend: Optional[SearchBackend] = None,
+) -> AgentExecutor:
+    """Create the DiaBuddy agent executor.
+
+    Args:
+        knowledge_retriever (BaseRetriever): Retriever of the knowledge index.
+        llm (Optional[BaseChatModel]): The agent LLM, tagged with AGENT_LLM_TAG,
+            a streaming OpenAI chat model if None.
+        search_backend (Optional[SearchBackend]): Backend of the online search tool,
+            the configured one if None.
+
+    Returns:
+        AgentExecutor: The agent executor.
+    """
+    # Cached, coalesced and bounded by a timeout.
+    online_search_tool = create_online_search_tool(search_backend)
+
+    # Create a knowledge retriever tool using the retriever.
+    knowledge_retriever_tool = create_retriever_tool(
+        knowledge_retriever,
+        KNOWLEDGE_RETRIEVER_TOOL_NAME,
+        """Search knowledge about diabetes management.
+        You must use this tool to find information related to diabetes management.
+        However, if you are unable to find the required information that you need, you can always use another tool.
+        Use the retrieved information to enhance your knowledge and provide better support to your patient.
+        """,
+    )
+
+    tools = [
+        knowledge_retriever_tool,
+        online_search_tool,
+    ]
+
+    if llm is None:
+        llm = ChatOpenAI(streaming=True, tags=[AGENT_LLM_TAG])
+
+    agent = create_react_agent(llm, tools, agentic_prompt)
+
+    return AgentExecutor(
+        agent=agent, tools=tools, verbose=AGENT_VERBOSE, handle_parsing_errors=True
+    )
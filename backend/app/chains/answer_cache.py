@@ -0,0 +1,350 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Container, Hashable, Optional
+from uuid import uuid4
+
+import numpy as np
+from app.ingest.embeddings import create_embeddings
+from app.models.user import User
+from app.utils.metrics import counter, gauge
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Set to "false" to answer every query with the agent.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+# Minimum cosine similarity between two queries to reuse an answer.
+SEMANTIC_CACHE_SIMILARITY_THRESHOLD = float(
+    os.getenv("SEMANTIC_CACHE_SIMILARITY_THRESHOLD", 0.95)
+)
+# Seconds an answer is reused for.
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", 24 * 3600))
+# Maximum number of cached answers.
+SEMANTIC_CACHE_MAX_SIZE = int(os.getenv("SEMANTIC_CACHE_MAX_SIZE", 10000))
+
+# Stands in for the nickname of the user an answer was generated for.
+NICKNAME_PLACEHOLDER = "\x00nickname\x00"
+
+
+@dataclass
+class CachedAnswer:
+    """Answer to a query, reused for similar queries in the same scope."""
+
+    scope: Hashable
+    vector: np.ndarray
+    answer: str
+    expires_at: float
+
+
+@dataclass
+class AnswerCacheStats:
+    """Lookup counters of the answer cache."""
+
+    hits: int = 0
+    misses: int = 0
+    bypasses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def get_answer_scope(user: User) -> Hashable:
+    """Get the profile fields that change the answer to the same query.
+
+    Answers are only reused between users with the same scope. It holds every
+    profile field given to the agent but the nickname, which is kept out of
+    the cached answers, and the exact age, of which only the decade is kept so
+    the cache isn't split into near-empty scopes.
+
+    Args:
+        user (User): The user asking.
+
+    Returns:
+        Hashable: The answer scope.
+    """
+    return (
+        user.diabetes_type,
+        user.preferred_language,
+        user.gender,
+        user.age // 10 if user.age is not None else None,
+    )
+
+
+class _ScopeVectors:
+    """Query vectors of the cached answers of a scope, stacked for lookups.
+
+    Vectors are appended in place, growing the matrix by doubling. Removed
+    entries are skipped by lookups and compacted once they are half the rows.
+    """
+
+    def __init__(self, dimension: int):
+        self.entry_ids: list[str] = []
+        self.vectors = np.empty((16, dimension), np.float32)
+        self.removed = 0
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self.vectors[: len(self.entry_ids)]
+
+    def append(self, entry_id: str, vector: np.ndarray):
+        size = len(self.entry_ids)
+
+        if size == len(self.vectors):
+            vectors = np.empty((max(size * 2, 16), self.vectors.shape[1]), np.float32)
+            vectors[:size] = self.vectors
+            self.vectors = vectors
+
+        self.vectors[size] = vector
+        self.entry_ids.append(entry_id)
+
+    def compact(self, live_entry_ids: Container[str]):
+        positions = [
+            position
+            for position, entry_id in enumerate(self.entry_ids)
+            if entry_id in live_entry_ids
+        ]
+        self.entry_ids = [self.entry_ids[position] for position in positions]
+        self.vectors = self.vectors[positions]
+        self.removed = 0
+
+
+class SemanticAnswerCache:
+    """In-process cache of agent answers, looked up by query similarity.
+
+    Queries are embedded and compared with the cached queries of the same scope
+    by cosine similarity. Entries expire after their time to live and are
+    evicted in least recently used order once `maxsize` is reached.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        similarity_threshold: float = SEMANTIC_CACHE_SIMILARITY_THRESHOLD,
+        maxsize: int = SEMANTIC_CACHE_MAX_SIZE,
+        ttl: float = SEMANTIC_CACHE_TTL_SECONDS,
+    ):
+        """Initialize the answer cache.
+
+        Args:
+            embeddings (Embeddings): Embeddings used for the queries.
+            similarity_threshold (float): Minimum cosine similarity of a hit.
+            maxsize (int): Maximum number of cached answers.
+            ttl (float): Time to live of an answer in seconds.
+        """
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = AnswerCacheStats()
+
+        self._entries: OrderedDict[str, CachedAnswer] = OrderedDict()
+        # Stacked query vectors of every scope.
+        self._scope_vectors: dict[Hashable, _ScopeVectors] = {}
+        self._lock = threading.Lock()
+
+    async def embed(self, query: str) -> np.ndarray:
+        """Embed a query for a lookup.
+
+        Args:
+            query (str): The contextualized query.
+
+        Returns:
+            np.ndarray: The normalized query vector.
+        """
+        vector = np.asarray(await self.embeddings.aembed_query(query), np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(
+        self, scope: Hashable, vector: np.ndarray, nickname: Optional[str] = None
+    ) -> Optional[str]:
+        """Get the cached answer of the most similar query.
+
+        Args:
+            scope (Hashable): Answer scope of the user.
+            vector (np.ndarray): Normalized query vector.
+            nickname (Optional[str]): Nickname of the user, put back into the answer.
+
+        Returns:
+            Optional[str]: The answer or None if no query is similar enough.
+        """
+        with self._lock:
+            entry_id = self._find(scope, vector)
+
+            if entry_id is None:
+                self.stats.misses += 1
+                return None
+
+            self.stats.hits += 1
+            self._entries.move_to_end(entry_id)
+            answer = self._entries[entry_id].answer
+
+        return answer.replace(NICKNAME_PLACEHOLDER, nickname or "")
+
+    def store(
+        self,
+        scope: Hashable,
+        vector: np.ndarray,
+        answer: str,
+        nickname: Optional[str] = None,
+        age: Optional[int] = None,
+    ):
+        """Cache the answer to a query.
+
+        Answers that mention the exact age of the user aren't cached, the scope
+        only holds its decade.
+
+        Args:
+            scope (Hashable): Answer scope of the user.
+            vector (np.ndarray): Normalized query vector.
+            answer (str): The answer.
+            nickname (Optional[str]): Nickname of the user, kept out of the cache.
+            age (Optional[int]): Age of the user.
+        """
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+
+        if age is not None and re.search(rf"\b{age}\b", answer):
+            return
+
+        if nickname:
+            answer = answer.replace(nickname, NICKNAME_PLACEHOLDER)
+
+        entry_id = uuid4().hex
+
+        with self._lock:
+            self._entries[entry_id] = CachedAnswer(
+                scope=scope,
+                vector=vector,
+                answer=answer,
+                expires_at=time.monotonic() + self.ttl,
+            )
+
+            if scope not in self._scope_vectors:
+                self._scope_vectors[scope] = _ScopeVectors(len(vector))
+
+            self._scope_vectors[scope].append(entry_id, vector)
+
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def record_bypass(self):
+        """Count a query answered without looking up the cache."""
+        self.stats.bypasses += 1
+
+    def clear(self):
+        """Remove all cached answers."""
+        with self._lock:
+            self._entries.clear()
+            self._scope_vectors.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _find(self, scope: Hashable, vector: np.ndarray) -> Optional[str]:
+        scope_vectors = self._scope_vectors.get(scope)
+
+        if scope_vectors is None:
+            return None
+
+        similarities = scope_vectors.matrix @ vector
+        entry_ids = scope_vectors.entry_ids
+        now = time.monotonic()
+
+        # Most similar first, skipping removed and expired entries.
+        for position in np.argsort(-similarities):
+            if similarities[position] < self.similarity_threshold:
+                return None
+
+            entry_id = entry_ids[position]
+            entry = self._entries.get(entry_id)
+
+            if entry is None:
+                continue
+
+            if entry.expires_at <= now:
+                self._remove(entry_id)
+                continue
+
+            return entry_id
+
+        return None
+
+    def _remove(self, entry_id: str):
+        entry = self._entries.pop(entry_id)
+        scope_vectors = self._scope_vectors[entry.scope]
+        scope_vectors.removed += 1
+
+        if scope_vectors.removed == len(scope_vectors.entry_ids):
+            del self._scope_vectors[entry.scope]
+        elif scope_vectors.removed * 2 > len(scope_vectors.entry_ids):
+            scope_vectors.compact(self._entries)
+
+
+_answer_cache: Optional[SemanticAnswerCache] = None
+# FastAPI resolves the dependency in its threadpool, concurrent first requests
+# must not create and register the cache twice.
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> Optional[SemanticAnswerCache]:
+    """Get the process-wide answer cache.
+
+    Returns:
+        Optional[SemanticAnswerCache]: The answer cache or None if it is disabled.
+    """
+    global _answer_cache
+
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = _create_answer_cache()
+
+    return _answer_cache
+
+
+def clear_answer_cache():
+    """Remove the cached answers, e.g. when the knowledge index changed."""
+    if _answer_cache is not None:
+        _answer_cache.clear()
+
+
+def _create_answer_cache() -> SemanticAnswerCache:
+    """Create the answer cache and register its metrics.
+
+    Returns:
+        SemanticAnswerCache: The answer cache.
+    """
+    answer_cache = SemanticAnswerCache(create_embeddings())
+
+    # Read from the cache's own counters on every scrape.
+    counter(
+        "diabuddy_answer_cache_hits_total",
+        "Queries answered from the answer cache.",
+        function=lambda: answer_cache.stats.hits,
+    )
+    counter(
+        "diabuddy_answer_cache_misses_total",
+        "Queries looked up in the answer cache without a similar cached query.",
+        function=lambda: answer_cache.stats.misses,
+    )
+    counter(
+        "diabuddy_answer_cache_bypasses_total",
+        "Queries sent with the answer cache bypassed.",
+        function=lambda: answer_cache.stats.bypasses,
+    )
+    gauge(
+        "diabuddy_answer_cache_size",
+        "Answers in the answer cache.",
+        function=lambda: len(answer_cache),
+    )
+
+    return answer_cache
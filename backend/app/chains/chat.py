@@ -1,4 +1,3 @@
-from app.ingest.faiss import load_or_create_index
 from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import (
@@ -7,19 +6,11 @@ from langchain_core.prompts import (
     MessagesPlaceholder,
     SystemMessagePromptTemplate,
 )
+from langchain_core.runnables import Runnable
+from langchain_core.vectorstores import VectorStore
 
 from langchain_huggingface import HuggingFaceEndpoint
 
-vector_db = load_or_create_index()
-
-# Create a retriever from the vector database.
-retriever = vector_db.as_retriever()
-
-# Load the LLM
-llm = HuggingFaceEndpoint(
-    repo_id="mistralai/Mistral-7B-Instruct-v0.3",
-)
-
 contextualized_q_prompt = ChatPromptTemplate.from_messages(
     [
         SystemMessagePromptTemplate.from_template(
@@ -41,10 +32,6 @@ contextualized_q_prompt = ChatPromptTemplate.from_messages(
     ],
 )
 
-history_aware_retrieval_chain = create_history_aware_retriever(
-    llm, retriever, contextualized_q_prompt
-)
-
 qa_prompt = ChatPromptTemplate.from_messages(
     [
         SystemMessagePromptTemplate.from_template(
@@ -111,6 +98,28 @@ qa_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
 
-rag_chain = create_retrieval_chain(history_aware_retrieval_chain, question_answer_chain)
+def create_rag_chain(vector_store: VectorStore) -> Runnable:
+    """Create the history aware RAG chain.
+
+    Args:
+        vector_store (VectorStore): The knowledge index.
+
+    Returns:
+        Runnable: The RAG chain.
+    """
+    # Create a retriever from the vector database.
+    retriever = vector_store.as_retriever()
+
+    # Load the LLM
+    llm = HuggingFaceEndpoint(
+        repo_id="mistralai/Mistral-7B-Instruct-v0.3",
+    )
+
+    history_aware_retrieval_chain = create_history_aware_retriever(
+        llm, retriever, contextualized_q_prompt
+    )
+
+    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
+
+    return create_retrieval_chain(history_aware_retrieval_chain, question_answer_chain)
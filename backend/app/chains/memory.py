@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import math
+import os
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Optional
+
+import tiktoken
+from app.models.chat import ChatSummary
+from app.repositories.chat import ChatRepository
+from langchain_core.messages import SystemMessage, get_buffer_string
+from langchain_core.messages.base import BaseMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import Runnable
+from langchain_openai import ChatOpenAI
+
+logger = logging.getLogger(__name__)
+
+# "window" keeps the latest messages that fit the token budget,
+# "summary" additionally keeps a rolling summary of the older messages.
+CHAT_MEMORY_STRATEGY = os.getenv("CHAT_MEMORY_STRATEGY", "window")
+# Maximum number of tokens of conversation history put into the prompt.
+CHAT_MEMORY_TOKEN_BUDGET = int(os.getenv("CHAT_MEMORY_TOKEN_BUDGET", 2000))
+# Maximum number of latest messages loaded to fill the token budget.
+CHAT_MEMORY_MAX_MESSAGES = int(os.getenv("CHAT_MEMORY_MAX_MESSAGES", 50))
+# Tokenizer matching the agent LLM.
+CHAT_MEMORY_TOKENIZER_MODEL = os.getenv("CHAT_MEMORY_TOKENIZER_MODEL", "gpt-3.5-turbo")
+# Rough number of characters per token, used while the tokenizer isn't loaded.
+CHARACTERS_PER_TOKEN = 4
+
+summary_prompt = PromptTemplate.from_template(
+    """
+    Progressively summarize the conversation between a patient and DiaBuddy,
+    a Diabetes Care Companion, adding onto the previous summary and returning a new summary.
+    Keep the details that matter for future conversations, such as the patient's concerns,
+    goals, symptoms, routines and any advice already given. Be concise.
+
+    Current summary:
+    {summary}
+
+    New lines of conversation:
+    {new_lines}
+
+    New summary:
+    """
+)
+
+# Keeps a reference to the running summary updates so they aren't garbage collected.
+_summary_tasks: set[asyncio.Task] = set()
+# Users whose summary is currently being updated by this process.
+_summarizing_user_ids: set[str] = set()
+# Set by load_tokenizer, tokens are estimated from the characters until then.
+_tokenizer: Optional[tiktoken.Encoding] = None
+
+
+def load_tokenizer() -> Optional[tiktoken.Encoding]:
+    """Load the tokenizer used to count prompt tokens.
+
+    tiktoken downloads the encoding unless it is cached, so this blocks and is
+    run in a thread at startup. If it fails, tokens keep being estimated.
+
+    Returns:
+        Optional[tiktoken.Encoding]: The tokenizer or None if it failed to load.
+    """
+    global _tokenizer
+
+    if _tokenizer is not None:
+        return _tokenizer
+
+    try:
+        try:
+            _tokenizer = tiktoken.encoding_for_model(CHAT_MEMORY_TOKENIZER_MODEL)
+        except KeyError:
+            _tokenizer = tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        logger.warning(
+            "Failed to load the tokenizer, prompt tokens are estimated instead",
+            exc_info=True,
+        )
+
+    return _tokenizer
+
+
+@lru_cache()
+def get_summary_chain() -> Runnable:
+    """Get the chain folding new lines of conversation into the summary.
+
+    Created on first use, so importing the module doesn't need OpenAI settings.
+
+    Returns:
+        Runnable: The chain, returning the new summary.
+    """
+    return summary_prompt | ChatOpenAI(temperature=0) | StrOutputParser()
+
+
+def count_tokens(message: BaseMessage) -> int:
+    """Count the tokens a message takes up in the prompt.
+
+    Estimated from the number of characters while the tokenizer isn't loaded.
+
+    Args:
+        message (BaseMessage): Chat message.
+
+    Returns:
+        int: Number of tokens.
+    """
+    text = get_buffer_string([message])
+
+    if _tokenizer is None:
+        return math.ceil(len(text) / CHARACTERS_PER_TOKEN)
+
+    return len(_tokenizer.encode(text))
+
+
+class ConversationMemory(ABC):
+    """Selects the conversation history given to the agent."""
+
+    def __init__(
+        self,
+        chat_repo: ChatRepository,
+        token_budget: int = CHAT_MEMORY_TOKEN_BUDGET,
+        max_messages: int = CHAT_MEMORY_MAX_MESSAGES,
+    ):
+        """Initialize conversation memory.
+
+        Args:
+            chat_repo (ChatRepository): Chat repository instance.
+            token_budget (int): Maximum number of history tokens.
+            max_messages (int): Maximum number of latest messages to load.
+        """
+        self.chat_repo = chat_repo
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+
+    @abstractmethod
+    async def load(self, user_id: str) -> list[BaseMessage]:
+        """Load the conversation history of the user.
+
+        Args:
+            user_id (str): ID of the user.
+
+        Returns:
+            list[BaseMessage]: Chat messages to put into the prompt.
+        """
+
+    async def _load_window(
+        self, user_id: str, token_budget: int
+    ) -> tuple[list[BaseMessage], list[BaseMessage]]:
+        """Load the latest messages that fit the token budget.
+
+        Args:
+            user_id (str): ID of the user.
+            token_budget (int): Maximum number of tokens.
+
+        Returns:
+            tuple[list[BaseMessage], list[BaseMessage]]: Messages within the budget
+                and the loaded messages that didn't fit, both in chronological order.
+        """
+        messages = (
+            await self.chat_repo.get_messages_by_user_id(
+                user_id, limit=self.max_messages
+            )
+            or []
+        )
+
+        used_tokens = 0
+        start = len(messages)
+
+        while start > 0:
+            used_tokens += count_tokens(messages[start - 1])
+
+            if used_tokens > token_budget:
+                break
+
+            start -= 1
+
+        return messages[start:], messages[:start]
+
+
+class TokenWindowMemory(ConversationMemory):
+    """Keeps the latest messages that fit the token budget."""
+
+    async def load(self, user_id: str) -> list[BaseMessage]:
+        window, _ = await self._load_window(user_id, self.token_budget)
+        return window
+
+
+class SummaryTokenWindowMemory(ConversationMemory):
+    """Keeps the latest messages that fit the token budget and a rolling summary.
+
+    Messages that fall out of the window are folded into the summary in the
+    background after the history is loaded, so the summary is up to date for the
+    next turn without delaying the current one.
+    """
+
+    async def load(self, user_id: str) -> list[BaseMessage]:
+        summary = await self.chat_repo.get_summary_by_user_id(user_id) or ChatSummary()
+        summary_message = SystemMessage(
+            content=f"Summary of the earlier conversation: {summary.summary}"
+        )
+        summary_tokens = count_tokens(summary_message) if summary.summary else 0
+
+        window, evicted = await self._load_window(
+            user_id, max(self.token_budget - summary_tokens, 0)
+        )
+
+        # Only messages that aren't part of the summary yet.
+        unsummarized = [
+            message
+            for message in evicted
+            if summary.summarized_until is None
+            or getattr(message, "timestamp", None) is None
+            or message.timestamp > summary.summarized_until
+        ]
+
+        if unsummarized and user_id not in _summarizing_user_ids:
+            _summarizing_user_ids.add(user_id)
+            task = asyncio.create_task(
+                self._update_summary(user_id, summary, unsummarized)
+            )
+            _summary_tasks.add(task)
+            task.add_done_callback(_summary_tasks.discard)
+
+        if summary.summary:
+            return [summary_message, *window]
+
+        return window
+
+    async def _update_summary(
+        self, user_id: str, summary: ChatSummary, messages: list[BaseMessage]
+    ):
+        """Fold messages into the summary of the user.
+
+        Args:
+            user_id (str): ID of the user.
+            summary (ChatSummary): Current summary.
+            messages (list[BaseMessage]): Messages to add to the summary.
+        """
+        try:
+            new_summary = await get_summary_chain().ainvoke(
+                {
+                    "summary": summary.summary,
+                    "new_lines": get_buffer_string(messages),
+                }
+            )
+            await self.chat_repo.save_summary(
+                user_id,
+                ChatSummary(
+                    summary=new_summary.strip(),
+                    summarized_until=getattr(messages[-1], "timestamp", None),
+                ),
+            )
+        except Exception:
+            logger.exception("Failed to update the conversation summary")
+        finally:
+            _summarizing_user_ids.discard(user_id)
+
+
+def create_conversation_memory(chat_repo: ChatRepository) -> ConversationMemory:
+    """Create the conversation memory configured for this deployment.
+
+    Args:
+        chat_repo (ChatRepository): Chat repository instance.
+
+    Raises:
+        ValueError: Unknown memory strategy.
+
+    Returns:
+        ConversationMemory: Conversation memory.
+    """
+    if CHAT_MEMORY_STRATEGY == "window":
+        return TokenWindowMemory(chat_repo)
+    if CHAT_MEMORY_STRATEGY == "summary":
+        return SummaryTokenWindowMemory(chat_repo)
+
+    raise ValueError(f'Unknown chat memory strategy "{CHAT_MEMORY_STRATEGY}"')
@@ -0,0 +1,573 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Optional
+
+import numpy as np
+from app.ingest.lexical import LexicalIndex, tokenize
+from app.utils.cache import TTLCache
+from app.utils.text import normalize_query
+from app.utils.tracing import span
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import PromptTemplate
+from langchain_core.pydantic_v1 import Field, PrivateAttr
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable
+from langchain_openai import ChatOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of cached retrievals per process.
+RETRIEVAL_CACHE_MAX_SIZE = int(os.getenv("RETRIEVAL_CACHE_MAX_SIZE", 1024))
+# Seconds retrieved documents are reused for.
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", 24 * 3600))
+
+# Number of chunks given to the agent per lookup.
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", 4))
+# Set to "false" to only search the vector index.
+HYBRID_RETRIEVAL_ENABLED = (
+    os.getenv("HYBRID_RETRIEVAL_ENABLED", "true").lower() == "true"
+)
+# Number of chunks fetched from each index before fusing them.
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", 20))
+# Weights of the dense and lexical rankings in the fused ranking.
+HYBRID_DENSE_WEIGHT = float(os.getenv("HYBRID_DENSE_WEIGHT", 1.0))
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", 1.0))
+# Reciprocal rank fusion constant, higher values flatten the rankings.
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", 60))
+# Queries of at most this many rare terms are answered by the lexical index alone.
+HYBRID_SHORT_CIRCUIT_MAX_TERMS = int(os.getenv("HYBRID_SHORT_CIRCUIT_MAX_TERMS", 3))
+# Maximum share of the chunks a term occurs in to count as rare.
+HYBRID_SHORT_CIRCUIT_MAX_DOCUMENT_RATIO = float(
+    os.getenv("HYBRID_SHORT_CIRCUIT_MAX_DOCUMENT_RATIO", 0.05)
+)
+
+# Set to "true" to also search with LLM generated variants of every query.
+MULTI_QUERY_ENABLED = os.getenv("MULTI_QUERY_ENABLED", "false").lower() == "true"
+# Number of query variants generated.
+MULTI_QUERY_COUNT = int(os.getenv("MULTI_QUERY_COUNT", 3))
+# Maximum number of queries whose variants are cached per process.
+MULTI_QUERY_CACHE_MAX_SIZE = int(os.getenv("MULTI_QUERY_CACHE_MAX_SIZE", 1024))
+# Seconds generated variants are reused for.
+MULTI_QUERY_CACHE_TTL_SECONDS = float(
+    os.getenv("MULTI_QUERY_CACHE_TTL_SECONDS", 24 * 3600)
+)
+
+# Set to "true" to rerank the retrieved chunks with a local cross-encoder.
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"
+# Cross-encoder used for reranking, run on the CPU.
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# Number of chunks retrieved for reranking.
+RERANK_FETCH_K = int(os.getenv("RERANK_FETCH_K", 20))
+# Number of chunks given to the agent after reranking.
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", 3))
+# Seconds reranking may take before the chunks are returned in retrieved order.
+RERANK_TIMEOUT_SECONDS = float(os.getenv("RERANK_TIMEOUT_SECONDS", 0.5))
+# Number of query / chunk pairs scored per model batch.
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", 32))
+# Maximum number of reranks scored at once, further ones skip reranking.
+RERANK_MAX_CONCURRENCY = int(os.getenv("RERANK_MAX_CONCURRENCY", 2))
+
+# Scores the reranked chunks, apart from the default thread pool. Timed-out
+# reranks keep their worker until they finish.
+_rerank_executor = ThreadPoolExecutor(
+    RERANK_MAX_CONCURRENCY, thread_name_prefix="rerank"
+)
+# Held by every rerank until its scoring finishes, timed out or not.
+_rerank_slots = threading.BoundedSemaphore(RERANK_MAX_CONCURRENCY)
+
+multi_query_prompt = PromptTemplate.from_template(
+    """
+    You are an AI language model assistant. Your task is to generate {count}
+    different versions of the given question to retrieve relevant documents about
+    diabetes management from a knowledge base. By generating multiple perspectives
+    on the question, your goal is to help overcome some of the limitations of
+    distance-based similarity search.
+    Provide only the alternative questions, one per line.
+
+    Original question: {question}
+    """
+)
+
+# Numbering or bullets in front of a generated variant.
+_VARIANT_PREFIX_PATTERN = re.compile(r"^\s*(?:\d+[.)]|[-*•])\s*")
+
+
+def create_multi_query_chain() -> Runnable:
+    """Create the chain generating query variants.
+
+    Returns:
+        Runnable: The chain, returning one variant per line.
+    """
+    # temperature=0 to get the most relevant variants.
+    return multi_query_prompt | ChatOpenAI(temperature=0) | StrOutputParser()
+
+
+def search_dense(
+    vector_store: FAISS, embeddings: list[list[float]], k: int
+) -> list[list[int]]:
+    """Search the vector index for several queries in a single call.
+
+    Args:
+        vector_store (FAISS): The serving vector store.
+        embeddings (list[list[float]]): Embedding of every query.
+        k (int): Number of chunks per query.
+
+    Returns:
+        list[list[int]]: Positions of the closest chunks of every query.
+    """
+    _, positions = vector_store.index.search(np.array(embeddings, dtype=np.float32), k)
+
+    # Missing results are padded with -1.
+    return [
+        [position for position in row if position != -1] for row in positions.tolist()
+    ]
+
+
+def fuse_rankings(
+    weighted_rankings: list[tuple[float, list[int]]], rrf_k: int, k: int
+) -> list[int]:
+    """Fuse rankings with weighted reciprocal rank fusion.
+
+    Args:
+        weighted_rankings (list[tuple[float, list[int]]]): Weight and chunk
+            positions of every ranking, best first.
+        rrf_k (int): Fusion constant, higher values flatten the rankings.
+        k (int): Number of chunks to return.
+
+    Returns:
+        list[int]: Positions of the best chunks, best first.
+    """
+    scores: dict[int, float] = {}
+
+    for weight, ranking in weighted_rankings:
+        for rank, position in enumerate(ranking):
+            scores[position] = scores.get(position, 0.0) + weight / (rrf_k + rank + 1)
+
+    return sorted(scores, key=scores.__getitem__, reverse=True)[:k]
+
+
+def get_documents(vector_store: FAISS, positions: list[int]) -> list[Document]:
+    """Get the chunks at positions of the vector index.
+
+    Args:
+        vector_store (FAISS): The serving vector store.
+        positions (list[int]): Positions of the chunks.
+
+    Returns:
+        list[Document]: The chunks.
+    """
+    return [
+        vector_store.docstore.search(vector_store.index_to_docstore_id[position])
+        for position in positions
+    ]
+
+
+class CachingRetriever(BaseRetriever):
+    """Caches and coalesces the retrievals of a retriever.
+
+    Documents are cached by normalized query and search parameters, least
+    recently used first out. Concurrent retrievals of the same query share a
+    single query embedding and index search.
+
+    The cache belongs to the retriever of one loaded index, a rebuilt index is
+    loaded into a new vector store and retriever, starting with an empty cache.
+    """
+
+    retriever: BaseRetriever
+    cache: TTLCache = Field(
+        default_factory=lambda: TTLCache(
+            maxsize=RETRIEVAL_CACHE_MAX_SIZE, ttl=RETRIEVAL_CACHE_TTL_SECONDS
+        )
+    )
+
+    _in_flight: dict[str, asyncio.Task] = PrivateAttr(default_factory=dict)
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def get_cache_key(self, query: str) -> str:
+        """Get the cache key of a query.
+
+        Args:
+            query (str): The query.
+
+        Returns:
+            str: The normalized query along with the search parameters.
+        """
+        return json.dumps(
+            [
+                normalize_query(query),
+                getattr(self.retriever, "search_type", None),
+                getattr(self.retriever, "search_kwargs", None),
+            ],
+            sort_keys=True,
+            default=str,
+        )
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        key = self.get_cache_key(query)
+        documents = self.cache.get(key)
+
+        if documents is None:
+            with span("retriever.search"):
+                documents = self.retriever.invoke(
+                    query, config={"callbacks": run_manager.get_child()}
+                )
+
+            self.cache.set(key, documents)
+
+        return list(documents)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        key = self.get_cache_key(query)
+        documents = self.cache.get(key)
+
+        if documents is not None:
+            return list(documents)
+
+        task = self._in_flight.get(key)
+
+        if task is None:
+            task = asyncio.create_task(self._aretrieve(key, query, run_manager))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._on_retrieval_done(key, task))
+
+        # Shielded, so a cancelled caller doesn't cancel the shared retrieval.
+        return list(await asyncio.shield(task))
+
+    def _on_retrieval_done(self, key: str, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+        # Retrieve the error, every caller may have been cancelled already.
+        if not task.cancelled():
+            task.exception()
+
+    async def _aretrieve(
+        self, key: str, query: str, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        with span("retriever.search"):
+            documents = await self.retriever.ainvoke(
+                query, config={"callbacks": run_manager.get_child()}
+            )
+
+        self.cache.set(key, documents)
+
+        return documents
+
+
+class HybridRetriever(BaseRetriever):
+    """Fuses dense vector search and BM25 search.
+
+    Both indexes are searched for `fetch_k` chunks, which are fused with
+    weighted reciprocal rank fusion. Queries made of a few rare terms, such as
+    drug names and acronyms, are answered by the lexical index alone, which
+    saves the query embedding.
+    """
+
+    vector_store: FAISS
+    lexical_index: LexicalIndex
+    k: int = RETRIEVAL_K
+    fetch_k: int = HYBRID_FETCH_K
+    dense_weight: float = HYBRID_DENSE_WEIGHT
+    lexical_weight: float = HYBRID_LEXICAL_WEIGHT
+    rrf_k: int = HYBRID_RRF_K
+    short_circuit_max_terms: int = HYBRID_SHORT_CIRCUIT_MAX_TERMS
+    short_circuit_max_document_ratio: float = HYBRID_SHORT_CIRCUIT_MAX_DOCUMENT_RATIO
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        lexical_ranking = self._search_lexical(query)
+
+        if self._is_exact_term_query(query, lexical_ranking):
+            return get_documents(self.vector_store, lexical_ranking[: self.k])
+
+        embedding = self.vector_store.embeddings.embed_query(query)
+        (dense_ranking,) = search_dense(self.vector_store, [embedding], self.fetch_k)
+
+        return self._fuse(dense_ranking, lexical_ranking)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        lexical_ranking = self._search_lexical(query)
+
+        if self._is_exact_term_query(query, lexical_ranking):
+            return get_documents(self.vector_store, lexical_ranking[: self.k])
+
+        embedding = await self.vector_store.embeddings.aembed_query(query)
+        (dense_ranking,) = await asyncio.to_thread(
+            search_dense, self.vector_store, [embedding], self.fetch_k
+        )
+
+        return self._fuse(dense_ranking, lexical_ranking)
+
+    def _search_lexical(self, query: str) -> list[int]:
+        return [
+            position for position, _ in self.lexical_index.search(query, self.fetch_k)
+        ]
+
+    def _is_exact_term_query(self, query: str, lexical_ranking: list[int]) -> bool:
+        terms = tokenize(query)
+
+        if not 0 < len(terms) <= self.short_circuit_max_terms:
+            return False
+
+        if len(lexical_ranking) < self.k:
+            return False
+
+        max_document_frequency = (
+            self.lexical_index.ntotal * self.short_circuit_max_document_ratio
+        )
+
+        return all(
+            0 < self.lexical_index.document_frequency(term) <= max_document_frequency
+            for term in terms
+        )
+
+    def _fuse(
+        self, dense_ranking: list[int], lexical_ranking: list[int]
+    ) -> list[Document]:
+        positions = fuse_rankings(
+            [
+                (self.dense_weight, dense_ranking),
+                (self.lexical_weight, lexical_ranking),
+            ],
+            self.rrf_k,
+            self.k,
+        )
+
+        return get_documents(self.vector_store, positions)
+
+
+class MultiQueryVectorRetriever(BaseRetriever):
+    """Searches with the query and LLM generated variants of it.
+
+    The variants are generated in a single LLM call and cached per query. All
+    queries are embedded in one batch and searched in one call over the query
+    matrix, and the rankings of every query, plus their BM25 rankings if there
+    is a lexical index, are fused with reciprocal rank fusion.
+    """
+
+    vector_store: FAISS
+    lexical_index: Optional[LexicalIndex] = None
+    query_chain: Runnable = Field(default_factory=create_multi_query_chain)
+    query_count: int = MULTI_QUERY_COUNT
+    k: int = RETRIEVAL_K
+    fetch_k: int = HYBRID_FETCH_K
+    dense_weight: float = HYBRID_DENSE_WEIGHT
+    lexical_weight: float = HYBRID_LEXICAL_WEIGHT
+    rrf_k: int = HYBRID_RRF_K
+    variant_cache: TTLCache = Field(
+        default_factory=lambda: TTLCache(
+            maxsize=MULTI_QUERY_CACHE_MAX_SIZE, ttl=MULTI_QUERY_CACHE_TTL_SECONDS
+        )
+    )
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        key = normalize_query(query)
+        variants = self.variant_cache.get(key)
+
+        if variants is None:
+            variants = self._parse_variants(
+                query,
+                self.query_chain.invoke(
+                    {"question": query, "count": self.query_count},
+                    config={"callbacks": run_manager.get_child()},
+                ),
+            )
+            self.variant_cache.set(key, variants)
+
+        queries = [query, *variants]
+        embeddings = self.vector_store.embeddings.embed_documents(queries)
+
+        dense_rankings = search_dense(self.vector_store, embeddings, self.fetch_k)
+
+        return self._fuse(queries, dense_rankings)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        key = normalize_query(query)
+        variants = self.variant_cache.get(key)
+
+        if variants is None:
+            variants = self._parse_variants(
+                query,
+                await self.query_chain.ainvoke(
+                    {"question": query, "count": self.query_count},
+                    config={"callbacks": run_manager.get_child()},
+                ),
+            )
+            self.variant_cache.set(key, variants)
+
+        queries = [query, *variants]
+        embeddings = await self.vector_store.embeddings.aembed_documents(queries)
+        dense_rankings = await asyncio.to_thread(
+            search_dense, self.vector_store, embeddings, self.fetch_k
+        )
+
+        return self._fuse(queries, dense_rankings)
+
+    def _parse_variants(self, query: str, output: str) -> list[str]:
+        seen = {normalize_query(query)}
+        variants = []
+
+        for line in output.splitlines():
+            variant = _VARIANT_PREFIX_PATTERN.sub("", line).strip()
+
+            if variant and normalize_query(variant) not in seen:
+                seen.add(normalize_query(variant))
+                variants.append(variant)
+
+        return variants[: self.query_count]
+
+    def _fuse(
+        self, queries: list[str], dense_rankings: list[list[int]]
+    ) -> list[Document]:
+        weighted_rankings = [(self.dense_weight, ranking) for ranking in dense_rankings]
+
+        if self.lexical_index is not None:
+            for query in queries:
+                lexical_results = self.lexical_index.search(query, self.fetch_k)
+                weighted_rankings.append(
+                    (self.lexical_weight, [position for position, _ in lexical_results])
+                )
+
+        positions = fuse_rankings(weighted_rankings, self.rrf_k, self.k)
+
+        return get_documents(self.vector_store, positions)
+
+
+def load_cross_encoder(model_name: str = RERANK_MODEL) -> Any:
+    """Load the cross-encoder used for reranking.
+
+    Args:
+        model_name (str): Name of the cross-encoder model.
+
+    Returns:
+        Any: The sentence-transformers cross-encoder.
+    """
+    # Imported here, loading torch is slow and only needed for reranking.
+    from sentence_transformers import CrossEncoder
+
+    return CrossEncoder(model_name, device="cpu")
+
+
+class RerankingRetriever(BaseRetriever):
+    """Reranks the chunks of a retriever with a cross-encoder.
+
+    The retriever over-fetches, the cross-encoder scores every query / chunk
+    pair in batches and the best `top_k` chunks are returned. If scoring takes
+    longer than the timeout, or `RERANK_MAX_CONCURRENCY` reranks are already
+    scoring, the first `top_k` chunks are returned in retrieved order instead.
+    """
+
+    retriever: BaseRetriever
+    cross_encoder: Any
+    top_k: int = RERANK_TOP_K
+    timeout: float = RERANK_TIMEOUT_SECONDS
+    batch_size: int = RERANK_BATCH_SIZE
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        documents = self.retriever.invoke(
+            query, config={"callbacks": run_manager.get_child()}
+        )
+        future = self._submit_score(query, documents)
+
+        if future is None:
+            return documents[: self.top_k]
+
+        try:
+            with span("retriever.rerank"):
+                scores = future.result(self.timeout)
+        except FutureTimeoutError:
+            logger.warning("Reranking timed out after %ss", self.timeout)
+            return documents[: self.top_k]
+
+        return self._rerank(documents, scores)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        documents = await self.retriever.ainvoke(
+            query, config={"callbacks": run_manager.get_child()}
+        )
+        future = self._submit_score(query, documents)
+
+        if future is None:
+            return documents[: self.top_k]
+
+        try:
+            with span("retriever.rerank"):
+                scores = await asyncio.wait_for(
+                    asyncio.wrap_future(future), self.timeout
+                )
+        except asyncio.TimeoutError:
+            logger.warning("Reranking timed out after %ss", self.timeout)
+            return documents[: self.top_k]
+
+        return self._rerank(documents, scores)
+
+    def _submit_score(self, query: str, documents: list[Document]) -> Optional[Future]:
+        """Start scoring the chunks in the rerank executor.
+
+        Args:
+            query (str): The query.
+            documents (list[Document]): Retrieved chunks.
+
+        Returns:
+            Optional[Future]: Future of the scores or None if too many reranks
+                are already scoring.
+        """
+        if not _rerank_slots.acquire(blocking=False):
+            logger.warning(
+                "Reranking skipped, %s reranks running", RERANK_MAX_CONCURRENCY
+            )
+            return None
+
+        future = _rerank_executor.submit(self._score, query, documents)
+        future.add_done_callback(lambda _: _rerank_slots.release())
+
+        return future
+
+    def _score(self, query: str, documents: list[Document]) -> list[float]:
+        if not documents:
+            return []
+
+        return self.cross_encoder.predict(
+            [(query, document.page_content) for document in documents],
+            batch_size=self.batch_size,
+            show_progress_bar=False,
+        ).tolist()
+
+    def _rerank(self, documents: list[Document], scores: list[float]) -> list[Document]:
+        ranking = sorted(range(len(documents)), key=scores.__getitem__, reverse=True)
+        return [documents[index] for index in ranking[: self.top_k]]
@@ -0,0 +1,308 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+
+from app.constants import SEARCH_CACHE_PATH
+from app.utils.cache import TTLCache
+from app.utils.text import normalize_query
+from app.utils.tracing import span
+from langchain_community.utilities.tavily_search import TavilySearchAPIWrapper
+from langchain_core.tools import Tool
+
+logger = logging.getLogger(__name__)
+
+# "tavily" searches the web, "fake" returns canned results for tests.
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "tavily")
+# Maximum number of results per search.
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", 5))
+# Seconds the agent waits for a search before falling back to the knowledge base.
+SEARCH_TIMEOUT_SECONDS = float(os.getenv("SEARCH_TIMEOUT_SECONDS", 8))
+# Seconds search results are reused for.
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", 3600))
+# Maximum number of cached searches per process.
+SEARCH_CACHE_MAX_SIZE = int(os.getenv("SEARCH_CACHE_MAX_SIZE", 1000))
+# Set to "true" to also keep search results on disk, shared between processes.
+SEARCH_CACHE_PERSIST = os.getenv("SEARCH_CACHE_PERSIST", "false").lower() == "true"
+
+# Name of the knowledge retriever tool the agent falls back to.
+KNOWLEDGE_RETRIEVER_TOOL_NAME = "Diabetes Knowledge retriever tool"
+ONLINE_SEARCH_TOOL_NAME = "Online Search Tool"
+
+SEARCH_TIMEOUT_MESSAGE = (
+    "The online search is taking too long. "
+    f"Use the {KNOWLEDGE_RETRIEVER_TOOL_NAME} instead."
+)
+
+
+class SearchBackend(ABC):
+    """Searches the web."""
+
+    @abstractmethod
+    async def search(self, query: str) -> list[dict]:
+        """Search the web.
+
+        Args:
+            query (str): The search query.
+
+        Returns:
+            list[dict]: The results, with their url and content.
+        """
+
+
+class TavilySearchBackend(SearchBackend):
+    """Searches the web with the Tavily search API."""
+
+    def __init__(self, max_results: int = SEARCH_MAX_RESULTS):
+        """Initialize the Tavily search backend.
+
+        Args:
+            max_results (int): Maximum number of results per search.
+        """
+        self.api_wrapper = TavilySearchAPIWrapper()
+        self.max_results = max_results
+
+    async def search(self, query: str) -> list[dict]:
+        return await self.api_wrapper.results_async(query, self.max_results)
+
+
+class FakeSearchBackend(SearchBackend):
+    """Returns canned results without calling any API."""
+
+    def __init__(
+        self,
+        results: Optional[dict[str, list[dict]]] = None,
+        latency: float = 0.0,
+    ):
+        """Initialize the fake search backend.
+
+        Args:
+            results (Optional[dict[str, list[dict]]]): Results by normalized query,
+                a single generated result for any other query.
+            latency (float): Seconds every search takes.
+        """
+        self.results = results or {}
+        self.latency = latency
+        self.calls = 0
+
+    async def search(self, query: str) -> list[dict]:
+        self.calls += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        return self.results.get(
+            normalize_query(query),
+            [
+                {
+                    "url": "https://example.com/search",
+                    "content": f"Search results for {query}.",
+                }
+            ],
+        )
+
+
+class SearchResultStore:
+    """SQLite store of search results, shared between processes."""
+
+    def __init__(self, path: Path):
+        """Initialize the search result store.
+
+        Args:
+            path (Path): Path of the SQLite database.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS search_results (
+                query TEXT PRIMARY KEY,
+                results TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+        self._connection.commit()
+
+    def get(self, query: str) -> Optional[list[dict]]:
+        """Get the stored results of a search.
+
+        Args:
+            query (str): The normalized search query.
+
+        Returns:
+            Optional[list[dict]]: The results or None if missing or expired.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT results FROM search_results WHERE query = ? AND expires_at > ?",
+                (query, time.time()),
+            ).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def set(self, query: str, results: list[dict], ttl: float):
+        """Store the results of a search.
+
+        Args:
+            query (str): The normalized search query.
+            results (list[dict]): The results.
+            ttl (float): Time to live in seconds.
+        """
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO search_results VALUES (?, ?, ?)",
+                (query, json.dumps(results), now + ttl),
+            )
+            # Expired results are only removed when new ones come in.
+            self._connection.execute(
+                "DELETE FROM search_results WHERE expires_at <= ?", (now,)
+            )
+            self._connection.commit()
+
+
+class CachedSearch:
+    """Caches and coalesces the searches of a search backend.
+
+    Results are cached by normalized query. Concurrent searches for the same
+    query share a single backend call, and a search that exceeds the timeout
+    returns a message pointing the agent to the knowledge retriever instead.
+    The backend call keeps running, so its results are still cached.
+    """
+
+    def __init__(
+        self,
+        backend: SearchBackend,
+        ttl: float = SEARCH_CACHE_TTL_SECONDS,
+        maxsize: int = SEARCH_CACHE_MAX_SIZE,
+        timeout: float = SEARCH_TIMEOUT_SECONDS,
+        store: Optional[SearchResultStore] = None,
+    ):
+        """Initialize the cached search.
+
+        Args:
+            backend (SearchBackend): The search backend.
+            ttl (float): Time to live of search results in seconds.
+            maxsize (int): Maximum number of cached searches.
+            timeout (float): Seconds to wait for a search.
+            store (Optional[SearchResultStore]): Store persisting the results.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.timeout = timeout
+        self.store = store
+        self.cache: TTLCache[str, list[dict]] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    async def search(self, query: str) -> list[dict] | str:
+        """Search the web, reusing cached results.
+
+        Args:
+            query (str): The search query.
+
+        Returns:
+            list[dict] | str: The results or a message for the agent if the
+                search failed or timed out.
+        """
+        key = normalize_query(query)
+        results = self.cache.get(key)
+
+        if results is not None:
+            return results
+
+        task = self._in_flight.get(key)
+
+        if task is None:
+            task = asyncio.create_task(self._search(key, query))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._on_search_done(key, task))
+
+        try:
+            # Shielded, so a timed out caller doesn't cancel the shared search.
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Online search timed out after %ss", self.timeout)
+            return SEARCH_TIMEOUT_MESSAGE
+        except Exception as e:
+            return repr(e)
+
+    def _on_search_done(self, key: str, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+        # Retrieve the error, every caller may have timed out already.
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Online search failed: %r", task.exception())
+
+    async def _search(self, key: str, query: str) -> list[dict]:
+        if self.store is not None:
+            results = await asyncio.to_thread(self.store.get, key)
+
+            if results is not None:
+                self.cache.set(key, results)
+                return results
+
+        with span("search.backend"):
+            results = await self.backend.search(query)
+
+        self.cache.set(key, results)
+
+        if self.store is not None:
+            await asyncio.to_thread(self.store.set, key, results, self.ttl)
+
+        return results
+
+
+def create_search_backend() -> SearchBackend:
+    """Create the search backend configured for this deployment.
+
+    Raises:
+        ValueError: Unknown search backend.
+
+    Returns:
+        SearchBackend: The search backend.
+    """
+    if SEARCH_BACKEND == "tavily":
+        return TavilySearchBackend()
+    if SEARCH_BACKEND == "fake":
+        return FakeSearchBackend()
+
+    raise ValueError(f'Unknown search backend "{SEARCH_BACKEND}"')
+
+
+def create_online_search_tool(backend: Optional[SearchBackend] = None) -> Tool:
+    """Create the agent's online search tool.
+
+    Args:
+        backend (Optional[SearchBackend]): The search backend, the configured one
+            if None.
+
+    Returns:
+        Tool: The online search tool, which only runs asynchronously.
+    """
+    cached_search = CachedSearch(
+        backend or create_search_backend(),
+        store=SearchResultStore(SEARCH_CACHE_PATH) if SEARCH_CACHE_PERSIST else None,
+    )
+
+    return Tool(
+        name=ONLINE_SEARCH_TOOL_NAME,
+        description="""Search the web for information related to diabetes management.
+        This tool should be used when you are unable to find the required diabetes management information using the Diabetes Knowledge retriever tool.
+        Its important to note that the information retrieved from the web may not always be accurate or up-to-date.
+        So always make sure to verify the information from a reliable source before using it. Use the retrieved information to enhance your knowledge and provide better support to your patient.
+        """,
+        func=None,
+        coroutine=cached_search.search,
+    )
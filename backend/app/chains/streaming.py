@@ -0,0 +1,58 @@
+FINAL_ANSWER_PREFIX = "Final Answer:"
+
+
+class FinalAnswerStreamParser:
+    """Extracts the final answer tokens from a streamed ReAct LLM generation.
+
+    The ReAct agent emits its reasoning ("Thought: ...", "Action: ...") before the
+    "Final Answer:" marker. Tokens are held back until the marker is seen and then
+    forwarded as they arrive.
+    """
+
+    def __init__(self, prefix: str = FINAL_ANSWER_PREFIX):
+        """Initialize the parser.
+
+        Args:
+            prefix (str): Marker that precedes the final answer.
+        """
+        self.prefix = prefix
+        self.reset()
+
+    def reset(self):
+        """Reset the parser state for a new LLM generation."""
+        self._buffer = ""
+        self._in_final_answer = False
+        self._has_emitted = False
+
+    def feed(self, token: str) -> str:
+        """Feed a streamed token to the parser.
+
+        Args:
+            token (str): Token emitted by the LLM.
+
+        Returns:
+            str: Final answer content to forward, empty if none yet.
+        """
+        if not self._in_final_answer:
+            self._buffer += token
+            index = self._buffer.find(self.prefix)
+
+            if index == -1:
+                # Only keep enough text to detect a marker split across tokens.
+                self._buffer = self._buffer[-(len(self.prefix) - 1) :]
+                return ""
+
+            self._in_final_answer = True
+            token = self._buffer[index + len(self.prefix) :]
+            self._buffer = ""
+
+        if not self._has_emitted:
+            # Drop the whitespace between the marker and the answer.
+            token = token.lstrip()
+
+            if not token:
+                return ""
+
+            self._has_emitted = True
+
+        return token
@@ -4,3 +4,5 @@ ROOT_DIR = Path(__file__).resolve().parent.parent
 
 KNOWLEDGE_BASE_PATH = ROOT_DIR / "vectorstores" / "faiss"
 RAW_DATA_PATH = ROOT_DIR / "data" / "raw_data"
+EMBEDDING_CACHE_PATH = ROOT_DIR / "vectorstores" / "embedding_cache.sqlite3"
+SEARCH_CACHE_PATH = ROOT_DIR / "vectorstores" / "search_cache.sqlite3"
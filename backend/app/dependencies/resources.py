@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from app.chains.agentic import create_agent_executor, create_knowledge_retriever
+from app.chains.answer_cache import clear_answer_cache
+from app.chains.chat import create_rag_chain
+from app.constants import KNOWLEDGE_BASE_PATH
+from app.exceptions.common import ResourceNotReadyException
+from app.ingest.faiss import load_or_create_index
+from app.ingest.store import get_serving_index_path, load_lexical_index
+from app.utils.resources import ResourceRegistry
+from fastapi import HTTPException, status
+from langchain.agents import AgentExecutor
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for a new serving index build, 0 disables reloading.
+KNOWLEDGE_INDEX_RELOAD_INTERVAL_SECONDS = float(
+    os.getenv("KNOWLEDGE_INDEX_RELOAD_INTERVAL_SECONDS", 30)
+)
+
+VECTOR_STORE = "vector_store"
+LEXICAL_INDEX = "lexical_index"
+KNOWLEDGE_RETRIEVER = "knowledge_retriever"
+AGENT_EXECUTOR = "agent_executor"
+RAG_CHAIN = "rag_chain"
+
+# Create the process-wide resource registry.
+resource_registry = ResourceRegistry()
+
+resource_registry.register(VECTOR_STORE, load_or_create_index, eager=True)
+resource_registry.register(
+    LEXICAL_INDEX, lambda: load_lexical_index(resource_registry.load(VECTOR_STORE))
+)
+resource_registry.register(
+    KNOWLEDGE_RETRIEVER,
+    lambda: create_knowledge_retriever(
+        resource_registry.load(VECTOR_STORE), resource_registry.load(LEXICAL_INDEX)
+    ),
+)
+resource_registry.register(
+    AGENT_EXECUTOR,
+    lambda: create_agent_executor(resource_registry.load(KNOWLEDGE_RETRIEVER)),
+    eager=True,
+)
+resource_registry.register(
+    RAG_CHAIN, lambda: create_rag_chain(resource_registry.load(VECTOR_STORE))
+)
+
+# Resources built on the knowledge index, dependencies first.
+KNOWLEDGE_INDEX_RESOURCES = [
+    VECTOR_STORE,
+    LEXICAL_INDEX,
+    KNOWLEDGE_RETRIEVER,
+    AGENT_EXECUTOR,
+    RAG_CHAIN,
+]
+
+
+class KnowledgeIndexReloader:
+    """Reloads the knowledge index when the ingest command exports a new build.
+
+    The resources built on the index are reloaded along with it, so the
+    knowledge retriever starts with an empty cache, and the cached answers are
+    removed. Requests are served by the loaded resources until the new ones
+    are ready.
+    """
+
+    def __init__(
+        self,
+        registry: ResourceRegistry,
+        interval: float = KNOWLEDGE_INDEX_RELOAD_INTERVAL_SECONDS,
+    ):
+        """Initialize the knowledge index reloader.
+
+        Args:
+            registry (ResourceRegistry): Registry holding the index resources.
+            interval (float): Seconds between checks for a new build.
+        """
+        self.registry = registry
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start checking for new builds unless it is running or disabled."""
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._reload_periodically())
+
+    async def stop(self):
+        """Stop checking for new builds."""
+        if self._task is not None:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+    async def reload_if_changed(self) -> bool:
+        """Reload the knowledge index if a new build was exported.
+
+        Returns:
+            bool: True if the index was reloaded.
+        """
+        if not self.registry.is_ready(VECTOR_STORE):
+            # The first load picks up the current build.
+            return False
+
+        vector_store = self.registry.load(VECTOR_STORE)
+        loaded_path = getattr(vector_store.docstore, "build_path", None)
+        current_path = await asyncio.to_thread(
+            get_serving_index_path, KNOWLEDGE_BASE_PATH
+        )
+
+        if current_path is None or current_path == loaded_path:
+            return False
+
+        # Resources not loaded yet will be loaded from the new index.
+        await self.registry.reload(
+            [
+                name
+                for name in KNOWLEDGE_INDEX_RESOURCES
+                if name == VECTOR_STORE or self.registry.is_ready(name)
+            ]
+        )
+        clear_answer_cache()
+        logger.info("Reloaded the knowledge index build %s", current_path.name)
+
+        return True
+
+    async def _reload_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.reload_if_changed()
+            except Exception:
+                # Keep serving the loaded index, the next run will retry.
+                logger.exception("Failed to reload the knowledge index")
+
+
+knowledge_index_reloader = KnowledgeIndexReloader(resource_registry)
+
+
+def get_resource_registry() -> ResourceRegistry:
+    """Get the resource registry
+
+    Returns:
+        ResourceRegistry: The resource registry
+    """
+    return resource_registry
+
+
+async def get_agent_executor() -> AgentExecutor:
+    """Get the agent executor
+
+    Raises:
+        HTTPException: 503 if the agent executor is not ready yet.
+
+    Returns:
+        AgentExecutor: The agent executor
+    """
+    try:
+        return resource_registry.get(AGENT_EXECUTOR)
+    except ResourceNotReadyException as rnre:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=rnre.message
+        )
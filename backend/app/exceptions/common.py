@@ -11,3 +11,33 @@ class NotFoundException(Exception):
     ):
         self.message = message
         super().__init__(self.message)
+
+
+class DeadlineExceededException(Exception):
+    """Exception to raise when a step doesn't finish before its deadline.
+
+    Args:
+        Exception (Exception): Base exception class.
+    """
+
+    def __init__(
+        self,
+        message="Deadline exceeded",
+    ):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ResourceNotReadyException(Exception):
+    """Exception to raise when a resource is still loading or failed to load.
+
+    Args:
+        Exception (Exception): Base exception class.
+    """
+
+    def __init__(
+        self,
+        message="Resource not ready",
+    ):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,78 @@
+import argparse
+import logging
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app.constants import KNOWLEDGE_BASE_PATH, RAW_DATA_PATH
+from app.ingest.embeddings import EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_CONCURRENCY
+from app.ingest.index import INDEX_TYPES, IndexConfig
+from app.ingest.pipeline import convert_legacy_index, ingest
+
+parser = argparse.ArgumentParser(
+    prog="python -m app.ingest",
+    description="Bring the knowledge index up to date with the source PDFs.",
+)
+parser.add_argument("--raw-data-path", type=Path, default=RAW_DATA_PATH)
+parser.add_argument("--index-path", type=Path, default=KNOWLEDGE_BASE_PATH)
+parser.add_argument(
+    "--workers", type=int, default=None, help="Number of PDF parsing processes."
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=EMBEDDING_BATCH_SIZE,
+    help="Number of chunks per embedding request.",
+)
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=EMBEDDING_MAX_CONCURRENCY,
+    help="Maximum number of concurrent embedding requests.",
+)
+parser.add_argument(
+    "--index-type",
+    choices=INDEX_TYPES,
+    default=None,
+    help="Type of the search index, KNOWLEDGE_INDEX_TYPE if not set.",
+)
+parser.add_argument(
+    "--convert-legacy-index",
+    action="store_true",
+    help="Convert the pickled index written by earlier versions instead of "
+    "ingesting the PDFs. It is unpickled, only convert an index you trust.",
+)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    args = parser.parse_args()
+
+    index_config = IndexConfig.from_env()
+
+    if args.index_type is not None:
+        index_config.index_type = args.index_type
+
+    if args.convert_legacy_index:
+        count = convert_legacy_index(
+            args.index_path, args.raw_data_path, index_config=index_config
+        )
+        print(f"converted: {count} chunks")
+    else:
+        result = ingest(
+            args.raw_data_path,
+            args.index_path,
+            max_workers=args.workers,
+            batch_size=args.batch_size,
+            max_concurrency=args.concurrency,
+            index_config=index_config,
+        )
+
+        for status in ("added", "updated", "removed", "unchanged", "failed"):
+            sources = getattr(result, status)
+            print(f"{status}: {len(sources)}")
+
+            for source in sources:
+                print(f"  {source}")
@@ -0,0 +1,156 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Chunks, vectors and source hashes of the ingested PDFs.
+CHUNK_STORE_FILE_NAME = "chunks.sqlite3"
+
+
+class ChunkStore:
+    """SQLite store of the ingested chunks and their vectors.
+
+    It is the source of truth of the ingest command, the serving index is
+    exported from it. Every source file is committed on its own, so an
+    interrupted ingest keeps the files it finished.
+    """
+
+    def __init__(self, path: Path):
+        """Initialize the chunk store.
+
+        Args:
+            path (Path): Path of the SQLite database.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sources (
+                source TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                position INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT NOT NULL REFERENCES sources (source),
+                page_content TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                vector BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source);
+            """
+        )
+
+    def get_source_hashes(self) -> dict[str, str]:
+        """Get the content hash of every ingested source file.
+
+        Returns:
+            dict[str, str]: SHA-256 hex digest by source file.
+        """
+        return dict(self._connection.execute("SELECT source, sha256 FROM sources"))
+
+    def replace_source(
+        self,
+        source: str,
+        sha256: str,
+        documents: list[Document],
+        vectors: list[list[float]],
+    ):
+        """Replace the chunks of a source file.
+
+        Args:
+            source (str): Source file, relative to the raw data directory.
+            sha256 (str): Content hash of the source file.
+            documents (list[Document]): Chunks of the source file.
+            vectors (list[list[float]]): Vector of every chunk.
+        """
+        with self._connection:
+            self._delete_source(source)
+            self._connection.execute(
+                "INSERT INTO sources VALUES (?, ?)", (source, sha256)
+            )
+            self._connection.executemany(
+                """
+                INSERT INTO chunks (source, page_content, metadata, vector)
+                VALUES (?, ?, ?, ?)
+                """,
+                [
+                    (
+                        source,
+                        document.page_content,
+                        json.dumps(document.metadata, default=str),
+                        np.asarray(vector, dtype=np.float32).tobytes(),
+                    )
+                    for document, vector in zip(documents, vectors)
+                ],
+            )
+
+    def delete_source(self, source: str):
+        """Delete a source file and its chunks.
+
+        Args:
+            source (str): Source file, relative to the raw data directory.
+        """
+        with self._connection:
+            self._delete_source(source)
+
+    def count(self) -> int:
+        """Count the chunks.
+
+        Returns:
+            int: Number of chunks.
+        """
+        return self._connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def dimension(self) -> Optional[int]:
+        """Get the dimension of the vectors.
+
+        Returns:
+            Optional[int]: The dimension or None if there are no chunks.
+        """
+        row = self._connection.execute(
+            "SELECT LENGTH(vector) FROM chunks LIMIT 1"
+        ).fetchone()
+
+        return row[0] // np.dtype(np.float32).itemsize if row else None
+
+    def iter_chunks(self) -> Iterator[tuple[Document, np.ndarray]]:
+        """Iterate over the chunks in a stable order.
+
+        Yields:
+            Iterator[tuple[Document, np.ndarray]]: Every chunk and its vector.
+        """
+        rows = self._connection.execute(
+            "SELECT page_content, metadata, vector FROM chunks ORDER BY position"
+        )
+
+        for page_content, metadata, vector in rows:
+            yield (
+                Document(page_content=page_content, metadata=json.loads(metadata)),
+                np.frombuffer(vector, dtype=np.float32),
+            )
+
+    def iter_texts(self) -> Iterator[str]:
+        """Iterate over the chunk texts in the order of `iter_chunks`.
+
+        Yields:
+            Iterator[str]: Every chunk text.
+        """
+        rows = self._connection.execute(
+            "SELECT page_content FROM chunks ORDER BY position"
+        )
+
+        for (page_content,) in rows:
+            yield page_content
+
+    def close(self):
+        """Close the database connection."""
+        self._connection.close()
+
+    def _delete_source(self, source: str):
+        self._connection.execute("DELETE FROM chunks WHERE source = ?", (source,))
+        self._connection.execute("DELETE FROM sources WHERE source = ?", (source,))
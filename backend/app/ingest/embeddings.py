@@ -0,0 +1,519 @@
+import asyncio
+import atexit
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+import openai
+from app.constants import EMBEDDING_CACHE_PATH
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# Embedding model used for the knowledge index.
+EMBEDDING_MODEL = "text-embedding-3-large"
+# Maximum size of the cached vectors, 0 disables the cache.
+EMBEDDING_CACHE_MAX_SIZE_MB = int(os.getenv("EMBEDDING_CACHE_MAX_SIZE_MB", 1024))
+# Number of texts sent to the embedding model per request when building the index.
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+# Maximum number of concurrent embedding requests when building the index.
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 4))
+# Maximum number of retries of a failed embedding request.
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 6))
+# Seconds between writes of the last use of cached vectors, which orders evictions.
+EMBEDDING_CACHE_TOUCH_INTERVAL_SECONDS = float(
+    os.getenv("EMBEDDING_CACHE_TOUCH_INTERVAL_SECONDS", 60)
+)
+
+# Maximum number of variables in a single SQLite statement.
+_SQLITE_BATCH_SIZE = 500
+# Maximum number of last uses kept in memory before they are written.
+_MAX_PENDING_TOUCHES = 10000
+
+
+def hash_text(text: str) -> str:
+    """Compute the SHA-256 hash of a text.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        str: Hex digest of the text.
+    """
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _batched(items: list, size: int) -> Iterable[list]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+class EmbeddingCache:
+    """Disk-backed embedding cache keyed by model name and text hash.
+
+    Vectors are stored as float32 blobs in SQLite, so the cache can be shared by
+    the ingest command and every server process. Once the cached vectors exceed
+    the maximum size, the least recently used ones are evicted.
+
+    Lookups don't write, the last use of the vectors read is kept in memory and
+    written in one transaction every `touch_interval` seconds, before evicting
+    and on close. Vectors used within the interval aren't written again.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_size_bytes: int,
+        touch_interval: float = EMBEDDING_CACHE_TOUCH_INTERVAL_SECONDS,
+    ):
+        """Initialize the embedding cache.
+
+        Args:
+            path (Path): Path of the SQLite database.
+            max_size_bytes (int): Maximum size of the cached vectors.
+            touch_interval (float): Seconds between writes of the last uses.
+        """
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.touch_interval = touch_interval
+        # Last use of the vectors read since the last write, by model and text hash.
+        self._touches: dict[tuple[str, str], float] = {}
+        self._touches_written_at = time.monotonic()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets the server read while the ingest command writes.
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._connection.commit()
+        self._size_bytes = self._compute_size()
+        # Write the last uses read by the time the process exits.
+        atexit.register(self.close)
+
+    def get_many(self, model: str, text_hashes: list[str]) -> dict[str, list[float]]:
+        """Get the cached vectors of texts.
+
+        Args:
+            model (str): Name of the embedding model.
+            text_hashes (list[str]): Hashes of the texts.
+
+        Returns:
+            dict[str, list[float]]: Vector by text hash, misses are left out.
+        """
+        vectors = {}
+
+        with self._lock:
+            for batch in _batched(list(set(text_hashes)), _SQLITE_BATCH_SIZE):
+                rows = self._connection.execute(
+                    f"""
+                    SELECT text_hash, vector FROM embeddings
+                    WHERE model = ? AND text_hash IN ({",".join("?" * len(batch))})
+                    """,
+                    [model, *batch],
+                )
+                vectors.update(
+                    (text_hash, np.frombuffer(vector, dtype=np.float32).tolist())
+                    for text_hash, vector in rows
+                )
+
+            now = time.time()
+            self._touches.update(((model, text_hash), now) for text_hash in vectors)
+
+            if (
+                len(self._touches) >= _MAX_PENDING_TOUCHES
+                or time.monotonic() - self._touches_written_at >= self.touch_interval
+            ):
+                with self._transaction():
+                    self._write_touches()
+
+        return vectors
+
+    def set_many(self, model: str, vectors: dict[str, list[float]]):
+        """Cache the vectors of texts.
+
+        Args:
+            model (str): Name of the embedding model.
+            vectors (dict[str, list[float]]): Vector by text hash.
+        """
+        if not vectors:
+            return
+
+        now = time.time()
+        rows = [
+            (model, text_hash, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text_hash, vector in vectors.items()
+        ]
+
+        with self._lock:
+            with self._transaction():
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows
+                )
+                # Written in the same transaction.
+                self._write_touches()
+
+            self._size_bytes += sum(len(row[2]) for row in rows)
+
+            if self._size_bytes > self.max_size_bytes:
+                with self._transaction():
+                    self._evict()
+
+    def close(self):
+        """Write the pending last uses and close the database."""
+        with self._lock:
+            if self._connection is None:
+                return
+
+            self._write_touches()
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """Commit the statements run within, or roll them back on error.
+
+        A failed transaction would otherwise keep the database locked for the
+        other processes.
+        """
+        try:
+            yield
+            self._connection.commit()
+        except sqlite3.Error:
+            self._connection.rollback()
+            raise
+
+    def _write_touches(self):
+        """Write the pending last uses, except of vectors used within the interval."""
+        if self._touches:
+            self._connection.executemany(
+                """
+                UPDATE embeddings SET last_used = ?
+                WHERE model = ? AND text_hash = ? AND last_used < ?
+                """,
+                [
+                    (last_used, model, text_hash, last_used - self.touch_interval)
+                    for (model, text_hash), last_used in self._touches.items()
+                ],
+            )
+            self._touches = {}
+
+        self._touches_written_at = time.monotonic()
+
+    def _evict(self):
+        """Evict the least recently used vectors down to 90% of the maximum size."""
+        # Recent uses must be written first, so they aren't evicted as unused.
+        self._write_touches()
+        # The size is tracked per process, other processes may have written since.
+        self._size_bytes = self._compute_size()
+        target_size = self.max_size_bytes * 0.9
+
+        while self._size_bytes > target_size:
+            rows = self._connection.execute(
+                """
+                SELECT model, text_hash, LENGTH(vector) FROM embeddings
+                ORDER BY last_used LIMIT ?
+                """,
+                (_SQLITE_BATCH_SIZE,),
+            ).fetchall()
+
+            if not rows:
+                break
+
+            evicted = []
+
+            for model, text_hash, size in rows:
+                evicted.append((model, text_hash))
+                self._size_bytes -= size
+
+                if self._size_bytes <= target_size:
+                    break
+
+            self._connection.executemany(
+                "DELETE FROM embeddings WHERE model = ? AND text_hash = ?", evicted
+            )
+
+    def _compute_size(self) -> int:
+        return self._connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that only call the underlying model for texts not cached yet.
+
+    A failing cache, e.g. a SQLite database locked by another process, is
+    logged and treated as a miss, so embedding never fails because of it.
+    """
+
+    def __init__(self, underlying: Embeddings, cache: EmbeddingCache, model: str):
+        """Initialize the cached embeddings.
+
+        Args:
+            underlying (Embeddings): Embeddings used on a cache miss.
+            cache (EmbeddingCache): The embedding cache.
+            model (str): Name of the embedding model, part of the cache key.
+        """
+        self.underlying = underlying
+        self.cache = cache
+        self.model = model
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        text_hashes = [hash_text(text) for text in texts]
+        vectors = self._get_cached(text_hashes)
+        misses = self._get_misses(texts, text_hashes, vectors)
+
+        if misses:
+            new_vectors = dict(
+                zip(misses, self.underlying.embed_documents(list(misses.values())))
+            )
+            self._set_cached(new_vectors)
+            vectors.update(new_vectors)
+
+        return [vectors[text_hash] for text_hash in text_hashes]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        text_hashes = [hash_text(text) for text in texts]
+        vectors = await asyncio.to_thread(self._get_cached, text_hashes)
+        misses = self._get_misses(texts, text_hashes, vectors)
+
+        if misses:
+            new_vectors = dict(
+                zip(
+                    misses,
+                    await self.underlying.aembed_documents(list(misses.values())),
+                )
+            )
+            await asyncio.to_thread(self._set_cached, new_vectors)
+            vectors.update(new_vectors)
+
+        return [vectors[text_hash] for text_hash in text_hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        text_hash = hash_text(text)
+        vector = self._get_cached([text_hash]).get(text_hash)
+
+        if vector is None:
+            vector = self.underlying.embed_query(text)
+            self._set_cached({text_hash: vector})
+
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        text_hash = hash_text(text)
+        vector = (await asyncio.to_thread(self._get_cached, [text_hash])).get(text_hash)
+
+        if vector is None:
+            vector = await self.underlying.aembed_query(text)
+            await asyncio.to_thread(self._set_cached, {text_hash: vector})
+
+        return vector
+
+    def _get_cached(self, text_hashes: list[str]) -> dict[str, list[float]]:
+        """Get the cached vectors of texts, none if the cache fails.
+
+        Returns:
+            dict[str, list[float]]: Vectors by text hash.
+        """
+        try:
+            return self.cache.get_many(self.model, text_hashes)
+        except sqlite3.Error:
+            logger.warning("Failed to read the embedding cache", exc_info=True)
+            return {}
+
+    def _set_cached(self, vectors: dict[str, list[float]]):
+        """Cache the vectors of texts, unless the cache fails."""
+        try:
+            self.cache.set_many(self.model, vectors)
+        except sqlite3.Error:
+            logger.warning("Failed to write the embedding cache", exc_info=True)
+
+    @staticmethod
+    def _get_misses(
+        texts: list[str], text_hashes: list[str], vectors: dict[str, list[float]]
+    ) -> dict[str, str]:
+        """Get the distinct texts that aren't cached.
+
+        Returns:
+            dict[str, str]: Text by text hash.
+        """
+        return {
+            text_hash: text
+            for text, text_hash in zip(texts, text_hashes)
+            if text_hash not in vectors
+        }
+
+
+class BatchEmbedder:
+    """Embeds texts in batches with a bounded number of concurrent requests.
+
+    Rate limited, timed out and server error requests are retried with
+    exponential backoff, honouring the `Retry-After` header of rate limited
+    responses. Other errors, such as invalid requests, are raised right away. Backing off keeps the
+    concurrency slot, so a rate limit slows down every batch.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+        progress: Optional[tqdm] = None,
+    ):
+        """Initialize the batch embedder.
+
+        Args:
+            embeddings (Embeddings): Embeddings used for every batch.
+            batch_size (int): Number of texts per request.
+            max_concurrency (int): Maximum number of concurrent requests.
+            max_retries (int): Maximum number of retries of a failed request.
+            progress (Optional[tqdm]): Progress bar updated with embedded texts.
+        """
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.progress = progress
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        """Embed texts.
+
+        Args:
+            texts (list[str]): Texts to embed.
+
+        Returns:
+            list[list[float]]: Vectors in the order of the texts.
+        """
+        batches = await asyncio.gather(
+            *(self._aembed_batch(batch) for batch in _batched(texts, self.batch_size))
+        )
+
+        return [vector for batch in batches for vector in batch]
+
+    async def _aembed_batch(self, texts: list[str]) -> list[list[float]]:
+        async with self._semaphore:
+            attempt = 0
+
+            while True:
+                try:
+                    vectors = await self.embeddings.aembed_documents(texts)
+                    break
+                except Exception as error:
+                    if attempt >= self.max_retries or not _is_retryable(error):
+                        raise
+
+                    delay = _get_retry_delay(error, attempt)
+                    attempt += 1
+                    logger.warning(
+                        "Embedding request failed (%s), retry %d in %.1fs",
+                        error,
+                        attempt,
+                        delay,
+                    )
+                    await asyncio.sleep(delay)
+
+        if self.progress is not None:
+            self.progress.update(len(texts))
+
+        return vectors
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Check whether a failed embedding request may succeed when retried.
+
+    Args:
+        error (Exception): Error of the failed request.
+
+    Returns:
+        bool: Whether the request was rate limited, timed out or hit a server error.
+    """
+    if isinstance(error, (openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+
+    status_code = getattr(error, "status_code", None)
+
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+
+    return status_code is not None and (status_code in (408, 429) or status_code >= 500)
+
+
+def _get_retry_delay(error: Exception, attempt: int) -> float:
+    """Get how long to wait before retrying a failed embedding request.
+
+    Args:
+        error (Exception): Error of the failed request.
+        attempt (int): Number of retries so far.
+
+    Returns:
+        float: Delay in seconds.
+    """
+    response = getattr(error, "response", None)
+    retry_after = getattr(response, "headers", {}).get("retry-after")
+
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        # Full jitter keeps concurrent batches from retrying in lockstep.
+        return random.uniform(0, min(60.0, 2.0 ** (attempt + 1)))
+
+
+_embedding_cache: EmbeddingCache | None = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Get the process-wide embedding cache.
+
+    Returns:
+        EmbeddingCache: The embedding cache.
+    """
+    global _embedding_cache
+
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(
+                EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_SIZE_MB * 1024 * 1024
+            )
+
+    return _embedding_cache
+
+
+def create_embeddings() -> Embeddings:
+    """Create the embeddings used for the knowledge index.
+
+    Returns:
+        Embeddings: The embeddings.
+    """
+    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+
+    if EMBEDDING_CACHE_MAX_SIZE_MB <= 0:
+        return embeddings
+
+    return CachedEmbeddings(embeddings, get_embedding_cache(), EMBEDDING_MODEL)
@@ -1,45 +1,31 @@
-from app.constants import KNOWLEDGE_BASE_PATH, RAW_DATA_PATH
-from langchain_community.document_loaders import DirectoryLoader, UnstructuredPDFLoader
-from langchain_community.vectorstores.faiss import FAISS
-from langchain_openai import OpenAIEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from app.constants import KNOWLEDGE_BASE_PATH
+from app.ingest.embeddings import create_embeddings
+from app.ingest.index import IndexConfig, get_search_params_from_env
+from app.ingest.pipeline import ingest
+from app.ingest.store import load_serving_index
 
 
 def load_or_create_index():
     """Load or create a FAISS index.
 
+    The serving index exported by the ingest command is memory-mapped read-only,
+    so the vectors and chunks are shared by every process on the host. It is
+    searched with the parameters saved with it, unless they are set in the
+    environment.
+
     Returns:
         FAISS: The FAISS index.
     """
     # Embeddings used for the index.
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-
-    if KNOWLEDGE_BASE_PATH.exists():
-        # Index file already exists, load it.
-        vector_db = FAISS.load_local(
-            KNOWLEDGE_BASE_PATH, embeddings, allow_dangerous_deserialization=True
-        )
-    else:
-        # Index file doesn't exist, create a new one
-        # Define the document loader.
-        document_loader = DirectoryLoader(
-            path=RAW_DATA_PATH,
-            glob="**/*.pdf",
-            use_multithreading=True,
-            show_progress=True,
-            loader_cls=UnstructuredPDFLoader,
-            loader_kwargs={"infer_table_structure": True, "strategy": "hi_res"},
-        )
-        # Load the documents.
-        loaded_documents = document_loader.load()
+    embeddings = create_embeddings()
+    search_params = get_search_params_from_env()
 
-        # Split the documents.
-        splitted_documents = RecursiveCharacterTextSplitter().split_documents(
-            loaded_documents
-        )
+    vector_db = load_serving_index(KNOWLEDGE_BASE_PATH, embeddings, search_params)
 
-        # Create and save the FAISS index.
-        vector_db = FAISS.from_documents(splitted_documents, embeddings)
-        vector_db.save_local(KNOWLEDGE_BASE_PATH)
+    if vector_db is None:
+        # Serving index doesn't exist, ingest the PDFs and export it.
+        # Prefer running `python -m app.ingest` ahead of time.
+        ingest(embeddings=embeddings, index_config=IndexConfig.from_env())
+        vector_db = load_serving_index(KNOWLEDGE_BASE_PATH, embeddings, search_params)
 
     return vector_db
@@ -0,0 +1,162 @@
+import logging
+import math
+import os
+from dataclasses import dataclass, replace
+from typing import Optional
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FLAT = "flat"
+IVF_FLAT = "ivf_flat"
+HNSW = "hnsw"
+IVF_PQ = "ivf_pq"
+INDEX_TYPES = (FLAT, IVF_FLAT, HNSW, IVF_PQ)
+
+# FAISS recommends at least this many training vectors per IVF list / PQ centroid.
+_MIN_TRAINING_POINTS_PER_CENTROID = 39
+
+
+def _getenv_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+@dataclass
+class IndexConfig:
+    """Type and parameters of the search index.
+
+    Build parameters:
+        nlist: Number of IVF lists, about 4 * sqrt(number of vectors) if None.
+        hnsw_m: Number of neighbours of an HNSW node.
+        ef_construction: HNSW candidate list size while building.
+        pq_m: Number of PQ sub-quantizers, must divide the vector dimension.
+        pq_nbits: Bits per PQ sub-quantizer code.
+
+    Search parameters:
+        nprobe: Number of IVF lists visited per query.
+        ef_search: HNSW candidate list size while searching.
+    """
+
+    index_type: str = FLAT
+    nlist: Optional[int] = None
+    hnsw_m: int = 32
+    ef_construction: int = 40
+    pq_m: int = 64
+    pq_nbits: int = 8
+    nprobe: int = 16
+    ef_search: int = 64
+
+    @classmethod
+    def from_env(cls) -> "IndexConfig":
+        """Create the index config from the environment.
+
+        Returns:
+            IndexConfig: The index config.
+        """
+        defaults = cls()
+        index_type = os.getenv("KNOWLEDGE_INDEX_TYPE", FLAT)
+
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f'Unknown knowledge index type "{index_type}"')
+
+        return cls(
+            index_type=index_type,
+            nlist=_getenv_int("KNOWLEDGE_INDEX_NLIST"),
+            hnsw_m=_getenv_int("KNOWLEDGE_INDEX_HNSW_M") or defaults.hnsw_m,
+            ef_construction=_getenv_int("KNOWLEDGE_INDEX_EF_CONSTRUCTION")
+            or defaults.ef_construction,
+            pq_m=_getenv_int("KNOWLEDGE_INDEX_PQ_M") or defaults.pq_m,
+            pq_nbits=_getenv_int("KNOWLEDGE_INDEX_PQ_NBITS") or defaults.pq_nbits,
+            nprobe=_getenv_int("KNOWLEDGE_INDEX_NPROBE") or defaults.nprobe,
+            ef_search=_getenv_int("KNOWLEDGE_INDEX_EF_SEARCH") or defaults.ef_search,
+        )
+
+
+def get_search_params_from_env() -> dict[str, int]:
+    """Get the search parameters set in the environment.
+
+    Returns:
+        dict[str, int]: `nprobe` and `ef_search`, only those that are set.
+    """
+    search_params = {
+        "nprobe": _getenv_int("KNOWLEDGE_INDEX_NPROBE"),
+        "ef_search": _getenv_int("KNOWLEDGE_INDEX_EF_SEARCH"),
+    }
+
+    return {name: value for name, value in search_params.items() if value}
+
+
+def build_search_index(
+    vectors: np.ndarray, config: IndexConfig
+) -> tuple[faiss.Index, IndexConfig]:
+    """Build and train a search index over vectors.
+
+    Vectors are added in order, so position i of the index holds vectors[i].
+    Falls back to a simpler index type if there are too few vectors to train on.
+
+    Args:
+        vectors (np.ndarray): float32 matrix of vectors.
+        config (IndexConfig): Type and parameters of the index.
+
+    Returns:
+        tuple[faiss.Index, IndexConfig]: The search index and the config it was built with.
+    """
+    ntotal, dimension = vectors.shape
+    index_type = config.index_type
+
+    nlist = config.nlist or max(1, int(4 * math.sqrt(ntotal)))
+    # Keep enough training vectors per list for k-means.
+    nlist = max(1, min(nlist, ntotal // _MIN_TRAINING_POINTS_PER_CENTROID))
+
+    if index_type == IVF_PQ and (
+        dimension % config.pq_m != 0
+        or ntotal < _MIN_TRAINING_POINTS_PER_CENTROID * 2**config.pq_nbits
+    ):
+        logger.warning("Can't train an IVF-PQ index on these vectors, using IVF-Flat")
+        index_type = IVF_FLAT
+
+    if index_type in (IVF_FLAT, IVF_PQ) and ntotal < _MIN_TRAINING_POINTS_PER_CENTROID:
+        logger.warning("Too few vectors to train an IVF index, using a flat index")
+        index_type = FLAT
+
+    if index_type == FLAT:
+        index = faiss.IndexFlatL2(dimension)
+    elif index_type == HNSW:
+        index = faiss.IndexHNSWFlat(dimension, config.hnsw_m)
+        index.hnsw.efConstruction = config.ef_construction
+    elif index_type == IVF_FLAT:
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, nlist)
+    else:
+        index = faiss.IndexIVFPQ(
+            faiss.IndexFlatL2(dimension),
+            dimension,
+            nlist,
+            config.pq_m,
+            config.pq_nbits,
+        )
+
+    if not index.is_trained:
+        index.train(vectors)
+
+    index.add(vectors)
+
+    config = replace(config, index_type=index_type, nlist=nlist)
+    apply_search_params(index, config)
+
+    return index, config
+
+
+def apply_search_params(index: faiss.Index, config: IndexConfig):
+    """Set the search time parameters of an index.
+
+    Args:
+        index (faiss.Index): The search index.
+        config (IndexConfig): Parameters to apply.
+    """
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = config.ef_search
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = config.nprobe
@@ -0,0 +1,191 @@
+import json
+import math
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+
+# Number of indexed texts and term ids by term.
+LEXICAL_VOCABULARY_FILE_NAME = "lexical_vocabulary.json"
+# Start offset of every term's postings plus the end offset of the last one.
+LEXICAL_OFFSETS_FILE_NAME = "lexical_offsets.npy"
+# Chunk position of every posting, grouped by term.
+LEXICAL_POSITIONS_FILE_NAME = "lexical_positions.npy"
+# BM25 score of every posting, grouped by term.
+LEXICAL_SCORES_FILE_NAME = "lexical_scores.npy"
+
+# BM25 term frequency saturation.
+BM25_K1 = 1.2
+# BM25 document length normalization.
+BM25_B = 0.75
+
+# Tokens kept whole, e.g. "hba1c", "sglt2", "mg/dl" and "5.7".
+_TOKEN_PATTERN = re.compile(r"\w+(?:[./-]\w+)*")
+
+_STOP_WORDS = frozenset(
+    """
+    a about an and any are as at be been but by can could do does for from had
+    has have how i if in into is it its may me might my no not of on or our
+    should so such than that the their them then there these they this to
+    was we were what when where which who why will with would you your
+    """.split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Split a text into lower cased terms, leaving out stop words.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list[str]: The terms.
+    """
+    return [
+        token
+        for token in _TOKEN_PATTERN.findall(text.lower())
+        if token not in _STOP_WORDS
+    ]
+
+
+def build_lexical_index(texts: Iterable[str], build_path: Path):
+    """Write the BM25 inverted index of texts.
+
+    The BM25 score of every term in every text is computed up front, so a
+    search only adds up the scores of the query terms.
+
+    Args:
+        texts (Iterable[str]): Texts in the order of the vector index.
+        build_path (Path): Directory of the serving index build.
+    """
+    term_ids: dict[str, int] = {}
+    postings: list[list[tuple[int, int]]] = []
+    lengths = []
+
+    for position, text in enumerate(texts):
+        terms = tokenize(text)
+        lengths.append(len(terms))
+
+        for term, frequency in Counter(terms).items():
+            if term not in term_ids:
+                term_ids[term] = len(postings)
+                postings.append([])
+
+            postings[term_ids[term]].append((position, frequency))
+
+    ntotal = len(lengths)
+    average_length = (sum(lengths) / ntotal if ntotal else 0) or 1.0
+
+    offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(term_postings) for term_postings in postings])
+    positions = np.empty(offsets[-1], dtype=np.int32)
+    scores = np.empty(offsets[-1], dtype=np.float32)
+
+    for term_id, term_postings in enumerate(postings):
+        frequency_in_texts = len(term_postings)
+        idf = math.log(
+            1 + (ntotal - frequency_in_texts + 0.5) / (frequency_in_texts + 0.5)
+        )
+        start = offsets[term_id]
+
+        for index, (position, frequency) in enumerate(term_postings):
+            normalization = BM25_K1 * (
+                1 - BM25_B + BM25_B * lengths[position] / average_length
+            )
+            positions[start + index] = position
+            scores[start + index] = (
+                idf * frequency * (BM25_K1 + 1) / (frequency + normalization)
+            )
+
+    (build_path / LEXICAL_VOCABULARY_FILE_NAME).write_text(
+        json.dumps({"ntotal": ntotal, "term_ids": term_ids})
+    )
+    np.save(build_path / LEXICAL_OFFSETS_FILE_NAME, offsets)
+    np.save(build_path / LEXICAL_POSITIONS_FILE_NAME, positions)
+    np.save(build_path / LEXICAL_SCORES_FILE_NAME, scores)
+
+
+class LexicalIndex:
+    """Memory-mapped BM25 inverted index over the chunks of a serving build."""
+
+    def __init__(self, build_path: Path):
+        """Initialize the lexical index.
+
+        Args:
+            build_path (Path): Directory of the serving index build.
+        """
+        vocabulary = json.loads((build_path / LEXICAL_VOCABULARY_FILE_NAME).read_text())
+        self.ntotal: int = vocabulary["ntotal"]
+        self.term_ids: dict[str, int] = vocabulary["term_ids"]
+        self.offsets = np.load(build_path / LEXICAL_OFFSETS_FILE_NAME, mmap_mode="r")
+        self.positions = np.load(
+            build_path / LEXICAL_POSITIONS_FILE_NAME, mmap_mode="r"
+        )
+        self.scores = np.load(build_path / LEXICAL_SCORES_FILE_NAME, mmap_mode="r")
+
+    @classmethod
+    def load(cls, build_path: Path) -> Optional["LexicalIndex"]:
+        """Load the lexical index of a serving build.
+
+        Args:
+            build_path (Path): Directory of the serving index build.
+
+        Returns:
+            Optional[LexicalIndex]: The lexical index or None if the build has none.
+        """
+        if not (build_path / LEXICAL_VOCABULARY_FILE_NAME).exists():
+            return None
+
+        return cls(build_path)
+
+    def document_frequency(self, term: str) -> int:
+        """Count the chunks a term occurs in.
+
+        Args:
+            term (str): The term.
+
+        Returns:
+            int: Number of chunks containing the term.
+        """
+        term_id = self.term_ids.get(term)
+
+        if term_id is None:
+            return 0
+
+        return int(self.offsets[term_id + 1] - self.offsets[term_id])
+
+    def search(self, query: str, k: int) -> list[tuple[int, float]]:
+        """Search the chunks by BM25 score.
+
+        Args:
+            query (str): The query.
+            k (int): Maximum number of chunks to return.
+
+        Returns:
+            list[tuple[int, float]]: Position and score of the best chunks,
+                best first.
+        """
+        slices = [
+            slice(self.offsets[term_id], self.offsets[term_id + 1])
+            for term_id in (self.term_ids.get(term) for term in set(tokenize(query)))
+            if term_id is not None
+        ]
+
+        if not slices:
+            return []
+
+        # Add up the scores of every chunk over the query terms.
+        positions, inverse = np.unique(
+            np.concatenate([self.positions[postings] for postings in slices]),
+            return_inverse=True,
+        )
+        scores = np.bincount(
+            inverse,
+            weights=np.concatenate([self.scores[postings] for postings in slices]),
+        )
+
+        best = np.argsort(-scores, kind="stable")[:k]
+
+        return list(zip(positions[best].tolist(), scores[best].tolist()))
@@ -0,0 +1,372 @@
+import asyncio
+import hashlib
+import json
+import logging
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import faiss
+import numpy as np
+from app.constants import KNOWLEDGE_BASE_PATH, RAW_DATA_PATH
+from app.ingest.chunks import CHUNK_STORE_FILE_NAME, ChunkStore
+from app.ingest.embeddings import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_MAX_CONCURRENCY,
+    BatchEmbedder,
+    create_embeddings,
+)
+from app.ingest.index import IndexConfig
+from app.ingest.store import export_serving_index
+from langchain_community.document_loaders import UnstructuredPDFLoader
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# LangChain FAISS index, pickled docstore and manifest written by earlier versions.
+LEGACY_INDEX_FILE_NAME = "index.faiss"
+LEGACY_DOCSTORE_FILE_NAME = "index.pkl"
+LEGACY_MANIFEST_FILE_NAME = "manifest.json"
+LEGACY_INDEX_FILE_NAMES = (
+    LEGACY_INDEX_FILE_NAME,
+    LEGACY_DOCSTORE_FILE_NAME,
+    LEGACY_MANIFEST_FILE_NAME,
+)
+
+
+@dataclass
+class IngestResult:
+    """Summary of an ingest run."""
+
+    added: list[str] = field(default_factory=list)
+    updated: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    unchanged: list[str] = field(default_factory=list)
+    failed: list[str] = field(default_factory=list)
+
+
+def hash_file(path: Path) -> str:
+    """Compute the SHA-256 hash of a file's content.
+
+    Args:
+        path (Path): Path of the file.
+
+    Returns:
+        str: Hex digest of the content.
+    """
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def parse_pdf(path: str) -> list[Document]:
+    """Parse a PDF and split it into chunks.
+
+    Runs in a worker process, so it must stay a module level function.
+
+    Args:
+        path (str): Path of the PDF.
+
+    Returns:
+        list[Document]: Chunks of the PDF.
+    """
+    loaded_documents = UnstructuredPDFLoader(
+        path, infer_table_structure=True, strategy="hi_res"
+    ).load()
+
+    return RecursiveCharacterTextSplitter().split_documents(loaded_documents)
+
+
+def ingest(
+    raw_data_path: Path = RAW_DATA_PATH,
+    index_path: Path = KNOWLEDGE_BASE_PATH,
+    embeddings: Optional[Embeddings] = None,
+    max_workers: Optional[int] = None,
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+    index_config: Optional[IndexConfig] = None,
+) -> IngestResult:
+    """Bring the knowledge index up to date with the source PDFs.
+
+    Blocking version of `aingest`.
+    """
+    return asyncio.run(
+        aingest(
+            raw_data_path,
+            index_path,
+            embeddings,
+            max_workers,
+            batch_size,
+            max_concurrency,
+            index_config,
+        )
+    )
+
+
+async def aingest(
+    raw_data_path: Path = RAW_DATA_PATH,
+    index_path: Path = KNOWLEDGE_BASE_PATH,
+    embeddings: Optional[Embeddings] = None,
+    max_workers: Optional[int] = None,
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+    index_config: Optional[IndexConfig] = None,
+) -> IngestResult:
+    """Bring the knowledge index up to date with the source PDFs.
+
+    Only new or changed PDFs are parsed, chunked and embedded, the chunks of
+    changed or deleted PDFs are removed. PDFs are parsed in a process pool while
+    the chunks of already parsed PDFs are embedded in concurrent batches.
+
+    Chunks and vectors are kept in a SQLite chunk store, committed one PDF at a
+    time, and embedded batches are kept in the embedding cache, so a failed run
+    resumes where it stopped. The memory-mapped serving index of the configured
+    type is then exported from the chunk store.
+
+    Args:
+        raw_data_path (Path): Directory of the source PDFs.
+        index_path (Path): Directory of the index.
+        embeddings (Optional[Embeddings]): Embeddings used for the index.
+        max_workers (Optional[int]): Number of parsing processes, CPU count if None.
+        batch_size (int): Number of chunks per embedding request.
+        max_concurrency (int): Maximum number of concurrent embedding requests.
+        index_config (Optional[IndexConfig]): Type and parameters of the search index,
+            read from the environment if None.
+
+    Returns:
+        IngestResult: Summary of the ingest run.
+    """
+    embeddings = embeddings or create_embeddings()
+    result = IngestResult()
+
+    if not (index_path / CHUNK_STORE_FILE_NAME).exists() and any(
+        (index_path / name).exists() for name in LEGACY_INDEX_FILE_NAMES
+    ):
+        if not any(raw_data_path.glob("**/*.pdf")):
+            # The pickled index is kept, it is the only copy of the chunks.
+            raise FileNotFoundError(
+                f"{index_path} holds an index written by an earlier version and "
+                f"there are no PDFs in {raw_data_path} to rebuild it from. Convert "
+                "it with `python -m app.ingest --convert-legacy-index`."
+            )
+
+        # Loading it would mean unpickling it, rebuild it from the PDFs instead.
+        # Already embedded chunks are still served by the embedding cache.
+        logger.warning(
+            "Rebuilding the pickled index at %s from the PDFs in %s",
+            index_path,
+            raw_data_path,
+        )
+
+    chunk_store = ChunkStore(index_path / CHUNK_STORE_FILE_NAME)
+
+    try:
+        await _ingest_sources(
+            chunk_store,
+            raw_data_path,
+            embeddings,
+            max_workers,
+            batch_size,
+            max_concurrency,
+            result,
+        )
+
+        if not chunk_store.count():
+            raise FileNotFoundError(f"No PDFs could be ingested from {raw_data_path}")
+
+        export_serving_index(
+            chunk_store, index_path, index_config or IndexConfig.from_env()
+        )
+    finally:
+        chunk_store.close()
+
+    for name in LEGACY_INDEX_FILE_NAMES:
+        (index_path / name).unlink(missing_ok=True)
+
+    return result
+
+
+def convert_legacy_index(
+    index_path: Path = KNOWLEDGE_BASE_PATH,
+    raw_data_path: Path = RAW_DATA_PATH,
+    index_config: Optional[IndexConfig] = None,
+) -> int:
+    """Convert the pickled index written by earlier versions into a chunk store.
+
+    A one-off upgrade step for deployments without the source PDFs, the chunks
+    and vectors are copied as they are and the serving index is exported. The
+    docstore is unpickled, which can run arbitrary code, so only convert an
+    index you trust.
+
+    Args:
+        index_path (Path): Directory of the index.
+        raw_data_path (Path): Directory of the source PDFs, the chunk sources
+            are stored relative to it.
+        index_config (Optional[IndexConfig]): Type and parameters of the search index,
+            read from the environment if None.
+
+    Raises:
+        FileExistsError: The index already has a chunk store.
+        FileNotFoundError: The index has no pickled index to convert.
+
+    Returns:
+        int: Number of chunks converted.
+    """
+    if (index_path / CHUNK_STORE_FILE_NAME).exists():
+        raise FileExistsError(f"{index_path} already has a chunk store")
+
+    if not (index_path / LEGACY_INDEX_FILE_NAME).exists() or not (
+        (index_path / LEGACY_DOCSTORE_FILE_NAME).exists()
+    ):
+        raise FileNotFoundError(f"{index_path} has no pickled index to convert")
+
+    index = faiss.read_index(str(index_path / LEGACY_INDEX_FILE_NAME))
+
+    with open(index_path / LEGACY_DOCSTORE_FILE_NAME, "rb") as file:
+        docstore, index_to_docstore_id = pickle.load(file)
+
+    # Source file and content hash by chunk id, from the manifest if there is one.
+    sources_by_id: dict[str, str] = {}
+    source_hashes: dict[str, str] = {}
+    manifest_path = index_path / LEGACY_MANIFEST_FILE_NAME
+
+    if manifest_path.exists():
+        for source, entry in json.loads(manifest_path.read_text())["sources"].items():
+            source_hashes[source] = entry["sha256"]
+            sources_by_id.update((chunk_id, source) for chunk_id in entry["ids"])
+
+    vectors = index.reconstruct_n(0, index.ntotal)
+    chunks: dict[str, tuple[list[Document], list[np.ndarray]]] = {}
+
+    for position, chunk_id in sorted(index_to_docstore_id.items()):
+        document = docstore.search(chunk_id)
+        source = sources_by_id.get(chunk_id) or _get_legacy_source(
+            document, raw_data_path
+        )
+        documents, source_vectors = chunks.setdefault(source, ([], []))
+        documents.append(document)
+        source_vectors.append(vectors[position])
+
+    chunk_store = ChunkStore(index_path / CHUNK_STORE_FILE_NAME)
+
+    try:
+        for source, (documents, source_vectors) in chunks.items():
+            path = raw_data_path / source
+            # An unknown hash has the PDF ingested again once it is added.
+            sha256 = source_hashes.get(source) or (
+                hash_file(path) if path.is_file() else ""
+            )
+            chunk_store.replace_source(source, sha256, documents, source_vectors)
+
+        export_serving_index(
+            chunk_store, index_path, index_config or IndexConfig.from_env()
+        )
+    finally:
+        chunk_store.close()
+
+    for name in LEGACY_INDEX_FILE_NAMES:
+        (index_path / name).unlink(missing_ok=True)
+
+    return len(index_to_docstore_id)
+
+
+def _get_legacy_source(document: Document, raw_data_path: Path) -> str:
+    """Get the source file of a chunk of a legacy index without a manifest.
+
+    Returns:
+        str: Source file, relative to the raw data directory when it is in it.
+    """
+    source = Path(document.metadata.get("source", "unknown"))
+
+    for base in (raw_data_path, raw_data_path.resolve()):
+        if source.is_relative_to(base):
+            return source.relative_to(base).as_posix()
+
+    return source.as_posix()
+
+
+async def _ingest_sources(
+    chunk_store: ChunkStore,
+    raw_data_path: Path,
+    embeddings: Embeddings,
+    max_workers: Optional[int],
+    batch_size: int,
+    max_concurrency: int,
+    result: IngestResult,
+):
+    ingested_hashes = chunk_store.get_source_hashes()
+    current_hashes = {
+        path.relative_to(raw_data_path).as_posix(): hash_file(path)
+        for path in sorted(raw_data_path.glob("**/*.pdf"))
+    }
+
+    for source, sha256 in ingested_hashes.items():
+        if source not in current_hashes:
+            result.removed.append(source)
+            chunk_store.delete_source(source)
+        elif sha256 != current_hashes[source]:
+            result.updated.append(source)
+        else:
+            result.unchanged.append(source)
+
+    result.added = [
+        source for source in current_hashes if source not in ingested_hashes
+    ]
+    pending = [*result.updated, *result.added]
+
+    if not pending:
+        return
+
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor, tqdm(
+        total=0, desc="Embedding chunks", unit="chunk"
+    ) as progress:
+        embedder = BatchEmbedder(
+            embeddings, batch_size, max_concurrency, progress=progress
+        )
+
+        async def parse_and_embed(source: str):
+            documents = await loop.run_in_executor(
+                executor, parse_pdf, str(raw_data_path / source)
+            )
+
+            progress.total += len(documents)
+            progress.refresh()
+
+            vectors = await embedder.aembed(
+                [document.page_content for document in documents]
+            )
+
+            return documents, vectors
+
+        tasks = {
+            asyncio.ensure_future(parse_and_embed(source)): source for source in pending
+        }
+
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                source = tasks.pop(task)
+
+                try:
+                    documents, vectors = task.result()
+                except Exception:
+                    # An updated PDF keeps its previous chunks until it ingests.
+                    logger.exception("Failed to ingest %s", source)
+                    result.failed.append(source)
+                    continue
+
+                chunk_store.replace_source(
+                    source, current_hashes[source], documents, vectors
+                )
@@ -0,0 +1,306 @@
+import json
+import logging
+import mmap
+import shutil
+from collections.abc import Mapping
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+from typing import Iterator, Optional, Union
+from uuid import uuid4
+
+import faiss
+import numpy as np
+from app.ingest.chunks import ChunkStore
+from app.ingest.index import FLAT, IndexConfig, apply_search_params, build_search_index
+from app.ingest.lexical import LexicalIndex, build_lexical_index
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Directory of the serving index builds, next to the ingested index.
+SERVING_DIR_NAME = "serving"
+# File holding the name of the serving index build in use.
+CURRENT_FILE_NAME = "CURRENT"
+
+META_FILE_NAME = "meta.json"
+# Vectors of a flat index, as a .npy matrix.
+VECTORS_FILE_NAME = "vectors.npy"
+# Any other index type, as a FAISS index.
+INDEX_FILE_NAME = "index.faiss"
+# JSON records of the chunks, back to back.
+CHUNKS_FILE_NAME = "chunks.bin"
+# Start offset of every chunk record plus the end offset of the last one.
+CHUNK_OFFSETS_FILE_NAME = "chunk_offsets.npy"
+
+
+@dataclass
+class ServingIndexMeta:
+    """Description of a serving index build."""
+
+    config: IndexConfig
+    dimension: int
+    ntotal: int
+
+
+class MmapDocstore(Docstore):
+    """Read-only docstore over a memory-mapped chunk file.
+
+    Chunks are looked up by their position in the vector index, only the
+    requested records are decoded.
+    """
+
+    def __init__(self, chunks_path: Path, offsets_path: Path):
+        """Initialize the docstore.
+
+        Args:
+            chunks_path (Path): Path of the chunk records.
+            offsets_path (Path): Path of the chunk record offsets.
+        """
+        self.build_path = chunks_path.parent
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+
+        with open(chunks_path, "rb") as file:
+            # An empty file can't be mapped.
+            self.chunks = (
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                if chunks_path.stat().st_size
+                else b""
+            )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def search(self, search: Union[int, str]) -> Union[str, Document]:
+        """Get a chunk by its position in the vector index.
+
+        Args:
+            search (Union[int, str]): Position of the chunk.
+
+        Returns:
+            Union[str, Document]: The chunk or a message if it wasn't found.
+        """
+        position = int(search)
+
+        if not 0 <= position < len(self):
+            return f"ID {search} not found."
+
+        start, end = self.offsets[position], self.offsets[position + 1]
+        record = json.loads(self.chunks[start:end])
+
+        return Document(
+            page_content=record["page_content"], metadata=record["metadata"]
+        )
+
+
+class PositionIds(Mapping):
+    """Maps vector positions to docstore ids, which are the positions themselves."""
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def __getitem__(self, position: int) -> int:
+        if not 0 <= position < self.size:
+            raise KeyError(position)
+
+        return position
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self.size))
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class MmapFlatIndex:
+    """Exact search over a memory-mapped vector matrix.
+
+    Implements the part of the FAISS index interface used by the FAISS vector
+    store. The vectors are paged in by the OS and shared by every process
+    mapping the file.
+    """
+
+    def __init__(self, vectors_path: Path):
+        """Initialize the index.
+
+        Args:
+            vectors_path (Path): Path of the .npy vector matrix.
+        """
+        self.vectors = np.load(vectors_path, mmap_mode="r")
+        self.ntotal, self.d = self.vectors.shape
+
+    def search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        if self.ntotal == 0:
+            return (
+                np.full((len(queries), k), np.inf, dtype=np.float32),
+                np.full((len(queries), k), -1, dtype=np.int64),
+            )
+
+        distances, positions = faiss.knn(queries, self.vectors, min(k, self.ntotal))
+
+        if k > self.ntotal:
+            # Pad like a FAISS index does when there are fewer than k vectors.
+            padding = ((0, 0), (0, k - self.ntotal))
+            distances = np.pad(distances, padding, constant_values=np.inf)
+            positions = np.pad(positions, padding, constant_values=-1)
+
+        return distances, positions
+
+    def reconstruct(self, position: int) -> np.ndarray:
+        return np.array(self.vectors[position])
+
+
+def export_serving_index(
+    chunk_store: ChunkStore, index_path: Path, config: IndexConfig
+):
+    """Write the serving index of the ingested chunks.
+
+    Chunks and vectors are streamed from the chunk store into the build files.
+    The build is written to its own directory and then made current, so
+    processes that still map the previous build keep working.
+
+    Args:
+        chunk_store (ChunkStore): The ingested chunks.
+        index_path (Path): Directory of the ingested index.
+        config (IndexConfig): Type and parameters of the search index.
+    """
+    serving_path = index_path / SERVING_DIR_NAME
+    build_name = uuid4().hex
+    build_path = serving_path / build_name
+    build_path.mkdir(parents=True)
+
+    ntotal = chunk_store.count()
+    dimension = chunk_store.dimension() or 0
+
+    vectors_path = build_path / VECTORS_FILE_NAME
+    vectors = np.lib.format.open_memmap(
+        vectors_path, mode="w+", dtype=np.float32, shape=(ntotal, dimension)
+    )
+    offsets = np.lib.format.open_memmap(
+        build_path / CHUNK_OFFSETS_FILE_NAME,
+        mode="w+",
+        dtype=np.int64,
+        shape=(ntotal + 1,),
+    )
+    offsets[0] = 0
+
+    with open(build_path / CHUNKS_FILE_NAME, "wb") as file:
+        for position, (document, vector) in enumerate(chunk_store.iter_chunks()):
+            record = json.dumps(
+                {"page_content": document.page_content, "metadata": document.metadata},
+                default=str,
+            ).encode()
+            file.write(record)
+
+            vectors[position] = vector
+            offsets[position + 1] = offsets[position] + len(record)
+
+    vectors.flush()
+    offsets.flush()
+
+    build_lexical_index(chunk_store.iter_texts(), build_path)
+
+    if config.index_type == FLAT or ntotal == 0:
+        config = IndexConfig(index_type=FLAT)
+    else:
+        logger.info(
+            "Building %s search index over %d vectors", config.index_type, ntotal
+        )
+        search_index, config = build_search_index(np.asarray(vectors), config)
+        faiss.write_index(search_index, str(build_path / INDEX_FILE_NAME))
+
+        # The search index holds its own copy of the vectors.
+        del vectors
+        vectors_path.unlink()
+
+    meta = ServingIndexMeta(config=config, dimension=dimension, ntotal=ntotal)
+    (build_path / META_FILE_NAME).write_text(json.dumps(asdict(meta), indent=2))
+
+    # Switch to the new build atomically.
+    current_path = serving_path / CURRENT_FILE_NAME
+    temporary_path = current_path.with_suffix(".tmp")
+    temporary_path.write_text(build_name)
+    temporary_path.replace(current_path)
+
+    # Open files of previous builds stay readable until they are unmapped.
+    for path in serving_path.iterdir():
+        if path.is_dir() and path.name != build_name:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def get_serving_index_path(index_path: Path) -> Optional[Path]:
+    """Get the directory of the current serving index build.
+
+    Args:
+        index_path (Path): Directory of the ingested index.
+
+    Returns:
+        Optional[Path]: The build directory or None if there is no build.
+    """
+    current_path = index_path / SERVING_DIR_NAME / CURRENT_FILE_NAME
+
+    if not current_path.exists():
+        return None
+
+    return index_path / SERVING_DIR_NAME / current_path.read_text().strip()
+
+
+def load_serving_index(
+    index_path: Path,
+    embeddings: Embeddings,
+    search_params: Optional[dict[str, int]] = None,
+) -> Optional[FAISS]:
+    """Load the current serving index, memory-mapped and read-only.
+
+    Args:
+        index_path (Path): Directory of the ingested index.
+        embeddings (Embeddings): Embeddings used for queries.
+        search_params (Optional[dict[str, int]]): Search parameters overriding
+            the ones saved with the build, e.g. `{"nprobe": 32}`.
+
+    Returns:
+        Optional[FAISS]: The vector store or None if there is no serving index.
+    """
+    build_path = get_serving_index_path(index_path)
+
+    if build_path is None:
+        return None
+
+    meta = json.loads((build_path / META_FILE_NAME).read_text())
+    meta = ServingIndexMeta(**{**meta, "config": IndexConfig(**meta["config"])})
+
+    if meta.config.index_type == FLAT:
+        index = MmapFlatIndex(build_path / VECTORS_FILE_NAME)
+    else:
+        # Inverted lists are mapped from the file, other index data is read in.
+        index = faiss.read_index(
+            str(build_path / INDEX_FILE_NAME),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+        )
+        apply_search_params(index, replace(meta.config, **(search_params or {})))
+
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=MmapDocstore(
+            build_path / CHUNKS_FILE_NAME, build_path / CHUNK_OFFSETS_FILE_NAME
+        ),
+        index_to_docstore_id=PositionIds(meta.ntotal),
+    )
+
+
+def load_lexical_index(vector_db: FAISS) -> Optional[LexicalIndex]:
+    """Load the lexical index of the serving build a vector store was loaded from.
+
+    Args:
+        vector_db (FAISS): The serving vector store.
+
+    Returns:
+        Optional[LexicalIndex]: The lexical index or None if the build has none.
+    """
+    if not isinstance(vector_db.docstore, MmapDocstore):
+        return None
+
+    return LexicalIndex.load(vector_db.docstore.build_path)
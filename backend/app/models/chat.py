@@ -1,8 +1,10 @@
 from datetime import datetime
+from typing import Literal, Optional
 from uuid import uuid4
 
+from bson import ObjectId
 from langchain_core.messages import BaseMessage
-from pydantic import Field
+from pydantic import BaseModel, Field
 
 
 class ChatMessage(BaseMessage):
@@ -25,3 +27,77 @@ class ChatMessage(BaseMessage):
         # Set the message_id and timestamp
         self.message_id = existing_id or self.message_id
         self.timestamp = existing_timestamp or self.timestamp
+
+
+class ToolStep(BaseModel):
+    """ToolStep class to describe an intermediate agent tool call.
+
+    Args:
+        BaseModel (_type_): Base model class.
+    """
+
+    step_id: str
+    tool: str
+    status: Literal["start", "end"]
+    input: Optional[str] = None
+    output: Optional[str] = None
+
+
+class ChatSummary(BaseModel):
+    """ChatSummary class to store the rolling summary of a conversation.
+
+    Args:
+        BaseModel (_type_): Base model class.
+    """
+
+    summary: str = ""
+    summarized_until: Optional[datetime] = None
+
+
+class ChatHistoryCursor(BaseModel):
+    """ChatHistoryCursor class to page backwards through a chat history.
+
+    Messages are ordered by timestamp and then by document id, as several
+    messages can share a millisecond. The next page holds the messages before
+    the cursor.
+
+    Args:
+        BaseModel (_type_): Base model class.
+    """
+
+    timestamp: datetime
+    # Hex document id of the message at the cursor, None for timestamp-only cursors.
+    document_id: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.document_id is None:
+            return self.timestamp.isoformat()
+
+        return f"{self.timestamp.isoformat()}_{self.document_id}"
+
+    @classmethod
+    def parse(cls, value: str) -> "ChatHistoryCursor":
+        """Parse a cursor, or a timestamp, sent back by a client.
+
+        Timestamps with an offset are converted to naive local time, like the
+        stored ones, which are set with `datetime.now()`.
+
+        Args:
+            value (str): `<ISO timestamp>_<document id>` or an ISO timestamp.
+
+        Raises:
+            ValueError: The cursor is malformed.
+
+        Returns:
+            ChatHistoryCursor: The cursor.
+        """
+        timestamp, _, document_id = value.partition("_")
+        parsed_timestamp = datetime.fromisoformat(timestamp)
+
+        if parsed_timestamp.tzinfo is not None:
+            parsed_timestamp = parsed_timestamp.astimezone().replace(tzinfo=None)
+
+        if document_id and not ObjectId.is_valid(document_id):
+            raise ValueError(f'Invalid document id "{document_id}"')
+
+        return cls(timestamp=parsed_timestamp, document_id=document_id or None)
@@ -1,21 +1,43 @@
-from typing import List
+import logging
+from datetime import datetime
+from typing import List, Optional
+from uuid import uuid4
 
 from app.dependencies.database import get_database
+from app.models.chat import ChatHistoryCursor, ChatSummary
+from app.repositories.chat_writer import chat_message_writer
+from app.utils.tracing import span
+from bson import ObjectId
 from fastapi import Depends
 from langchain_core.messages import messages_from_dict
 from langchain_core.messages.base import BaseMessage, message_to_dict
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Users whose legacy history document has already been migrated by this process.
+_migrated_user_ids: set[str] = set()
+# Set once every legacy history document is migrated, users aren't checked anymore.
+_legacy_messages_migrated = False
+_indexes_created = False
 
 
 class ChatRepository:
     def __init__(self, db: AsyncIOMotorDatabase = Depends(get_database)):
         """Initialize chat repository.
 
+        Messages are stored one document per message and read back newest first
+        through the (user_id, timestamp) index.
+
         Args:
             db (MongoDB): MongoDB instance.
         """
         self.db = db
-        self.message_collection = self.db["chat_message_history_collection"]
+        self.message_collection = self.db["chat_messages"]
+        # Previous layout, a single document holding every message of the user.
+        self.legacy_message_collection = self.db["chat_message_history_collection"]
+        self.summary_collection = self.db["chat_summaries"]
 
     async def add_messages(
         self, user_id: str, messages: List[BaseMessage]
@@ -32,38 +54,137 @@ class ChatRepository:
         Returns:
             List[BaseMessage]: List of chat messages.
         """
-        result = await self.message_collection.update_one(
-            {"user_id": user_id},
-            {
-                "$push": {
-                    "messages": {
-                        "$each": [message_to_dict(message) for message in messages],
-                    }
-                }
-            },
-            upsert=True,
-        )
+        await self._prepare(user_id)
+
+        with span("mongo.add_messages"):
+            result = await self.message_collection.insert_many(
+                [self._to_document(user_id, message) for message in messages],
+                ordered=True,
+            )
 
         if not result.acknowledged:
             raise Exception("Failed to add messages to the user")
 
         return messages
 
-    async def get_messages_by_user_id(self, user_id: str) -> List[BaseMessage] | None:
+    async def enqueue_messages(
+        self, user_id: str, messages: List[BaseMessage]
+    ) -> List[BaseMessage]:
+        """Queue chat messages to be added to the user in the background.
+
+        The messages are written in batches with those of other chat turns and
+        read back with the user's history until then.
+
+        Args:
+            user_id (str): ID of the user.
+            messages (List[BaseMessage]): List of chat messages.
+
+        Returns:
+            List[BaseMessage]: List of chat messages.
+        """
+        await self._prepare(user_id)
+        await chat_message_writer.enqueue(
+            self.message_collection,
+            [self._to_document(user_id, message) for message in messages],
+        )
+
+        return messages
+
+    async def get_messages_by_user_id(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        before: Optional[ChatHistoryCursor] = None,
+    ) -> List[BaseMessage] | None:
         """Get chat messages of the user.
 
         Args:
             user_id (str): ID of the user.
+            limit (Optional[int]): Maximum number of latest messages to return, all if None.
+            before (Optional[ChatHistoryCursor]): Only return messages before
+                this cursor.
 
         Returns:
-            List[BaseMessage] | None: List of chat messages or None if user has no messages.
+            List[BaseMessage] | None: List of chat messages in chronological order
+                or None if user has no messages.
         """
-        user_messages = await self.message_collection.find_one({"user_id": user_id})
+        messages, _ = await self.get_messages_page(user_id, limit, before)
+        return messages or None
 
-        if not user_messages:
-            return None
+    async def get_messages_page(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        before: Optional[ChatHistoryCursor] = None,
+    ) -> tuple[List[BaseMessage], Optional[ChatHistoryCursor]]:
+        """Get a page of chat messages of the user, latest first.
+
+        Args:
+            user_id (str): ID of the user.
+            limit (Optional[int]): Maximum number of latest messages to return, all if None.
+            before (Optional[ChatHistoryCursor]): Only return messages before
+                this cursor.
+
+        Returns:
+            tuple[List[BaseMessage], Optional[ChatHistoryCursor]]: List of chat
+                messages in chronological order and, if the page is full, the
+                cursor of the previous page.
+        """
+        await self._prepare(user_id)
+
+        query: dict = {"user_id": user_id}
+
+        if before is not None and before.document_id is None:
+            query["timestamp"] = {"$lt": before.timestamp}
+        elif before is not None:
+            # Messages can share a millisecond, the document id breaks the tie.
+            query["$or"] = [
+                {"timestamp": {"$lt": before.timestamp}},
+                {
+                    "timestamp": before.timestamp,
+                    "_id": {"$lt": ObjectId(before.document_id)},
+                },
+            ]
+
+        cursor = self.message_collection.find(
+            query, {"_id": 1, "message_id": 1, "timestamp": 1, "message": 1}
+        ).sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        with span("mongo.get_messages"):
+            documents = await cursor.to_list(length=None)
+
+        # Messages queued by this process may not be written yet, or only just.
+        stored_message_ids = {document.get("message_id") for document in documents}
+        pending_documents = [
+            document
+            for document in chat_message_writer.get_pending(user_id)
+            if document["message_id"] not in stored_message_ids
+            and (before is None or self._is_before(document, before))
+        ]
 
-        return messages_from_dict(user_messages.get("messages", []))
+        if pending_documents:
+            documents = sorted(
+                [*pending_documents, *documents],
+                key=lambda document: (document["timestamp"], document["_id"]),
+                reverse=True,
+            )[:limit]
+
+        next_cursor = None
+
+        if documents and limit is not None and len(documents) == limit:
+            next_cursor = ChatHistoryCursor(
+                timestamp=documents[-1]["timestamp"],
+                document_id=str(documents[-1]["_id"]),
+            )
+
+        messages = messages_from_dict(
+            [document["message"] for document in reversed(documents)]
+        )
+
+        return messages, next_cursor
 
     async def delete_messages_by_user_id(self, user_id: str):
         """Delete chat messages of the user.
@@ -71,4 +192,176 @@ class ChatRepository:
         Args:
             user_id (str): ID of the user.
         """
-        await self.message_collection.delete_one({"user_id": user_id})
+        # Queued messages would otherwise be written after the deletion.
+        await chat_message_writer.flush()
+        await self.message_collection.delete_many({"user_id": user_id})
+        await self.legacy_message_collection.delete_one({"user_id": user_id})
+        await self.summary_collection.delete_one({"user_id": user_id})
+
+    async def get_summary_by_user_id(self, user_id: str) -> ChatSummary | None:
+        """Get the conversation summary of the user.
+
+        Args:
+            user_id (str): ID of the user.
+
+        Returns:
+            ChatSummary | None: Conversation summary or None if there is none yet.
+        """
+        with span("mongo.get_summary"):
+            summary = await self.summary_collection.find_one(
+                {"user_id": user_id}, {"_id": 0, "user_id": 0}
+            )
+
+        if not summary:
+            return None
+
+        return ChatSummary(**summary)
+
+    async def save_summary(self, user_id: str, summary: ChatSummary) -> ChatSummary:
+        """Save the conversation summary of the user.
+
+        Args:
+            user_id (str): ID of the user.
+            summary (ChatSummary): Conversation summary.
+
+        Raises:
+            Exception: Failed to save the summary.
+
+        Returns:
+            ChatSummary: Conversation summary.
+        """
+        result = await self.summary_collection.update_one(
+            {"user_id": user_id}, {"$set": summary.dict()}, upsert=True
+        )
+
+        if not result.acknowledged:
+            raise Exception("Failed to save the conversation summary")
+
+        return summary
+
+    async def create_indexes(self):
+        """Create the indexes used to page through the history of a user.
+
+        The unique (user_id, message_id) index also backs the upserts of the
+        message writer's retries and of the legacy migration.
+        """
+        await self.message_collection.create_index(
+            [("user_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)]
+        )
+        await self.message_collection.create_index(
+            [("user_id", ASCENDING), ("message_id", ASCENDING)], unique=True
+        )
+        await self.summary_collection.create_index("user_id", unique=True)
+
+    async def _prepare(self, user_id: str):
+        """Make sure the indexes exist and the user's history uses the current layout.
+
+        Args:
+            user_id (str): ID of the user.
+        """
+        global _indexes_created
+
+        if not _indexes_created:
+            await self.create_indexes()
+            _indexes_created = True
+
+        if not _legacy_messages_migrated and user_id not in _migrated_user_ids:
+            await self._migrate_legacy_messages(user_id)
+            _migrated_user_ids.add(user_id)
+
+    async def migrate_legacy_messages(self):
+        """Migrate the legacy history documents of every user.
+
+        Run once at startup, the histories are then read without checking for
+        a legacy document first.
+        """
+        global _legacy_messages_migrated
+
+        try:
+            for user_id in await self.legacy_message_collection.distinct("user_id"):
+                await self._prepare(user_id)
+        except Exception:
+            # Histories keep being migrated when they are read.
+            logger.exception("Failed to migrate the legacy chat histories")
+            return
+
+        _legacy_messages_migrated = True
+        _migrated_user_ids.clear()
+
+    async def _migrate_legacy_messages(self, user_id: str):
+        """Move the messages of a legacy history document to one document per message.
+
+        Args:
+            user_id (str): ID of the user.
+        """
+        legacy_document = await self.legacy_message_collection.find_one(
+            {"user_id": user_id}
+        )
+
+        if not legacy_document:
+            return
+
+        documents = [
+            self._to_document(user_id, message)
+            for message in messages_from_dict(legacy_document.get("messages", []))
+        ]
+
+        if documents:
+            # Upserts keep a migration that runs concurrently in another worker idempotent.
+            await self.message_collection.bulk_write(
+                [
+                    UpdateOne(
+                        {"user_id": user_id, "message_id": document["message_id"]},
+                        {"$setOnInsert": document},
+                        upsert=True,
+                    )
+                    for document in documents
+                ],
+                ordered=True,
+            )
+
+        await self.legacy_message_collection.delete_one({"_id": legacy_document["_id"]})
+
+    @staticmethod
+    def _is_before(document: dict, cursor: ChatHistoryCursor) -> bool:
+        """Check whether a message document comes before a cursor.
+
+        Args:
+            document (dict): Message document.
+            cursor (ChatHistoryCursor): The cursor.
+
+        Returns:
+            bool: Whether the message is on the pages after the cursor.
+        """
+        if cursor.document_id is None:
+            return document["timestamp"] < cursor.timestamp
+
+        return (document["timestamp"], document["_id"]) < (
+            cursor.timestamp,
+            ObjectId(cursor.document_id),
+        )
+
+    @staticmethod
+    def _to_document(user_id: str, message: BaseMessage) -> dict:
+        """Convert a chat message to its stored document.
+
+        Args:
+            user_id (str): ID of the user.
+            message (BaseMessage): Chat message.
+
+        Returns:
+            dict: Message document.
+        """
+        timestamp = getattr(message, "timestamp", None) or datetime.now()
+
+        return {
+            # Set here, so queued messages already have their place in the history.
+            "_id": ObjectId(),
+            "user_id": user_id,
+            "message_id": getattr(message, "message_id", None) or str(uuid4()),
+            # BSON dates keep milliseconds, queued messages are truncated alike.
+            "timestamp": timestamp.replace(
+                microsecond=timestamp.microsecond // 1000 * 1000
+            ),
+            "message": message_to_dict(message),
+        }
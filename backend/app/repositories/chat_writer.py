@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Optional
+
+from app.utils.metrics import counter, gauge, histogram
+from app.utils.tracing import span
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of messages written in one bulk write.
+CHAT_WRITE_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", 500))
+# Seconds messages wait for messages of other sessions to join their batch.
+CHAT_WRITE_BATCH_INTERVAL_SECONDS = float(
+    os.getenv("CHAT_WRITE_BATCH_INTERVAL_SECONDS", 0.05)
+)
+# Retries of a failed batch before its messages are dropped.
+CHAT_WRITE_MAX_RETRIES = int(os.getenv("CHAT_WRITE_MAX_RETRIES", 5))
+# Seconds before the first retry, doubled on every retry up to 30 seconds.
+CHAT_WRITE_RETRY_BASE_DELAY_SECONDS = float(
+    os.getenv("CHAT_WRITE_RETRY_BASE_DELAY_SECONDS", 0.5)
+)
+# Maximum number of queued messages, chat turns wait to queue theirs beyond it.
+CHAT_WRITE_QUEUE_MAX_SIZE = int(os.getenv("CHAT_WRITE_QUEUE_MAX_SIZE", 10000))
+# Seconds the server waits for the queued messages to be written on shutdown.
+CHAT_WRITE_SHUTDOWN_TIMEOUT_SECONDS = float(
+    os.getenv("CHAT_WRITE_SHUTDOWN_TIMEOUT_SECONDS", 10)
+)
+
+_MAX_RETRY_DELAY_SECONDS = 30.0
+
+CHAT_WRITE_BATCH_SIZES = histogram(
+    "diabuddy_chat_write_batch_size",
+    "Chat messages per bulk write.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+CHAT_WRITE_RETRIES = counter(
+    "diabuddy_chat_write_retries_total", "Retried bulk writes of chat messages."
+)
+CHAT_WRITE_DROPPED_MESSAGES = counter(
+    "diabuddy_chat_write_dropped_messages_total",
+    "Chat messages dropped after every retry failed.",
+)
+
+
+class ChatMessageWriter:
+    """Writes chat messages to MongoDB in the background.
+
+    Queued messages of concurrent chat turns are written together in ordered
+    bulk writes by a single worker, one batch after the other, so the messages
+    of a user are written in the order they were queued. A failed batch is
+    retried with exponential backoff, as idempotent upserts, before the next
+    batch is written.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = CHAT_WRITE_BATCH_SIZE,
+        batch_interval: float = CHAT_WRITE_BATCH_INTERVAL_SECONDS,
+        max_retries: int = CHAT_WRITE_MAX_RETRIES,
+        retry_base_delay: float = CHAT_WRITE_RETRY_BASE_DELAY_SECONDS,
+        max_size: int = CHAT_WRITE_QUEUE_MAX_SIZE,
+    ):
+        """Initialize the chat message writer.
+
+        Args:
+            batch_size (int): Maximum number of messages per bulk write.
+            batch_interval (float): Seconds to wait for more messages to batch.
+            max_retries (int): Retries of a failed batch.
+            retry_base_delay (float): Seconds before the first retry.
+            max_size (int): Maximum number of queued messages.
+        """
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.max_size = max_size
+        # Message documents and the collection they go to, in queued order.
+        self._queue: deque[tuple[AsyncIOMotorCollection, dict]] = deque()
+        self._batch: list[dict] = []
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._space = asyncio.Condition()
+        self._worker: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._queue) + len(self._batch)
+
+    def start(self):
+        """Start the background worker unless it is running."""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = CHAT_WRITE_SHUTDOWN_TIMEOUT_SECONDS):
+        """Write the queued messages and stop the background worker.
+
+        Args:
+            timeout (float): Seconds to wait for the queued messages to be written.
+        """
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            logger.error("Shutting down with %d chat messages unsaved", len(self))
+
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def enqueue(self, collection: AsyncIOMotorCollection, documents: list[dict]):
+        """Queue message documents to be written.
+
+        Waits until the documents fit in the queue. Documents that don't fit even
+        in an empty queue are queued once it is empty.
+
+        Args:
+            collection (AsyncIOMotorCollection): Collection of the documents.
+            documents (list[dict]): Message documents, in order.
+        """
+        self.start()
+
+        async with self._space:
+            await self._space.wait_for(
+                lambda: not len(self) or len(self) + len(documents) <= self.max_size
+            )
+            self._queue.extend((collection, document) for document in documents)
+
+        self._idle.clear()
+        self._wakeup.set()
+
+    async def flush(self):
+        """Wait until every queued message is written or dropped."""
+        if len(self):
+            self.start()
+            await self._idle.wait()
+
+    def get_pending(self, user_id: str) -> list[dict]:
+        """Get the queued message documents of a user.
+
+        Args:
+            user_id (str): ID of the user.
+
+        Returns:
+            list[dict]: Documents not written yet, in queued order.
+        """
+        return [
+            document
+            for document in (*self._batch, *(document for _, document in self._queue))
+            if document["user_id"] == user_id
+        ]
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+
+            # Let the messages of concurrent chat turns join the batch.
+            if len(self._queue) < self.batch_size:
+                await asyncio.sleep(self.batch_interval)
+
+            self._wakeup.clear()
+
+            while self._queue:
+                collection = self._queue[0][0]
+
+                while (
+                    self._queue
+                    and self._queue[0][0] is collection
+                    and len(self._batch) < self.batch_size
+                ):
+                    self._batch.append(self._queue.popleft()[1])
+
+                try:
+                    await self._write(collection, self._batch)
+                finally:
+                    self._batch = []
+
+                async with self._space:
+                    self._space.notify_all()
+
+            self._idle.set()
+
+    async def _write(self, collection: AsyncIOMotorCollection, documents: list[dict]):
+        """Write a batch of message documents, retrying on failure.
+
+        Args:
+            collection (AsyncIOMotorCollection): Collection of the documents.
+            documents (list[dict]): Message documents, in order.
+        """
+        CHAT_WRITE_BATCH_SIZES.observe(len(documents))
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with span("mongo.write_batch"):
+                    if attempt == 0:
+                        await collection.insert_many(documents, ordered=True)
+                    else:
+                        # Part of the batch may have been written by the last attempt.
+                        await collection.bulk_write(
+                            [
+                                UpdateOne(
+                                    {
+                                        "user_id": document["user_id"],
+                                        "message_id": document["message_id"],
+                                    },
+                                    {"$setOnInsert": document},
+                                    upsert=True,
+                                )
+                                for document in documents
+                            ],
+                            ordered=True,
+                        )
+
+                return
+            except Exception as error:
+                if attempt == self.max_retries:
+                    logger.error(
+                        "Dropping %d chat messages after %d failed writes",
+                        len(documents),
+                        attempt + 1,
+                        exc_info=error,
+                    )
+                    CHAT_WRITE_DROPPED_MESSAGES.inc(len(documents))
+                    return
+
+                delay = min(
+                    self.retry_base_delay * 2**attempt, _MAX_RETRY_DELAY_SECONDS
+                )
+                logger.warning(
+                    "Failed to write %d chat messages, retrying in %ss: %r",
+                    len(documents),
+                    delay,
+                    error,
+                )
+                CHAT_WRITE_RETRIES.inc()
+                await asyncio.sleep(delay)
+
+
+# Create the process-wide chat message writer.
+chat_message_writer = ChatMessageWriter()
+
+gauge(
+    "diabuddy_chat_write_queue_depth",
+    "Chat messages waiting to be written to MongoDB.",
+    function=lambda: len(chat_message_writer),
+)
@@ -1,13 +1,24 @@
+import asyncio
+import os
 from typing import Optional
 
 from app.dependencies.auth import get_user_manager
 from app.exceptions.common import NotFoundException
 from app.models.user import User
 from app.schemas.user import UpdateUser
+from app.utils.cache import TTLCache
+from app.utils.tracing import span
 from auth0 import Auth0Error
 from auth0.management import Users
 from fastapi import Depends
 
+# Profiles are cached per process, so an update made through another worker is
+# picked up once the cached entry expires.
+user_cache: TTLCache[str, User] = TTLCache(
+    maxsize=int(os.getenv("USER_PROFILE_CACHE_MAX_SIZE", 10000)),
+    ttl=float(os.getenv("USER_PROFILE_CACHE_TTL_SECONDS", 300)),
+)
+
 
 class UserRepository:
     def __init__(self, users: Users = Depends(get_user_manager)):
@@ -18,7 +29,7 @@ class UserRepository:
         """
         self.users = users
 
-    def get_user_by_id(self, user_id: str) -> Optional[User]:
+    async def get_user_by_id(self, user_id: str) -> Optional[User]:
         """Get a user
 
         Args:
@@ -27,21 +38,28 @@ class UserRepository:
         Returns:
             Optional[User]: The user profile or None if the user was not found
         """
+        user = user_cache.get(user_id)
+
+        if user is not None:
+            return user.copy()
+
         try:
             # Get the user data from Auth0 metadata field.
-            user_data = self.users.get(user_id, fields=["user_metadata"]).get(
-                "user_metadata", {}
-            )
-            return User(
-                id=user_id,
-                **user_data,
-            )
+            user_data = await self._get_user_metadata(user_id)
         except Auth0Error as ae:
             if ae.status_code == 404:
                 return None
             raise ae
 
-    def update_user_by_id(self, user_id: str, data: UpdateUser) -> User | None:
+        user = User(
+            id=user_id,
+            **user_data,
+        )
+        user_cache.set(user_id, user)
+
+        return user.copy()
+
+    async def update_user_by_id(self, user_id: str, data: UpdateUser) -> User | None:
         """Update a user
 
         Args:
@@ -52,31 +70,49 @@ class UserRepository:
             User | None: The updated user profile or None if the user was not found.
         """
         try:
-            user_data = self.users.get(user_id, fields=["user_metadata"]).get(
-                "user_metadata", {}
-            )
+            user_data = await self._get_user_metadata(user_id)
 
             user_data.update(data.dict(exclude_unset=True))
 
-            self.users.update(
+            await asyncio.to_thread(
+                self.users.update,
                 user_data.get("user_id", user_id),
                 {"user_metadata": user_data},
             )
-            return self.get_user_by_id(user_id)
+            user_cache.delete(user_id)
+
+            return await self.get_user_by_id(user_id)
         except Auth0Error as ae:
             if ae.status_code == 404:
                 raise NotFoundException("User not found")
             raise ae
 
-    def delete_user_by_id(self, user_id: str) -> None:
+    async def delete_user_by_id(self, user_id: str) -> None:
         """Delete a user
 
         Args:
             user_id (str): The user_id
         """
         try:
-            self.users.delete(user_id)
+            await asyncio.to_thread(self.users.delete, user_id)
         except Auth0Error as ae:
             if ae.status_code == 404:
                 raise NotFoundException("User not found")
             raise ae
+        finally:
+            user_cache.delete(user_id)
+
+    async def _get_user_metadata(self, user_id: str) -> dict:
+        """Get the Auth0 metadata of a user without blocking the event loop.
+
+        Args:
+            user_id (str): The user_id
+
+        Returns:
+            dict: The user metadata
+        """
+        with span("auth0.get_user"):
+            user = await asyncio.to_thread(
+                self.users.get, user_id, fields=["user_metadata"]
+            )
+        return user.get("user_metadata", {})
@@ -1,52 +1,117 @@
-from typing import cast
+import os
+from typing import AsyncIterator, Optional, cast
 
 from app.dependencies.auth import get_token_verifier
-from app.models.chat import ChatMessage
+from app.dependencies.resources import get_agent_executor
+from app.exceptions.common import NotFoundException, ResourceNotReadyException
+from app.models.chat import ChatHistoryCursor, ChatMessage, ToolStep
 from app.schemas.chat import ChatQuery
 from app.services.chat import ChatService
-from app.utils.sse import format_sse_event
-from fastapi import APIRouter, Depends, HTTPException, Security
+from app.services.chat_streams import (
+    find_chat_stream,
+    format_event_id,
+    get_chat_stream_buffer,
+    start_chat_stream,
+)
+from app.utils.sse import ChunkCoalescer, format_sse_event, with_flush_deadlines
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Response,
+    Security,
+    status,
+)
 from fastapi.responses import StreamingResponse
 
+# Maximum number of messages returned in a chat history page.
+MAX_CHAT_HISTORY_PAGE_SIZE = 100
+# Milliseconds clients wait before reconnecting to a dropped chat stream.
+CHAT_STREAM_RETRY_MILLISECONDS = int(os.getenv("CHAT_STREAM_RETRY_MILLISECONDS", 1000))
+
 router = APIRouter()
 
 token_verifier = get_token_verifier()
 
 
-@router.post("/me/chat/stream", response_class=StreamingResponse)
-def stream_chat(
+@router.post(
+    "/me/chat/stream",
+    response_class=StreamingResponse,
+    # Responds with 503 until the knowledge index and agent are loaded.
+    dependencies=[Depends(get_agent_executor)],
+)
+async def stream_chat(
     query: ChatQuery,
+    last_event_id: Optional[str] = Header(None),
     authenticated_user_id: str = Security(token_verifier.verify),
     chat_service: ChatService = Depends(ChatService),
 ):
-    """Streams a chat session between a user and the AI using Server-Sent Events (SSE)."""
+    """Streams a chat session between a user and the AI using Server-Sent Events (SSE).
+
+    The answer is generated in the background. A client that lost the stream can
+    send the same request with the `Last-Event-ID` header to receive the events
+    it missed and follow the answer still being generated, the query is ignored.
+    """
 
-    async def event_stream():
+    async def generate_events() -> AsyncIterator[tuple[str, Optional[dict]]]:
         try:
             user_message = ChatMessage(content=query.query, type="human")
             ai_message = ChatMessage(content="Thinking...", type="ai")
 
             # Stream the user message.
-            yield format_sse_event("user_message", user_message.dict())
+            yield "user_message", user_message.dict()
             # Stream the AI response started event.
-            yield format_sse_event("ai_response_start", ai_message.dict())
+            yield "ai_response_start", ai_message.dict()
+
+            # Collect the AI response content, joining chunks that arrive together.
+            chunks = ChunkCoalescer()
+
+            def chunk_event(chunk: str) -> tuple[str, Optional[dict]]:
+                return "ai_message_chunk", {
+                    "message_id": ai_message.message_id,
+                    "chunk": chunk,
+                }
+
+            async for chunk in with_flush_deadlines(
+                chat_service.stream_ai_response(
+                    authenticated_user_id,
+                    query.query,
+                    query.include_tool_steps,
+                    query.bypass_cache,
+                ),
+                chunks,
+            ):
+                if chunk is None:
+                    # Stream the chunks held back for the whole flush interval.
+                    if (held_back := chunks.flush()) is not None:
+                        yield chunk_event(held_back)
 
-            # Reset the AI response content.
-            ai_message.content = ""
+                    continue
 
-            async for chunk in chat_service.stream_ai_response(
-                authenticated_user_id, query.query
-            ):
-                # Update the AI response content.
-                ai_message.content += chunk
-                # Stream the AI response chunk.
-                yield format_sse_event(
-                    "ai_message_chunk",
-                    {"message_id": ai_message.message_id, "chunk": chunk},
-                )
+                if isinstance(chunk, ToolStep):
+                    # Stream the chunks held back before the intermediate tool step.
+                    if (held_back := chunks.flush()) is not None:
+                        yield chunk_event(held_back)
 
-            # save the user message and AI response to the chat history.
-            await chat_service.add_messages(
+                    # Stream the intermediate tool step.
+                    yield "tool_step", chunk.dict()
+                    continue
+
+                # Stream the AI response chunk, unless it is held back.
+                if (chunk := chunks.add(chunk)) is not None:
+                    yield chunk_event(chunk)
+
+            # Stream the last chunks held back.
+            if (held_back := chunks.flush()) is not None:
+                yield chunk_event(held_back)
+
+            ai_message.content = chunks.content
+
+            # Queue the user message and AI response to be saved to the chat
+            # history, the response ends without waiting for the write.
+            await chat_service.enqueue_messages(
                 authenticated_user_id,
                 [
                     user_message,
@@ -54,33 +119,82 @@ def stream_chat(
                 ],
             )
 
-            yield format_sse_event("ai_response_end")
+            yield "ai_response_end", None
         except Exception:
-            yield format_sse_event(
-                "error", {"message": "Failed to stream chat response."}
+            yield "error", {"message": "Failed to stream chat response."}
+
+    async def event_stream(stream_id: str, after: int):
+        retry = CHAT_STREAM_RETRY_MILLISECONDS
+
+        try:
+            async for event in get_chat_stream_buffer().subscribe(stream_id, after):
+                yield format_sse_event(
+                    event.event,
+                    event.data,
+                    event_id=format_event_id(stream_id, event.sequence),
+                    retry=retry,
+                )
+                # Clients keep the reconnection time, it is only sent once.
+                retry = None
+        except NotFoundException:
+            yield format_sse_event("error", {"message": "Chat stream expired."})
+
+    if last_event_id is None:
+        try:
+            stream_id = await start_chat_stream(
+                authenticated_user_id, generate_events()
+            )
+        except ResourceNotReadyException as rnre:
+            # The server is shutting down, the client retries on another one.
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=rnre.message
+            )
+        after = 0
+    else:
+        try:
+            stream_id, after = await find_chat_stream(
+                authenticated_user_id, last_event_id
             )
+        except NotFoundException as nfe:
+            raise HTTPException(status_code=404, detail=nfe.message)
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    return StreamingResponse(
+        event_stream(stream_id, after), media_type="text/event-stream"
+    )
 
 
 @router.get("/me/chat", response_model=list[ChatMessage])
 async def get_chat_history_for_authenticated_user(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_CHAT_HISTORY_PAGE_SIZE),
+    before: Optional[str] = Query(None),
     authenticated_user_id: str = Security(token_verifier.verify),
     chat_service: ChatService = Depends(ChatService),
 ) -> list[ChatMessage]:
     """Get chat history for the authenticated user.
 
+    The whole history is returned unless a page size is given. When a page is
+    full, the cursor of the previous page is set in the `X-Next-Cursor` header
+    and can be passed back as `before`. An ISO timestamp is also accepted as
+    `before`.
+
     Returns:
         list[ChatMessage]: List of chat messages.
     """
     try:
-        return (
-            cast(
-                list[ChatMessage],
-                await chat_service.get_messages(authenticated_user_id),
-            )
-            or []
+        cursor = ChatHistoryCursor.parse(before) if before is not None else None
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Invalid chat history cursor.")
+
+    try:
+        messages, next_cursor = await chat_service.get_messages_page(
+            authenticated_user_id, limit, cursor
         )
+
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = str(next_cursor)
+
+        return cast(list[ChatMessage], messages)
     except Exception:
         raise HTTPException(status_code=500, detail="Failed to fetch chat history.")
 
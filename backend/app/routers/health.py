@@ -0,0 +1,51 @@
+from typing import Optional
+
+from app.chains.answer_cache import SemanticAnswerCache, get_answer_cache
+from app.dependencies.resources import get_resource_registry
+from app.utils.resources import ResourceRegistry
+from fastapi import APIRouter, Depends, status
+from fastapi.responses import JSONResponse
+
+router = APIRouter()
+
+
+@router.get("/live")
+async def liveness():
+    """Check whether the server is up"""
+    return {"status": "ok"}
+
+
+@router.get("/ready")
+async def readiness(
+    resource_registry: ResourceRegistry = Depends(get_resource_registry),
+):
+    """Check whether the server is ready to serve chat requests"""
+    is_ready = resource_registry.is_eager_ready()
+
+    return JSONResponse(
+        status_code=(
+            status.HTTP_200_OK if is_ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+        content={
+            "status": "ready" if is_ready else "loading",
+            "resources": resource_registry.status(),
+        },
+    )
+
+
+@router.get("/answer-cache")
+async def answer_cache_stats(
+    answer_cache: Optional[SemanticAnswerCache] = Depends(get_answer_cache),
+):
+    """Get the hit rate of the answer cache"""
+    if answer_cache is None:
+        return {"enabled": False}
+
+    return {
+        "enabled": True,
+        "size": len(answer_cache),
+        "hits": answer_cache.stats.hits,
+        "misses": answer_cache.stats.misses,
+        "bypasses": answer_cache.stats.bypasses,
+        "hit_rate": answer_cache.stats.hit_rate,
+    }
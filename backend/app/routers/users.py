@@ -11,13 +11,13 @@ router = APIRouter()
 
 
 @router.get("/me", response_model=User)
-def get_authenticated_user(
+async def get_authenticated_user(
     authenticated_user_id: str = Security(token_verifier.verify),
     user_service: UserService = Depends(UserService),
 ):
     """Get the authenticated user"""
     try:
-        user = user_service.get_user(authenticated_user_id)
+        user = await user_service.get_user(authenticated_user_id)
 
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
@@ -30,14 +30,14 @@ def get_authenticated_user(
 
 
 @router.patch("/me", response_model=User)
-def update_authenticated_user(
+async def update_authenticated_user(
     data: UpdateUser,
     authenticated_user_id: str = Security(token_verifier.verify),
     user_service: UserService = Depends(UserService),
 ):
     """Update the authenticated user"""
     try:
-        user_profile = user_service.update_user(authenticated_user_id, data)
+        user_profile = await user_service.update_user(authenticated_user_id, data)
 
         if not user_profile:
             raise NotFoundException("User not found")
@@ -3,3 +3,5 @@ from openai import BaseModel
 
 class ChatQuery(BaseModel):
     query: str
+    include_tool_steps: bool = False
+    bypass_cache: bool = False
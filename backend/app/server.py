@@ -2,15 +2,64 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from app.routers import chats, users
+import asyncio
+from contextlib import asynccontextmanager
+
+from app.chains.memory import load_tokenizer
+from app.dependencies.auth import get_token_verifier
+from app.dependencies.database import get_database
+from app.dependencies.resources import get_resource_registry, knowledge_index_reloader
+from app.repositories.chat import ChatRepository
+from app.repositories.chat_writer import chat_message_writer
+from app.routers import chats, health, metrics, users
+from app.services.chat_streams import stop_chat_streams
+from app.utils.tracing import TracingMiddleware
 from fastapi import FastAPI
 from fastapi.responses import RedirectResponse
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the knowledge index and chains in the background,
+    # the server accepts requests in the meantime.
+    get_resource_registry().start()
+    # Reload the knowledge index when the ingest command exports a new build.
+    knowledge_index_reloader.start()
+    # Warm up the JWKS used to verify access tokens.
+    get_token_verifier().jwks_cache.start()
+    # Load the tokenizer in a thread, it may download its encoding. Until then,
+    # the history tokens are estimated.
+    tokenizer_loading = asyncio.create_task(asyncio.to_thread(load_tokenizer))
+    # Write the chat messages queued by chat turns in the background.
+    chat_message_writer.start()
+    # Migrate the legacy chat histories in the background, until then each
+    # history is migrated when it is first read.
+    legacy_migration = asyncio.create_task(
+        ChatRepository(await get_database()).migrate_legacy_messages()
+    )
+
+    yield
+
+    tokenizer_loading.cancel()
+    legacy_migration.cancel()
+
+    # Finish the running chat streams, their messages are queued for writing.
+    await stop_chat_streams()
+    # Write the queued chat messages before the process exits.
+    await chat_message_writer.stop()
+    await get_token_verifier().jwks_cache.stop()
+    await knowledge_index_reloader.stop()
+
+
 app = FastAPI(
     title="DiaBuddy API",
     description="API for DiaBuddy chatbot",
+    lifespan=lifespan,
 )
 
+# Times every request and logs the stage timings of sampled ones.
+app.add_middleware(TracingMiddleware)
+
 
 @app.get("/")
 async def redirect_root_to_docs():
@@ -24,6 +73,8 @@ app.include_router(
     tags=["users"],
 )
 app.include_router(chats.router, prefix="/api/users", tags=["chats"])
+app.include_router(health.router, prefix="/health", tags=["health"])
+app.include_router(metrics.router, tags=["metrics"])
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,45 +1,146 @@
-from typing import AsyncGenerator
+import asyncio
+import logging
+import os
+import time
+from typing import AsyncGenerator, Optional
 
-from app.chains.agentic import agent_executor
-from app.exceptions.common import NotFoundException
+from app.chains.agentic import AGENT_LLM_TAG
+from app.chains.answer_cache import (
+    SemanticAnswerCache,
+    get_answer_cache,
+    get_answer_scope,
+)
+from app.chains.memory import create_conversation_memory
+from app.chains.streaming import FinalAnswerStreamParser
+from app.dependencies.resources import (
+    AGENT_EXECUTOR,
+    KNOWLEDGE_RETRIEVER,
+    get_resource_registry,
+)
+from app.exceptions.common import DeadlineExceededException, NotFoundException
+from app.models.chat import ChatHistoryCursor, ToolStep
 from app.repositories.chat import ChatRepository
 from app.repositories.user import UserRepository
+from app.utils.metrics import counter, histogram
+from app.utils.resources import ResourceRegistry
+from app.utils.tracing import record_stage, set_trace_attribute, span
 from fastapi import Depends
+from langchain_core.messages import get_buffer_string
 from langchain_core.messages.base import BaseMessage
 
+logger = logging.getLogger(__name__)
+
+# Maximum number of characters of a tool output streamed to the client.
+TOOL_STEP_OUTPUT_PREVIEW_LENGTH = 1000
+# Seconds to fetch the profile, history and query embedding before the agent starts.
+CHAT_TURN_SETUP_TIMEOUT_SECONDS = float(
+    os.getenv("CHAT_TURN_SETUP_TIMEOUT_SECONDS", 10)
+)
+# Set to "true" to search the knowledge index for the raw query while the turn
+# is set up, so the agent's lookup of the same query is already cached.
+SPECULATIVE_RETRIEVAL_ENABLED = (
+    os.getenv("SPECULATIVE_RETRIEVAL_ENABLED", "false").lower() == "true"
+)
+
+# Keeps a reference to the running speculative retrievals so they aren't
+# garbage collected.
+_speculative_retrievals: set[asyncio.Task] = set()
+
+TIME_TO_FIRST_CHUNK = histogram(
+    "diabuddy_chat_time_to_first_chunk_seconds",
+    "Time from a chat query to the first chunk of its answer.",
+)
+LLM_OUTPUT_TOKENS = counter(
+    "diabuddy_llm_output_tokens_total",
+    "Tokens streamed by the agent LLM, reasoning included.",
+)
+TURN_OUTPUT_TOKENS = histogram(
+    "diabuddy_chat_turn_output_tokens",
+    "Tokens streamed by the agent LLM per chat turn.",
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096),
+)
+
 
 class ChatService:
     def __init__(
         self,
         chat_repo: ChatRepository = Depends(ChatRepository),
         user_repo: UserRepository = Depends(UserRepository),
+        resource_registry: ResourceRegistry = Depends(get_resource_registry),
+        answer_cache: Optional[SemanticAnswerCache] = Depends(get_answer_cache),
     ):
         """Initialize chat service.
 
         Args:
             chat_repo (ChatRepository): Chat repository instance.
+            user_repo (UserRepository): User repository instance.
+            resource_registry (ResourceRegistry): Registry holding the agent executor.
+            answer_cache (Optional[SemanticAnswerCache]): Cache of answers to
+                similar queries, None if disabled.
         """
         self.chat_repo = chat_repo
         self.user_repo = user_repo
-        self.rag_agent_executor = agent_executor
+        self.resource_registry = resource_registry
+        self.answer_cache = answer_cache
+        self.memory = create_conversation_memory(chat_repo)
 
     async def stream_ai_response(
-        self, user_id: str, query: str
-    ) -> AsyncGenerator[str, None]:
+        self,
+        user_id: str,
+        query: str,
+        include_tool_steps: bool = False,
+        bypass_cache: bool = False,
+    ) -> AsyncGenerator[str | ToolStep, None]:
         """Streams AI response for given query for a user.
 
+        The profile, the history and the query embedding are fetched concurrently
+        within a shared deadline. Final answer tokens are yielded as soon as the
+        LLM emits them. The answer to a similar query of a user with the same
+        profile scope is reused for queries without chat history, the only
+        ones whose answers are cached.
+
         Args:
             user_id (str): ID of the user.
             query (str): Query to send to AI.
+            include_tool_steps (bool): Whether to also yield intermediate tool steps.
+            bypass_cache (bool): Whether to skip the answer cache lookup.
 
         Returns:
-            AsyncGenerator[str, None]: AI response stream.
+            AsyncGenerator[str | ToolStep, None]: AI response stream.
 
         Yields:
-            Iterator[AsyncGenerator[str, None]]: AI response.
+            Iterator[AsyncGenerator[str | ToolStep, None]]: AI response chunk or tool step.
         """
+        turn_started_at = time.perf_counter()
+
+        # Raises ResourceNotReadyException while the index is still loading.
+        rag_agent_executor = self.resource_registry.get(AGENT_EXECUTOR)
+
+        if SPECULATIVE_RETRIEVAL_ENABLED:
+            self._start_speculative_retrieval(query)
 
-        user = self.user_repo.get_user_by_id(user_id)
+        # Get the profile, the chat history that fits the memory token budget and,
+        # if there is no history, the query embedding for the answer cache.
+        user_task = asyncio.create_task(self.user_repo.get_user_by_id(user_id))
+        chat_history_task = asyncio.create_task(self.memory.load(user_id))
+        tasks = [user_task, chat_history_task]
+
+        if self.answer_cache is not None and not bypass_cache:
+            tasks.append(
+                asyncio.create_task(self._embed_query(query, chat_history_task))
+            )
+
+        try:
+            async with asyncio.timeout(CHAT_TURN_SETUP_TIMEOUT_SECONDS):
+                user, chat_history, *query_vectors = await asyncio.gather(*tasks)
+        except TimeoutError:
+            raise DeadlineExceededException(
+                f"Chat turn setup took longer than {CHAT_TURN_SETUP_TIMEOUT_SECONDS}s"
+            )
+        finally:
+            # Stops the other fetches when one fails or the deadline passes.
+            for task in tasks:
+                task.cancel()
 
         if not user:
             raise NotFoundException("User not found")
@@ -47,18 +148,181 @@ class ChatService:
         user_data = user.dict(
             include={"nickname", "age", "gender", "diabetes_type", "preferred_language"}
         )
+        user_data["chat_history"] = get_buffer_string(chat_history)
+
+        answer_scope = get_answer_scope(user)
+        query_vector = query_vectors[0] if query_vectors else None
+
+        if self.answer_cache is not None:
+            if bypass_cache:
+                self.answer_cache.record_bypass()
+                set_trace_attribute("answer_cache", "bypass")
 
-        # Get chat history.
-        user_data["chat_history"] = await self.get_messages(user_id) or []
+            if chat_history and not bypass_cache:
+                set_trace_attribute("answer_cache", "skip")
+
+            if query_vector is not None:
+                cached_answer = self.answer_cache.lookup(
+                    answer_scope, query_vector, user.nickname
+                )
+                set_trace_attribute("answer_cache", "hit" if cached_answer else "miss")
+
+                if cached_answer:
+                    TIME_TO_FIRST_CHUNK.observe(time.perf_counter() - turn_started_at)
+                    yield cached_answer
+                    return
+
+        final_answer_parser = FinalAnswerStreamParser()
+        has_streamed_answer = False
+        answer_chunks = []
+        # Start time of the running LLM calls and tools, by run id.
+        step_started_at: dict[str, float] = {}
+        # Streamed chunks, a token each.
+        output_tokens = 0
+        llm_calls = 0
+        tool_calls = 0
 
         # Stream AI message chunks.
-        async for chunk in self.rag_agent_executor.astream(
-            {"input": query, **user_data}
+        async for event in rag_agent_executor.astream_events(
+            {"input": query, **user_data}, version="v1"
         ):
-            ai_response = chunk.get("output")
+            kind = event["event"]
+
+            if AGENT_LLM_TAG in event.get("tags", []):
+                if kind == "on_chat_model_start":
+                    # Each agent step is a new generation.
+                    final_answer_parser.reset()
+                    step_started_at[event["run_id"]] = time.perf_counter()
+                elif kind == "on_chat_model_stream":
+                    output_tokens += 1
+                    ai_response = final_answer_parser.feed(
+                        event["data"]["chunk"].content
+                    )
+
+                    if ai_response:
+                        if not has_streamed_answer:
+                            TIME_TO_FIRST_CHUNK.observe(
+                                time.perf_counter() - turn_started_at
+                            )
+
+                        has_streamed_answer = True
+                        answer_chunks.append(ai_response)
+                        yield ai_response
+                elif kind == "on_chat_model_end":
+                    llm_calls += 1
+                    self._record_step("agent.llm", step_started_at, event)
+            elif kind in ("on_tool_start", "on_tool_end"):
+                if kind == "on_tool_start":
+                    step_started_at[event["run_id"]] = time.perf_counter()
+                else:
+                    tool_calls += 1
+                    self._record_step(f"tool.{event['name']}", step_started_at, event)
+
+                if include_tool_steps:
+                    yield self._to_tool_step(event)
+            elif kind == "on_chain_end" and event["name"] == "AgentExecutor":
+                # Fall back to the final output if no answer tokens were streamed,
+                # e.g. when the agent stopped early or failed to parse the LLM output.
+                ai_response = (event["data"].get("output") or {}).get("output")
+
+                if ai_response and not has_streamed_answer:
+                    TIME_TO_FIRST_CHUNK.observe(time.perf_counter() - turn_started_at)
+                    yield ai_response
+
+        LLM_OUTPUT_TOKENS.inc(output_tokens)
+        TURN_OUTPUT_TOKENS.observe(output_tokens)
+        set_trace_attribute("output_tokens", output_tokens)
+        set_trace_attribute("llm_calls", llm_calls)
+        set_trace_attribute("tool_calls", tool_calls)
+
+        # Fallback outputs aren't final answers, they aren't reused.
+        if query_vector is not None and answer_chunks:
+            self.answer_cache.store(
+                answer_scope,
+                query_vector,
+                "".join(answer_chunks),
+                user.nickname,
+                user.age,
+            )
+
+    async def _embed_query(
+        self, query: str, chat_history_task: asyncio.Task
+    ) -> Optional[list[float]]:
+        """Embed a query for the answer cache if the chat history is empty.
+
+        Answers given with a history may repeat what the user told, they are
+        neither cached nor looked up.
+
+        Args:
+            query (str): The query.
+            chat_history_task (asyncio.Task): Task loading the chat history.
+
+        Returns:
+            Optional[list[float]]: The query vector or None if the history isn't
+                empty or embedding failed.
+        """
+        if await chat_history_task:
+            return None
+
+        try:
+            with span("answer_cache.embed"):
+                return await self.answer_cache.embed(query)
+        except Exception:
+            logger.exception("Failed to embed the query for the answer cache")
+            return None
+
+    def _start_speculative_retrieval(self, query: str):
+        """Search the knowledge index for a query in the background.
 
-            if ai_response != None:
-                yield ai_response
+        The documents land in the knowledge retriever's cache, and a lookup of the
+        same query by the agent joins the search if it is still running.
+
+        Args:
+            query (str): The query.
+        """
+        knowledge_retriever = self.resource_registry.get(KNOWLEDGE_RETRIEVER)
+        task = asyncio.create_task(knowledge_retriever.ainvoke(query))
+        _speculative_retrievals.add(task)
+        task.add_done_callback(_on_speculative_retrieval_done)
+
+    @staticmethod
+    def _record_step(stage: str, step_started_at: dict[str, float], event: dict):
+        """Record the duration of an LLM call or tool that just ended.
+
+        Args:
+            stage (str): Name of the stage.
+            step_started_at (dict[str, float]): Start time of the running steps,
+                by run id.
+            event (dict): End event emitted by the agent executor.
+        """
+        started_at = step_started_at.pop(event["run_id"], None)
+
+        if started_at is not None:
+            record_stage(stage, started_at)
+
+    @staticmethod
+    def _to_tool_step(event: dict) -> ToolStep:
+        """Convert a tool start / end event to a tool step.
+
+        Args:
+            event (dict): Tool event emitted by the agent executor.
+
+        Returns:
+            ToolStep: Tool step.
+        """
+        data = event.get("data", {})
+        output = data.get("output")
+
+        return ToolStep(
+            step_id=event["run_id"],
+            tool=event["name"],
+            status="start" if event["event"] == "on_tool_start" else "end",
+            input=str(data["input"]) if "input" in data else None,
+            # Retrieved documents can be large, only a preview is streamed.
+            output=str(output)[:TOOL_STEP_OUTPUT_PREVIEW_LENGTH]
+            if output is not None
+            else None,
+        )
 
     async def add_messages(
         self, user_id: str, messages: list[BaseMessage]
@@ -74,16 +338,39 @@ class ChatService:
         """
         return await self.chat_repo.add_messages(user_id, messages)
 
-    async def get_messages(self, user_id: str) -> list[BaseMessage] | None:
-        """Get chat messages of the user.
+    async def enqueue_messages(
+        self, user_id: str, messages: list[BaseMessage]
+    ) -> list[BaseMessage]:
+        """Queue chat messages to be added for the user in the background.
 
         Args:
             user_id (str): ID of the user.
+            messages (List[BaseMessage]): List of chat messages.
 
         Returns:
-            List[BaseMessage] | None: List of chat messages or None if user has no messages.
+            List[BaseMessage]: List of chat messages.
         """
-        return await self.chat_repo.get_messages_by_user_id(user_id)
+        return await self.chat_repo.enqueue_messages(user_id, messages)
+
+    async def get_messages_page(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        before: Optional[ChatHistoryCursor] = None,
+    ) -> tuple[list[BaseMessage], Optional[ChatHistoryCursor]]:
+        """Get a page of chat messages of the user, latest first.
+
+        Args:
+            user_id (str): ID of the user.
+            limit (Optional[int]): Maximum number of latest messages to return, all if None.
+            before (Optional[ChatHistoryCursor]): Only return messages before
+                this cursor.
+
+        Returns:
+            tuple[list[BaseMessage], Optional[ChatHistoryCursor]]: List of chat
+                messages and, if the page is full, the cursor of the previous page.
+        """
+        return await self.chat_repo.get_messages_page(user_id, limit, before)
 
     async def delete_messages(self, user_id: str):
         """Delete chat messages of the user.
@@ -92,3 +379,10 @@ class ChatService:
             user_id (str): ID of the user.
         """
         await self.chat_repo.delete_messages_by_user_id(user_id)
+
+
+def _on_speculative_retrieval_done(task: asyncio.Task):
+    _speculative_retrievals.discard(task)
+
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Speculative retrieval failed: %r", task.exception())
@@ -0,0 +1,379 @@
+import asyncio
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import AsyncIterator, Optional
+from uuid import uuid4
+
+from app.exceptions.common import NotFoundException, ResourceNotReadyException
+from app.utils.metrics import counter, gauge
+from app.utils.tracing import background_trace
+
+logger = logging.getLogger(__name__)
+
+# Where chat stream events are kept for replay, "memory" keeps them in the process.
+CHAT_STREAM_BUFFER = os.getenv("CHAT_STREAM_BUFFER", "memory")
+# Seconds a finished chat stream can still be replayed.
+CHAT_STREAM_TTL_SECONDS = float(os.getenv("CHAT_STREAM_TTL_SECONDS", 300))
+# Maximum number of events kept per chat stream, the oldest are dropped first.
+CHAT_STREAM_MAX_EVENTS = int(os.getenv("CHAT_STREAM_MAX_EVENTS", 5000))
+# Maximum number of finished chat streams kept per process, oldest dropped first.
+CHAT_STREAM_MAX_STREAMS = int(os.getenv("CHAT_STREAM_MAX_STREAMS", 1000))
+# Seconds running generations may take to finish on shutdown before being cancelled.
+CHAT_STREAM_SHUTDOWN_TIMEOUT_SECONDS = float(
+    os.getenv("CHAT_STREAM_SHUTDOWN_TIMEOUT_SECONDS", 20)
+)
+
+# Generations of chat streams, referenced until they finish.
+_generations: set[asyncio.Task] = set()
+# Set on shutdown, no new chat streams are started afterwards.
+_stopping = False
+
+CHAT_STREAM_RESUMES = counter(
+    "diabuddy_chat_stream_resumes_total",
+    "Chat streams resumed by reconnecting clients.",
+)
+
+
+@dataclass
+class ChatStreamEvent:
+    """Event of a chat stream, numbered from 1 in the order it was sent."""
+
+    sequence: int
+    event: str
+    data: Optional[dict] = None
+
+
+class ChatStreamBuffer(ABC):
+    """Keeps the events of chat streams for clients to replay and follow."""
+
+    @abstractmethod
+    async def create(self, stream_id: str, user_id: str):
+        """Create a chat stream.
+
+        Args:
+            stream_id (str): ID of the stream.
+            user_id (str): ID of the user the stream belongs to.
+        """
+
+    @abstractmethod
+    async def append(self, stream_id: str, event: str, data: Optional[dict] = None):
+        """Append an event to a running chat stream.
+
+        Args:
+            stream_id (str): ID of the stream.
+            event (str): Name of the event.
+            data (Optional[dict]): Data of the event.
+        """
+
+    @abstractmethod
+    async def close(self, stream_id: str):
+        """Mark a chat stream as finished.
+
+        Args:
+            stream_id (str): ID of the stream.
+        """
+
+    @abstractmethod
+    async def get_user_id(self, stream_id: str) -> Optional[str]:
+        """Get the user a chat stream belongs to.
+
+        Args:
+            stream_id (str): ID of the stream.
+
+        Returns:
+            Optional[str]: ID of the user or None if the stream is unknown or expired.
+        """
+
+    @abstractmethod
+    def subscribe(
+        self, stream_id: str, after: int = 0
+    ) -> AsyncIterator[ChatStreamEvent]:
+        """Replay the events of a chat stream and follow it until it finishes.
+
+        Args:
+            stream_id (str): ID of the stream.
+            after (int): Sequence of the last event received, 0 for every event.
+
+        Raises:
+            NotFoundException: The stream is unknown or expired, or the events
+                after `after` were dropped.
+
+        Returns:
+            AsyncIterator[ChatStreamEvent]: The events after `after`, in order.
+        """
+
+
+class _BufferedChatStream:
+    def __init__(self, user_id: str, max_events: int):
+        self.user_id = user_id
+        self.events: deque[ChatStreamEvent] = deque(maxlen=max_events)
+        self.last_sequence = 0
+        self.closed_at: Optional[float] = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        # Wake up the subscribers waiting for the next change.
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class InMemoryChatStreamBuffer(ChatStreamBuffer):
+    """Keeps the events of chat streams in the process.
+
+    A reconnecting client must reach the same process, e.g. with sticky sessions.
+    Finished streams are kept for `ttl` seconds, running streams are never
+    dropped.
+    """
+
+    def __init__(
+        self,
+        ttl: float = CHAT_STREAM_TTL_SECONDS,
+        max_events: int = CHAT_STREAM_MAX_EVENTS,
+        max_streams: int = CHAT_STREAM_MAX_STREAMS,
+    ):
+        """Initialize the in-memory chat stream buffer.
+
+        Args:
+            ttl (float): Seconds a finished stream is kept.
+            max_events (int): Maximum number of events kept per stream.
+            max_streams (int): Maximum number of finished streams kept.
+        """
+        self.ttl = ttl
+        self.max_events = max_events
+        self.max_streams = max_streams
+        self._streams: dict[str, _BufferedChatStream] = {}
+        # Finished streams, in the order they finished.
+        self._closed_stream_ids: OrderedDict[str, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    async def create(self, stream_id: str, user_id: str):
+        self._expire()
+        self._streams[stream_id] = _BufferedChatStream(user_id, self.max_events)
+
+    async def append(self, stream_id: str, event: str, data: Optional[dict] = None):
+        stream = self._streams[stream_id]
+        stream.last_sequence += 1
+        stream.events.append(ChatStreamEvent(stream.last_sequence, event, data))
+        stream.notify()
+
+    async def close(self, stream_id: str):
+        stream = self._streams.get(stream_id)
+
+        if stream is None or stream.closed_at is not None:
+            return
+
+        stream.closed_at = time.monotonic()
+        stream.notify()
+        self._closed_stream_ids[stream_id] = None
+
+    async def get_user_id(self, stream_id: str) -> Optional[str]:
+        stream = self._get(stream_id)
+        return stream.user_id if stream is not None else None
+
+    async def subscribe(
+        self, stream_id: str, after: int = 0
+    ) -> AsyncIterator[ChatStreamEvent]:
+        stream = self._get(stream_id)
+
+        if stream is None:
+            raise NotFoundException("Chat stream not found")
+
+        while True:
+            changed = stream.changed
+
+            if stream.events and stream.events[0].sequence > after + 1:
+                raise NotFoundException("Chat stream events were dropped")
+
+            # Copied, the stream grows while the events are sent.
+            for event in [event for event in stream.events if event.sequence > after]:
+                yield event
+                after = event.sequence
+
+            if after >= stream.last_sequence:
+                if stream.closed_at is not None:
+                    return
+
+                await changed.wait()
+
+    def _get(self, stream_id: str) -> Optional[_BufferedChatStream]:
+        stream = self._streams.get(stream_id)
+
+        if stream is None or self._is_expired(stream):
+            return None
+
+        return stream
+
+    def _is_expired(self, stream: _BufferedChatStream) -> bool:
+        return (
+            stream.closed_at is not None
+            and stream.closed_at + self.ttl <= time.monotonic()
+        )
+
+    def _expire(self):
+        """Drop the expired streams and the oldest finished ones past the limit."""
+        while self._closed_stream_ids:
+            stream_id = next(iter(self._closed_stream_ids))
+
+            if len(self._closed_stream_ids) < self.max_streams and not (
+                self._is_expired(self._streams[stream_id])
+            ):
+                break
+
+            del self._closed_stream_ids[stream_id]
+            del self._streams[stream_id]
+
+
+@lru_cache()
+def get_chat_stream_buffer() -> ChatStreamBuffer:
+    """Get the process-wide chat stream buffer set by `CHAT_STREAM_BUFFER`.
+
+    Raises:
+        ValueError: The buffer is unknown.
+
+    Returns:
+        ChatStreamBuffer: The chat stream buffer.
+    """
+    if CHAT_STREAM_BUFFER == "memory":
+        buffer = InMemoryChatStreamBuffer()
+        gauge(
+            "diabuddy_chat_streams",
+            "Chat streams kept in the process, running or replayable.",
+            function=lambda: len(buffer),
+        )
+        return buffer
+
+    raise ValueError(f'Unknown chat stream buffer "{CHAT_STREAM_BUFFER}"')
+
+
+def format_event_id(stream_id: str, sequence: int) -> str:
+    """Format the SSE event id of a chat stream event.
+
+    Args:
+        stream_id (str): ID of the stream.
+        sequence (int): Sequence of the event.
+
+    Returns:
+        str: The event id, sent back by reconnecting clients as `Last-Event-ID`.
+    """
+    return f"{stream_id}:{sequence}"
+
+
+async def find_chat_stream(user_id: str, last_event_id: str) -> tuple[str, int]:
+    """Find the chat stream to resume from the last event a client received.
+
+    Args:
+        user_id (str): ID of the user.
+        last_event_id (str): The `Last-Event-ID` sent by the client.
+
+    Raises:
+        NotFoundException: The stream is unknown, expired or of another user.
+
+    Returns:
+        tuple[str, int]: ID of the stream and sequence of the last event received.
+    """
+    stream_id, _, sequence = last_event_id.rpartition(":")
+
+    if (
+        not sequence.isdigit()
+        or await get_chat_stream_buffer().get_user_id(stream_id) != user_id
+    ):
+        raise NotFoundException("Chat stream not found")
+
+    CHAT_STREAM_RESUMES.inc()
+
+    return stream_id, int(sequence)
+
+
+async def start_chat_stream(
+    user_id: str, events: AsyncIterator[tuple[str, Optional[dict]]]
+) -> str:
+    """Generate the events of a chat stream in the background.
+
+    The generation keeps running when the client disconnects, its events are
+    kept in the chat stream buffer for the client to replay.
+
+    Args:
+        user_id (str): ID of the user the stream belongs to.
+        events (AsyncIterator[tuple[str, Optional[dict]]]): Names and data of
+            the events.
+
+    Raises:
+        ResourceNotReadyException: The server is shutting down.
+
+    Returns:
+        str: ID of the stream.
+    """
+    if _stopping:
+        raise ResourceNotReadyException("Server is shutting down")
+
+    buffer = get_chat_stream_buffer()
+    stream_id = uuid4().hex
+    await buffer.create(stream_id, user_id)
+
+    task = asyncio.create_task(_generate(buffer, stream_id, events))
+    _generations.add(task)
+    task.add_done_callback(_on_generation_done)
+
+    return stream_id
+
+
+async def _generate(
+    buffer: ChatStreamBuffer,
+    stream_id: str,
+    events: AsyncIterator[tuple[str, Optional[dict]]],
+):
+    # The request trace is logged before the generation ends.
+    with background_trace("chat stream generation"):
+        try:
+            async for event, data in events:
+                await buffer.append(stream_id, event, data)
+        except asyncio.CancelledError:
+            await buffer.append(
+                stream_id, "error", {"message": "Chat stream interrupted by shutdown."}
+            )
+            raise
+        finally:
+            await buffer.close(stream_id)
+
+
+def _on_generation_done(task: asyncio.Task):
+    _generations.discard(task)
+
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Chat stream generation failed: %r", task.exception())
+
+
+async def stop_chat_streams(timeout: float = CHAT_STREAM_SHUTDOWN_TIMEOUT_SECONDS):
+    """Stop starting chat streams and wait for the running generations.
+
+    Generations still running after the timeout are cancelled, their streams
+    end with an error event.
+
+    Args:
+        timeout (float): Seconds to wait for the running generations.
+    """
+    global _stopping
+    _stopping = True
+
+    if not _generations:
+        return
+
+    _, pending = await asyncio.wait(set(_generations), timeout=timeout)
+
+    if pending:
+        logger.warning(
+            "Cancelling %d chat stream generations still running on shutdown",
+            len(pending),
+        )
+
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -22,7 +22,7 @@ class UserService:
         self.user_repo = user_repo
         self.chat_repo = chat_repo
 
-    def get_user(self, user_id: str) -> Optional[User]:
+    async def get_user(self, user_id: str) -> Optional[User]:
         """Get a user
 
         Args:
@@ -31,9 +31,9 @@ class UserService:
         Returns:
             Optional[User]: The user profile or None if the user was not found
         """
-        return self.user_repo.get_user_by_id(user_id)
+        return await self.user_repo.get_user_by_id(user_id)
 
-    def update_user(self, user_id: str, data: UpdateUser) -> User | None:
+    async def update_user(self, user_id: str, data: UpdateUser) -> User | None:
         """Update a user
 
         Args:
@@ -43,7 +43,7 @@ class UserService:
         Returns:
             User | None: The updated user profile or None if the user was not found.
         """
-        return self.user_repo.update_user_by_id(user_id, data)
+        return await self.user_repo.update_user_by_id(user_id, data)
 
     async def delete_user(self, user_id: str) -> None:
         """Delete a user
@@ -55,7 +55,7 @@ class UserService:
             async with await self.chat_repo.db.client.start_session() as session:
                 async with session.start_transaction():
                     await self.chat_repo.delete_messages_by_user_id(user_id)
-                    self.user_repo.delete_user_by_id(user_id)
+                    await self.user_repo.delete_user_by_id(user_id)
                     await session.commit_transaction()
         except Exception as e:
             await session.abort_transaction()
@@ -0,0 +1,352 @@
+import bisect
+import math
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Optional
+
+# Set to "false" to stop recording metrics, `/metrics` then only shows
+# the metrics read at scrape time.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Bucket upper bounds in seconds, from a cache hit to a slow LLM turn.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value))
+
+
+def _format_labels(labels: Iterable[tuple[str, str]]) -> str:
+    formatted = ",".join(
+        '{}="{}"'.format(
+            name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in labels
+    )
+
+    return f"{{{formatted}}}" if formatted else ""
+
+
+class Metric(ABC):
+    """Metric exposed in the Prometheus text format."""
+
+    type: str
+
+    def __init__(self, name: str, description: str, labelnames: tuple[str, ...] = ()):
+        """Initialize the metric.
+
+        Args:
+            name (str): Name of the metric.
+            description (str): Help text of the metric.
+            labelnames (tuple[str, ...]): Names of the labels of every sample.
+        """
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _get_label_values(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}"
+            )
+
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> str:
+        """Render the metric in the Prometheus text format.
+
+        Returns:
+            str: The help, type and sample lines.
+        """
+        return "\n".join(
+            [
+                f"# HELP {self.name} {self.description}",
+                f"# TYPE {self.name} {self.type}",
+                *self.collect(),
+            ]
+        )
+
+    @abstractmethod
+    def collect(self) -> list[str]:
+        """Collect the samples of the metric.
+
+        Returns:
+            list[str]: Sample lines.
+        """
+
+
+class ValueMetric(Metric):
+    """Metric holding one value per label set."""
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labelnames: tuple[str, ...] = (),
+        function: Optional[Callable[[], float]] = None,
+    ):
+        """Initialize the metric.
+
+        Args:
+            name (str): Name of the metric.
+            description (str): Help text of the metric.
+            labelnames (tuple[str, ...]): Names of the labels of every sample.
+            function (Optional[Callable[[], float]]): Reads the value at scrape time
+                instead of keeping the recorded values.
+        """
+        super().__init__(name, description, labelnames)
+        self.function = function
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        """Increment the value.
+
+        Args:
+            amount (float): Amount to add.
+            **labels (str): Label values of the sample.
+        """
+        if not METRICS_ENABLED:
+            return
+
+        key = self._get_label_values(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> list[str]:
+        if self.function is not None:
+            return [f"{self.name} {_format_value(self.function())}"]
+
+        with self._lock:
+            values = list(self._values.items())
+
+        return [
+            f"{self.name}{_format_labels(zip(self.labelnames, key))} "
+            f"{_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Counter(ValueMetric):
+    """Monotonically increasing count."""
+
+    type = "counter"
+
+
+class Gauge(ValueMetric):
+    """Value that goes up and down."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels: str):
+        """Set the value.
+
+        Args:
+            value (float): The value.
+            **labels (str): Label values of the sample.
+        """
+        if not METRICS_ENABLED:
+            return
+
+        key = self._get_label_values(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        """Initialize the histogram.
+
+        Args:
+            name (str): Name of the metric.
+            description (str): Help text of the metric.
+            labelnames (tuple[str, ...]): Names of the labels of every sample.
+            buckets (tuple[float, ...]): Sorted upper bounds of the buckets.
+        """
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+        # Observations per bucket, the last one past every bound, and their sum.
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str):
+        """Observe a value.
+
+        Args:
+            value (float): The value.
+            **labels (str): Label values of the sample.
+        """
+        if not METRICS_ENABLED:
+            return
+
+        key = self._get_label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._counts.get(key)
+
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+
+            counts[index] += 1
+            self._sums[key] += value
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            series = [
+                (key, list(counts), self._sums[key])
+                for key, counts in self._counts.items()
+            ]
+
+        lines = []
+
+        for key, counts, total in series:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                bucket_labels = _format_labels([*labels, ("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+
+            formatted_labels = _format_labels(labels)
+            lines.append(f"{self.name}_sum{formatted_labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{formatted_labels} {cumulative}")
+
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics of the process, rendered for Prometheus scrapes."""
+
+    def __init__(self):
+        """Initialize the metrics registry."""
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Register a metric.
+
+        Args:
+            metric (Metric): The metric.
+
+        Raises:
+            ValueError: A metric with the same name is already registered.
+
+        Returns:
+            Metric: The metric.
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric "{metric.name}" is already registered')
+
+            self._metrics[metric.name] = metric
+
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format.
+
+        Returns:
+            str: The exposition text.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return "".join(f"{metric.render()}\n" for metric in metrics)
+
+
+# Create the process-wide metrics registry.
+metrics_registry = MetricsRegistry()
+
+
+def counter(
+    name: str,
+    description: str,
+    labelnames: tuple[str, ...] = (),
+    function: Optional[Callable[[], float]] = None,
+) -> Counter:
+    """Create and register a counter.
+
+    Args:
+        name (str): Name of the metric.
+        description (str): Help text of the metric.
+        labelnames (tuple[str, ...]): Names of the labels of every sample.
+        function (Optional[Callable[[], float]]): Reads the count at scrape time.
+
+    Returns:
+        Counter: The counter.
+    """
+    return metrics_registry.register(Counter(name, description, labelnames, function))
+
+
+def gauge(
+    name: str,
+    description: str,
+    labelnames: tuple[str, ...] = (),
+    function: Optional[Callable[[], float]] = None,
+) -> Gauge:
+    """Create and register a gauge.
+
+    Args:
+        name (str): Name of the metric.
+        description (str): Help text of the metric.
+        labelnames (tuple[str, ...]): Names of the labels of every sample.
+        function (Optional[Callable[[], float]]): Reads the value at scrape time.
+
+    Returns:
+        Gauge: The gauge.
+    """
+    return metrics_registry.register(Gauge(name, description, labelnames, function))
+
+
+def histogram(
+    name: str,
+    description: str,
+    labelnames: tuple[str, ...] = (),
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+) -> Histogram:
+    """Create and register a histogram.
+
+    Args:
+        name (str): Name of the metric.
+        description (str): Help text of the metric.
+        labelnames (tuple[str, ...]): Names of the labels of every sample.
+        buckets (tuple[float, ...]): Sorted upper bounds of the buckets.
+
+    Returns:
+        Histogram: The histogram.
+    """
+    return metrics_registry.register(Histogram(name, description, labelnames, buckets))
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import threading
+from typing import Any, Callable
+
+from app.exceptions.common import ResourceNotReadyException
+
+logger = logging.getLogger(__name__)
+
+# Stands in for a resource being reloaded that isn't loaded yet.
+_NOT_LOADED = object()
+
+
+class ResourceRegistry:
+    """Loads expensive process-wide resources lazily or in the background.
+
+    Loaders run in worker threads so the event loop keeps serving requests while
+    indexes are read and clients are created. A loader may load the resources it
+    depends on with `load`.
+    """
+
+    def __init__(self):
+        """Initialize the resource registry."""
+        self._loaders: dict[str, Callable[[], Any]] = {}
+        self._eager: list[str] = []
+        self._resources: dict[str, Any] = {}
+        self._errors: dict[str, Exception] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._loading: dict[str, asyncio.Future] = {}
+        # Resources being reloaded by the current thread, see `reload`.
+        self._reloading = threading.local()
+
+    def register(self, name: str, loader: Callable[[], Any], eager: bool = False):
+        """Register a resource.
+
+        Args:
+            name (str): Name of the resource.
+            loader (Callable[[], Any]): Function that creates the resource.
+            eager (bool): Whether to load the resource in the background at startup.
+        """
+        self._loaders[name] = loader
+        self._locks[name] = threading.Lock()
+
+        if eager:
+            self._eager.append(name)
+
+    def start(self):
+        """Start loading the eager resources in the background."""
+        for name in self._eager:
+            self._schedule(name)
+
+    def load(self, name: str) -> Any:
+        """Load a resource, blocking until it is ready.
+
+        Args:
+            name (str): Name of the resource.
+
+        Returns:
+            Any: The resource.
+        """
+        reloaded = getattr(self._reloading, "resources", None)
+
+        if reloaded is not None and name in reloaded:
+            if reloaded[name] is _NOT_LOADED:
+                reloaded[name] = self._loaders[name]()
+
+            return reloaded[name]
+
+        if name in self._resources:
+            return self._resources[name]
+
+        with self._locks[name]:
+            if name not in self._resources:
+                try:
+                    self._resources[name] = self._loaders[name]()
+                    self._errors.pop(name, None)
+                except Exception as error:
+                    self._errors[name] = error
+                    raise
+
+        return self._resources[name]
+
+    async def aload(self, name: str) -> Any:
+        """Load a resource without blocking the event loop.
+
+        Args:
+            name (str): Name of the resource.
+
+        Returns:
+            Any: The resource.
+        """
+        if name in self._resources:
+            return self._resources[name]
+
+        return await asyncio.shield(self._schedule(name))
+
+    async def reload(self, names: list[str]):
+        """Load new instances of resources and replace the loaded ones.
+
+        The new instances are loaded in a worker thread, in order, and replace
+        the loaded ones together once they are all loaded. Loading one of the
+        resources meanwhile still gets the loaded instance.
+
+        Args:
+            names (list[str]): Names of the resources, dependencies first.
+        """
+        reloaded = await asyncio.get_running_loop().run_in_executor(
+            None, self._load_new, names
+        )
+        self._resources.update(reloaded)
+
+        for name in names:
+            self._errors.pop(name, None)
+
+    def get(self, name: str) -> Any:
+        """Get a resource if it is ready, start loading it otherwise.
+
+        Args:
+            name (str): Name of the resource.
+
+        Raises:
+            ResourceNotReadyException: The resource is still loading or failed to load.
+
+        Returns:
+            Any: The resource.
+        """
+        if name in self._resources:
+            return self._resources[name]
+
+        self._schedule(name)
+
+        raise ResourceNotReadyException(f'Resource "{name}" is not ready yet')
+
+    def is_ready(self, name: str) -> bool:
+        """Whether a resource is loaded.
+
+        Args:
+            name (str): Name of the resource.
+
+        Returns:
+            bool: True if the resource is loaded.
+        """
+        return name in self._resources
+
+    def is_eager_ready(self) -> bool:
+        """Whether all the eager resources are loaded.
+
+        Returns:
+            bool: True if all the eager resources are loaded.
+        """
+        return all(self.is_ready(name) for name in self._eager)
+
+    def status(self) -> dict[str, str]:
+        """Get the loading status of every resource.
+
+        Returns:
+            dict[str, str]: Status by resource name.
+        """
+        statuses = {}
+
+        for name in self._loaders:
+            if name in self._resources:
+                statuses[name] = "ready"
+            elif name in self._loading:
+                statuses[name] = "loading"
+            elif name in self._errors:
+                statuses[name] = "failed"
+            else:
+                statuses[name] = "pending"
+
+        return statuses
+
+    def _load_new(self, names: list[str]) -> dict[str, Any]:
+        """Load new instances of resources, loading them from each other.
+
+        Args:
+            names (list[str]): Names of the resources, dependencies first.
+
+        Returns:
+            dict[str, Any]: The new instances by name.
+        """
+        self._reloading.resources = dict.fromkeys(names, _NOT_LOADED)
+
+        try:
+            for name in names:
+                self.load(name)
+
+            return self._reloading.resources
+        finally:
+            del self._reloading.resources
+
+    def _schedule(self, name: str) -> asyncio.Future:
+        """Load a resource in a worker thread unless it is already loading.
+
+        Args:
+            name (str): Name of the resource.
+
+        Returns:
+            asyncio.Future: Future resolved with the resource.
+        """
+        future = self._loading.get(name)
+
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(None, self.load, name)
+            future.add_done_callback(lambda done: self._on_loaded(name, done))
+            self._loading[name] = future
+
+        return future
+
+    def _on_loaded(self, name: str, future: asyncio.Future):
+        self._loading.pop(name, None)
+
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(
+                'Failed to load resource "%s"', name, exc_info=future.exception()
+            )
@@ -1,7 +1,210 @@
+import asyncio
 import json
+import os
+import time
+from datetime import date, datetime
+from typing import Any, AsyncIterator, Optional, TypeVar
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson comes with langserve
+    orjson = None
 
-def format_sse_event(event: str, data: dict | None = None) -> str:
-    """Formats a dictionary into an SSE message string."""
-    formatted_data = {"data": data} if data else {}
-    return f"event: {event}\ndata: {json.dumps(formatted_data, default=str)}\n\n"
+# Seconds over which AI message chunks are joined into one event, 0 streams every chunk.
+SSE_CHUNK_FLUSH_INTERVAL_SECONDS = float(
+    os.getenv("SSE_CHUNK_FLUSH_INTERVAL_SECONDS", 0)
+)
+
+T = TypeVar("T")
+
+
+def _default(value: Any) -> str:
+    # Dates are encoded like orjson does, other values by their string.
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+
+    return str(value)
+
+
+def dumps(value: Any) -> bytes:
+    """Serialize a value to compact JSON.
+
+    Args:
+        value (Any): The value, dates are encoded in ISO 8601 and other values
+            that JSON doesn't support by their string.
+
+    Returns:
+        bytes: UTF-8 encoded JSON.
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=_default)
+
+    return json.dumps(
+        value, default=_default, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+def format_sse_event(
+    event: str,
+    data: dict | None = None,
+    event_id: Optional[str] = None,
+    retry: Optional[int] = None,
+) -> bytes:
+    """Formats a dictionary into an SSE message.
+
+    Args:
+        event (str): Name of the event.
+        data (dict | None): Data of the event, sent under the `data` key.
+        event_id (Optional[str]): ID of the event, sent back by reconnecting
+            clients as `Last-Event-ID`.
+        retry (Optional[int]): Milliseconds clients wait before reconnecting.
+
+    Returns:
+        bytes: The UTF-8 encoded message.
+    """
+    fields = b""
+
+    if event_id is not None:
+        fields += b"id: " + event_id.encode() + b"\n"
+
+    if retry is not None:
+        fields += b"retry: %d\n" % retry
+
+    return (
+        fields
+        + b"event: "
+        + event.encode()
+        + b"\ndata: "
+        + dumps({"data": data} if data else {})
+        + b"\n\n"
+    )
+
+
+class ChunkCoalescer:
+    """Collects the chunks of a streamed message and joins the small ones.
+
+    Chunks arriving within the flush interval of the last flushed one are held
+    back and sent together with the next flush, so fast token streams are sent
+    in fewer events. Held back chunks are due for a flush once the interval has
+    passed, see `with_flush_deadlines`. The whole content is kept as a list of
+    chunks until it is read.
+    """
+
+    def __init__(self, flush_interval: float = SSE_CHUNK_FLUSH_INTERVAL_SECONDS):
+        """Initialize the chunk coalescer.
+
+        Args:
+            flush_interval (float): Seconds over which chunks are joined,
+                0 flushes every chunk.
+        """
+        self.flush_interval = flush_interval
+        self._chunks: list[str] = []
+        # Index of the first chunk not flushed yet.
+        self._flushed = 0
+        self._flushed_at = float("-inf")
+
+    @property
+    def content(self) -> str:
+        """The whole content of the message."""
+        return "".join(self._chunks)
+
+    def add(self, chunk: str) -> Optional[str]:
+        """Add a chunk of the message.
+
+        Args:
+            chunk (str): The chunk.
+
+        Returns:
+            Optional[str]: The chunks to send now, joined, or None to hold them back.
+        """
+        self._chunks.append(chunk)
+
+        if time.monotonic() - self._flushed_at < self.flush_interval:
+            return None
+
+        return self.flush()
+
+    def flush(self) -> Optional[str]:
+        """Flush the chunks held back.
+
+        Returns:
+            Optional[str]: The chunks held back, joined, or None if there are none.
+        """
+        if self._flushed == len(self._chunks):
+            return None
+
+        chunk = "".join(self._chunks[self._flushed :])
+        self._flushed = len(self._chunks)
+        self._flushed_at = time.monotonic()
+
+        return chunk
+
+    def flush_delay(self) -> Optional[float]:
+        """Get the time left until the chunks held back are due for a flush.
+
+        Returns:
+            Optional[float]: Seconds left, 0 if they are due, or None if no chunk
+                is held back.
+        """
+        if self._flushed == len(self._chunks):
+            return None
+
+        return max(0.0, self._flushed_at + self.flush_interval - time.monotonic())
+
+
+async def with_flush_deadlines(
+    items: AsyncIterator[T], chunks: ChunkCoalescer
+) -> AsyncIterator[Optional[T]]:
+    """Iterate over items, telling when the chunks held back are due for a flush.
+
+    Without it, held back chunks wait for the next item, e.g. while a slow token
+    or a tool call is generated.
+
+    Args:
+        items (AsyncIterator[T]): The items, e.g. the chunks of a streamed message.
+        chunks (ChunkCoalescer): The coalescer the chunks are added to.
+
+    Returns:
+        AsyncIterator[Optional[T]]: The items, and None when the chunks held back
+            are due for a flush.
+    """
+    if chunks.flush_interval <= 0:
+        # Chunks are never held back.
+        async for item in items:
+            yield item
+
+        return
+
+    # The items are iterated in one task, so their iterator isn't cancelled
+    # while waiting for the next one and always runs in the same context.
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+    end = object()
+
+    async def produce():
+        try:
+            async for item in items:
+                await queue.put((item, None))
+        except Exception as e:
+            await queue.put((end, e))
+        else:
+            await queue.put((end, None))
+
+    producer = asyncio.create_task(produce())
+
+    try:
+        while True:
+            try:
+                item, error = await asyncio.wait_for(queue.get(), chunks.flush_delay())
+            except asyncio.TimeoutError:
+                yield None
+                continue
+
+            if error is not None:
+                raise error
+
+            if item is end:
+                return
+
+            yield item
+    finally:
+        producer.cancel()
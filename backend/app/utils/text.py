@@ -0,0 +1,15 @@
+import re
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so that trivially different queries share cached results.
+
+    Args:
+        query (str): The query.
+
+    Returns:
+        str: The lower cased query without surrounding quotes, punctuation and
+            repeated whitespace.
+    """
+    query = re.sub(r"\s+", " ", query).strip().lower()
+    return query.strip("\"'`.?! ")
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional
+from uuid import uuid4
+
+from app.utils.metrics import histogram
+
+logger = logging.getLogger(__name__)
+
+# Share of the requests whose stage timings are logged as a trace, from 0 to 1.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+
+STAGE_DURATION = histogram(
+    "diabuddy_stage_duration_seconds",
+    "Duration of the stages of a request, such as Auth0, MongoDB, retrieval, "
+    "search, LLM calls and tools.",
+    ("stage",),
+)
+HTTP_REQUEST_DURATION = histogram(
+    "diabuddy_http_request_duration_seconds",
+    "Duration of HTTP requests until their response, streamed or not, is sent.",
+    ("method", "route", "status"),
+)
+
+
+@dataclass
+class Trace:
+    """Timings of the stages of a sampled request."""
+
+    name: str
+    trace_id: str = field(default_factory=lambda: uuid4().hex)
+    started_at: float = field(default_factory=time.perf_counter)
+    spans: list[dict] = field(default_factory=list)
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+    def add_span(self, stage: str, started_at: float, duration: float):
+        """Add the timing of a stage.
+
+        Args:
+            stage (str): Name of the stage.
+            started_at (float): `time.perf_counter()` at the start of the stage.
+            duration (float): Duration of the stage in seconds.
+        """
+        self.spans.append(
+            {
+                "stage": stage,
+                "start_ms": round((started_at - self.started_at) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+            }
+        )
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def get_current_trace() -> Optional[Trace]:
+    """Get the trace of the current request.
+
+    Returns:
+        Optional[Trace]: The trace or None if the request isn't sampled.
+    """
+    return _current_trace.get()
+
+
+def set_trace_attribute(name: str, value: Any):
+    """Set an attribute of the current trace, if the request is sampled.
+
+    Args:
+        name (str): Name of the attribute.
+        value (Any): JSON serializable value.
+    """
+    trace = _current_trace.get()
+
+    if trace is not None:
+        trace.attributes[name] = value
+
+
+def record_stage(stage: str, started_at: float):
+    """Record the duration of a stage that ends now.
+
+    Args:
+        stage (str): Name of the stage.
+        started_at (float): `time.perf_counter()` at the start of the stage.
+    """
+    duration = time.perf_counter() - started_at
+    STAGE_DURATION.observe(duration, stage=stage)
+
+    trace = _current_trace.get()
+
+    if trace is not None:
+        trace.add_span(stage, started_at, duration)
+
+
+def _log_trace(trace: Trace, duration: float, **fields: Any):
+    logger.info(
+        "Trace %s",
+        json.dumps(
+            {
+                "trace_id": trace.trace_id,
+                "name": trace.name,
+                **fields,
+                "duration_ms": round(duration * 1000, 3),
+                "spans": trace.spans,
+                "attributes": trace.attributes,
+            },
+            default=str,
+        ),
+    )
+
+
+@contextmanager
+def background_trace(name: str) -> Iterator[None]:
+    """Trace work that outlives the request that started it in its own trace.
+
+    Background tasks inherit the trace of their request, which is logged when
+    the response is sent. The work is traced if that request is sampled, the
+    trace is linked to it by `parent_trace_id` and logged when the work ends.
+
+    Args:
+        name (str): Name of the trace.
+    """
+    parent = _current_trace.get()
+
+    if parent is None:
+        yield
+        return
+
+    trace = Trace(name=name, attributes={"parent_trace_id": parent.trace_id})
+    token = _current_trace.set(trace)
+
+    try:
+        yield
+    finally:
+        _current_trace.reset(token)
+        _log_trace(trace, time.perf_counter() - trace.started_at)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time a stage of the current request.
+
+    Args:
+        stage (str): Name of the stage.
+    """
+    started_at = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record_stage(stage, started_at)
+
+
+class TracingMiddleware:
+    """Times every HTTP request and logs the stage timings of sampled ones.
+
+    A plain ASGI middleware, so streamed responses pass through untouched and
+    are timed until their last chunk is sent.
+    """
+
+    def __init__(self, app, sample_rate: float = TRACE_SAMPLE_RATE):
+        """Initialize the tracing middleware.
+
+        Args:
+            app: The ASGI app.
+            sample_rate (float): Share of the requests to trace.
+        """
+        self.app = app
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        trace = None
+
+        if self.sample_rate and random.random() < self.sample_rate:
+            trace = Trace(name=f"{scope['method']} {scope['path']}")
+
+        token = _current_trace.set(trace)
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_trace.reset(token)
+
+            # The route template keeps the number of label values bounded.
+            route = scope.get("route")
+            duration = time.perf_counter() - started_at
+            HTTP_REQUEST_DURATION.observe(
+                duration,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=str(status_code),
+            )
+
+            if trace is not None:
+                _log_trace(trace, duration, status=status_code)
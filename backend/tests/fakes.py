@@ -0,0 +1,333 @@
+import asyncio
+import itertools
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterator, Optional
+from uuid import uuid4
+
+from app.chains.agentic import AGENT_LLM_TAG
+from app.chains.search import ONLINE_SEARCH_TOOL_NAME
+from fastapi import Depends
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pymongo import UpdateOne
+
+# Prefix of the fake tool inputs, counted in the prompt to know the agent step.
+FAKE_ACTION_INPUT_PREFIX = "load test lookup"
+
+DEFAULT_FAKE_ANSWER = (
+    "Keeping your blood glucose in range comes down to a few daily habits. "
+    "**Check your levels regularly**, eat balanced meals with plenty of fibre, "
+    "stay active and take your medication as prescribed. "
+    "Please talk to your healthcare professional before changing your treatment. "
+    "How have your glucose readings been this week?"
+)
+
+# Words with their trailing whitespace, streamed one per token.
+_TOKEN_PATTERN = re.compile(r"\S+\s*|\s+")
+
+
+class FakeChatModel(BaseChatModel):
+    """ReAct chat model streaming canned generations at a fixed token rate.
+
+    It calls `tool_calls` tools in a row, with a unique input so results are
+    never cached, and then streams the final answer.
+    """
+
+    tokens_per_second: float = 50.0
+    tool_calls: int = 0
+    tool_name: str = ONLINE_SEARCH_TOOL_NAME
+    answer: str = DEFAULT_FAKE_ANSWER
+    tags: Optional[list[str]] = [AGENT_LLM_TAG]
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-react-chat"
+
+    def _get_completion(self, messages: list[BaseMessage]) -> str:
+        """Get the generation of the current agent step.
+
+        Args:
+            messages (list[BaseMessage]): The prompt, with the agent scratchpad.
+
+        Returns:
+            str: A tool call or the final answer in the ReAct format.
+        """
+        prompt = "".join(str(message.content) for message in messages)
+        step = prompt.count(f"Action Input: {FAKE_ACTION_INPUT_PREFIX}")
+
+        if step < self.tool_calls:
+            return (
+                "Thought: Do I need to use a tool? Yes\n"
+                f"Action: {self.tool_name}\n"
+                f"Action Input: {FAKE_ACTION_INPUT_PREFIX} {step} {uuid4()}"
+            )
+
+        return f"Thought: Do I need to use a tool? No\nFinal Answer: {self.answer}"
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        completion = self._get_completion(messages)
+        time.sleep(len(_TOKEN_PATTERN.findall(completion)) / self.tokens_per_second)
+
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=completion))]
+        )
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for token in _TOKEN_PATTERN.findall(self._get_completion(messages)):
+            time.sleep(1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        for token in _TOKEN_PATTERN.findall(self._get_completion(messages)):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+
+            yield chunk
+
+
+def project(document: dict, projection: Optional[dict]) -> dict:
+    """Apply a Mongo projection to a document.
+
+    Args:
+        document (dict): The document.
+        projection (Optional[dict]): Fields to include or exclude, all if None.
+
+    Returns:
+        dict: The projected copy of the document.
+    """
+    if not projection:
+        return dict(document)
+
+    included = [field for field, value in projection.items() if value]
+
+    if included:
+        return {field: document[field] for field in included if field in document}
+
+    return {
+        field: value for field, value in document.items() if projection.get(field, 1)
+    }
+
+
+@dataclass
+class FakeWriteResult:
+    acknowledged: bool = True
+
+
+class FakeCursor:
+    """Motor cursor over the matched documents of an in-memory collection."""
+
+    def __init__(self, documents: list[dict], projection: Optional[dict] = None):
+        """Initialize the cursor.
+
+        Args:
+            documents (list[dict]): The matched documents.
+            projection (Optional[dict]): Fields to include or exclude.
+        """
+        self.documents = documents
+        self.projection = projection
+
+    def sort(self, keys: list[tuple[str, int]]) -> "FakeCursor":
+        # Stable sorts from the last key to the first sort by every key.
+        for key, direction in reversed(keys):
+            self.documents.sort(
+                key=lambda document: document[key], reverse=direction < 0
+            )
+
+        return self
+
+    def limit(self, limit: int) -> "FakeCursor":
+        self.documents = self.documents[:limit]
+        return self
+
+    async def to_list(self, length: Optional[int] = None) -> list[dict]:
+        return [
+            project(document, self.projection) for document in self.documents[:length]
+        ]
+
+
+class FakeCollection:
+    """In-memory stand-in of a Motor collection.
+
+    Supports the operations of the chat repository, with equality, `$lt` and
+    `$or` filters and upserting bulk writes. Documents are grouped by user id,
+    so the lookups of a user don't slow down as other users' histories grow.
+    """
+
+    def __init__(self):
+        """Initialize the collection."""
+        self.documents: dict[Any, list[dict]] = {}
+        self._ids = itertools.count()
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    async def insert_many(self, documents: list[dict], ordered: bool = True):
+        for document in documents:
+            self._insert(document)
+
+        return FakeWriteResult()
+
+    def find(self, query: dict, projection: Optional[dict] = None) -> FakeCursor:
+        return FakeCursor(self._match(query), projection)
+
+    async def find_one(
+        self, query: dict, projection: Optional[dict] = None
+    ) -> Optional[dict]:
+        documents = self._match(query)
+        return project(documents[0], projection) if documents else None
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        documents = self._match(query)
+
+        if documents:
+            documents[0].update(update.get("$set", {}))
+        elif upsert:
+            self._insert(
+                {**query, **update.get("$set", {}), **update.get("$setOnInsert", {})}
+            )
+
+        return FakeWriteResult()
+
+    async def bulk_write(self, requests: list[UpdateOne], ordered: bool = True):
+        for request in requests:
+            await self.update_one(request._filter, request._doc, upsert=request._upsert)
+
+        return FakeWriteResult()
+
+    async def distinct(self, field: str) -> list:
+        return list({document.get(field) for document in self._match({})} - {None})
+
+    async def delete_one(self, query: dict):
+        for document in self._match(query)[:1]:
+            self.documents[document.get("user_id")].remove(document)
+
+    async def delete_many(self, query: dict):
+        for document in self._match(query):
+            self.documents[document.get("user_id")].remove(document)
+
+    def _insert(self, document: dict):
+        document = {"_id": next(self._ids), **document}
+        self.documents.setdefault(document.get("user_id"), []).append(document)
+
+    def _match(self, query: dict) -> list[dict]:
+        if "user_id" in query:
+            candidates = self.documents.get(query["user_id"], [])
+        else:
+            candidates = list(itertools.chain.from_iterable(self.documents.values()))
+
+        return [
+            document for document in candidates if self._matches_query(document, query)
+        ]
+
+    def _matches_query(self, document: dict, query: dict) -> bool:
+        return all(
+            any(self._matches_query(document, branch) for branch in condition)
+            if field == "$or"
+            else self._matches(document.get(field), condition)
+            for field, condition in query.items()
+        )
+
+    @staticmethod
+    def _matches(value: Any, condition: Any) -> bool:
+        if isinstance(condition, dict) and "$lt" in condition:
+            return value is not None and value < condition["$lt"]
+
+        return value == condition
+
+
+class FakeDatabase:
+    """In-memory stand-in of a Motor database."""
+
+    def __init__(self):
+        """Initialize the database."""
+        self.collections: dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        return self.collections.setdefault(name, FakeCollection())
+
+
+class FakeUserManager:
+    """Stand-in of the Auth0 user manager, every user has a complete profile."""
+
+    def __init__(self, latency: float = 0.0):
+        """Initialize the user manager.
+
+        Args:
+            latency (float): Seconds every call takes, like a management API call.
+        """
+        self.latency = latency
+        self.user_metadata: dict[str, dict] = {}
+
+    def get(self, user_id: str, fields: Optional[list[str]] = None) -> dict:
+        time.sleep(self.latency)
+
+        return {
+            "user_metadata": self.user_metadata.setdefault(
+                user_id,
+                {
+                    "nickname": f"Patient {user_id}",
+                    "age": 45,
+                    "gender": "Female",
+                    "diabetes_type": "Type 2",
+                    "preferred_language": "English",
+                },
+            )
+        }
+
+    def update(self, user_id: str, body: dict) -> dict:
+        time.sleep(self.latency)
+        self.user_metadata[user_id] = body.get("user_metadata", {})
+
+        return {"user_metadata": self.user_metadata[user_id]}
+
+    def delete(self, user_id: str):
+        time.sleep(self.latency)
+        self.user_metadata.pop(user_id, None)
+
+
+async def verify_fake_token(
+    token: HTTPAuthorizationCredentials = Depends(HTTPBearer()),
+) -> str:
+    """Stand-in of the token verifier, the bearer token is the user id.
+
+    Args:
+        token (HTTPAuthorizationCredentials): The bearer token.
+
+    Returns:
+        str: The user id.
+    """
+    return token.credentials
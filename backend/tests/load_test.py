@@ -0,0 +1,454 @@
+import os
+
+# Nothing calls Auth0, the client created on import only needs settings.
+os.environ.setdefault("AUTH0_DOMAIN", "load-test.invalid")
+
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import httpx
+import numpy as np
+import uvicorn
+from app.chains.agentic import create_agent_executor, create_knowledge_retriever
+from app.chains.answer_cache import get_answer_cache
+from app.chains.search import (
+    KNOWLEDGE_RETRIEVER_TOOL_NAME,
+    ONLINE_SEARCH_TOOL_NAME,
+    FakeSearchBackend,
+)
+from app.dependencies.auth import get_token_verifier, get_user_manager
+from app.dependencies.database import get_database
+from app.dependencies.resources import (
+    AGENT_EXECUTOR,
+    KNOWLEDGE_RETRIEVER,
+    get_resource_registry,
+)
+from app.server import app
+from fastapi import FastAPI
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from tests.fakes import (
+    FakeChatModel,
+    FakeDatabase,
+    FakeUserManager,
+    verify_fake_token,
+)
+
+logger = logging.getLogger(__name__)
+
+CHAT_STREAM_PATH = "/api/users/me/chat/stream"
+
+# Chunks of the in-memory knowledge index searched by the knowledge retriever tool.
+FAKE_KNOWLEDGE = [
+    "Regular blood glucose monitoring helps to keep levels within the target range.",
+    "An HbA1c test shows the average blood glucose over the past three months.",
+    "Physical activity lowers blood glucose and improves insulin sensitivity.",
+    "Meals rich in fibre slow down the absorption of sugar.",
+    "Hypoglycaemia is treated with fast acting carbohydrates such as glucose tablets.",
+]
+
+
+@dataclass
+class LoadTestConfig:
+    sessions: int = 100
+    concurrency: int = 10
+    users: int = 10
+    tokens_per_second: float = 50.0
+    tool_calls: int = 1
+    tool: str = "online"
+    search_latency: float = 0.2
+    user_manager_latency: float = 0.05
+    lag_interval: float = 0.01
+
+
+@dataclass
+class SessionResult:
+    ok: bool = False
+    # Seconds from sending the query to the first event of any kind.
+    time_to_first_event: Optional[float] = None
+    # Seconds from sending the query to the first answer chunk.
+    time_to_first_chunk: Optional[float] = None
+    duration: Optional[float] = None
+    chunk_gaps: list[float] = field(default_factory=list)
+    chunks: int = 0
+
+
+class EventLoopLagMonitor:
+    """Samples how late the event loop wakes up a sleeping task.
+
+    A loop busy with blocking work wakes the monitor up late, which delays every
+    stream served by the loop by the same amount.
+    """
+
+    def __init__(self, interval: float):
+        """Initialize the monitor.
+
+        Args:
+            interval (float): Seconds between samples.
+        """
+        self.interval = interval
+        self.lags: list[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - started_at - self.interval)
+
+
+class ServerThread(threading.Thread):
+    """Serves the app from its own thread and event loop.
+
+    The clients then don't run on the server's event loop, so its lag only
+    reflects the work of the server.
+    """
+
+    def __init__(self, app: FastAPI, lag_interval: float):
+        """Initialize the server thread.
+
+        Args:
+            app (FastAPI): The app.
+            lag_interval (float): Seconds between event loop lag samples.
+        """
+        super().__init__(daemon=True)
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+
+        # The lifespan is skipped, the agent is loaded up front and nothing
+        # is fetched from Auth0.
+        self.server = uvicorn.Server(
+            uvicorn.Config(
+                app,
+                host="127.0.0.1",
+                port=self.port,
+                lifespan="off",
+                log_level="warning",
+                access_log=False,
+            )
+        )
+        self.lag_monitor = EventLoopLagMonitor(lag_interval)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.lag_monitor.start()
+
+        try:
+            await self.server.serve()
+        finally:
+            self.lag_monitor.stop()
+
+    def wait_started(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+
+        while not self.server.started:
+            if not self.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("The load test server didn't start")
+
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.join()
+
+
+def configure_app(config: LoadTestConfig) -> FastAPI:
+    """Replace the app's external services with in-process fakes.
+
+    Args:
+        config (LoadTestConfig): The load test configuration.
+
+    Returns:
+        FastAPI: The app, with its agent loaded.
+    """
+    database = FakeDatabase()
+    user_manager = FakeUserManager(latency=config.user_manager_latency)
+
+    async def get_fake_database():
+        return database
+
+    app.dependency_overrides[get_database] = get_fake_database
+    app.dependency_overrides[get_user_manager] = lambda: user_manager
+    app.dependency_overrides[get_token_verifier().verify] = verify_fake_token
+    # Every query would be answered from the cache after the first one.
+    app.dependency_overrides[get_answer_cache] = lambda: None
+
+    vector_store = FAISS.from_texts(FAKE_KNOWLEDGE, DeterministicFakeEmbedding(size=64))
+    llm = FakeChatModel(
+        tokens_per_second=config.tokens_per_second,
+        tool_calls=config.tool_calls,
+        tool_name=ONLINE_SEARCH_TOOL_NAME
+        if config.tool == "online"
+        else KNOWLEDGE_RETRIEVER_TOOL_NAME,
+    )
+
+    resource_registry = get_resource_registry()
+    resource_registry.register(
+        KNOWLEDGE_RETRIEVER, lambda: create_knowledge_retriever(vector_store)
+    )
+    resource_registry.register(
+        AGENT_EXECUTOR,
+        lambda: create_agent_executor(
+            resource_registry.load(KNOWLEDGE_RETRIEVER),
+            llm=llm,
+            search_backend=FakeSearchBackend(latency=config.search_latency),
+        ),
+    )
+    resource_registry.load(AGENT_EXECUTOR)
+
+    return app
+
+
+async def run_session(
+    client: httpx.AsyncClient, session_id: int, user_id: str
+) -> SessionResult:
+    """Stream one chat response and time its events.
+
+    Args:
+        client (httpx.AsyncClient): Client of the load test server.
+        session_id (int): Number of the session.
+        user_id (str): User sending the query.
+
+    Returns:
+        SessionResult: Timings of the session.
+    """
+    result = SessionResult()
+    started_at = time.perf_counter()
+    last_chunk_at = None
+
+    try:
+        async with client.stream(
+            "POST",
+            CHAT_STREAM_PATH,
+            json={"query": f"How can I keep my glucose in range? ({session_id})"},
+            headers={"Authorization": f"Bearer {user_id}"},
+        ) as response:
+            if response.status_code != 200:
+                logger.warning(
+                    "Session %d got HTTP %d", session_id, response.status_code
+                )
+                return result
+
+            async for line in response.aiter_lines():
+                if not line.startswith("event:"):
+                    continue
+
+                now = time.perf_counter()
+                event = line.removeprefix("event:").strip()
+
+                if result.time_to_first_event is None:
+                    result.time_to_first_event = now - started_at
+
+                if event == "ai_message_chunk":
+                    if last_chunk_at is None:
+                        result.time_to_first_chunk = now - started_at
+                    else:
+                        result.chunk_gaps.append(now - last_chunk_at)
+
+                    last_chunk_at = now
+                    result.chunks += 1
+                elif event == "ai_response_end":
+                    result.ok = True
+                elif event == "error":
+                    logger.warning("Session %d streamed an error", session_id)
+    except httpx.HTTPError as e:
+        logger.warning("Session %d failed: %r", session_id, e)
+
+    result.duration = time.perf_counter() - started_at
+
+    return result
+
+
+def summarize(values: list[float]) -> Optional[dict]:
+    """Summarize a distribution of seconds in milliseconds.
+
+    Args:
+        values (list[float]): The samples in seconds.
+
+    Returns:
+        Optional[dict]: Percentiles, mean and maximum or None if there are no samples.
+    """
+    if not values:
+        return None
+
+    samples = np.array(values) * 1000
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99]).tolist()
+
+    return {
+        "p50": p50,
+        "p90": p90,
+        "p99": p99,
+        "mean": float(samples.mean()),
+        "max": float(samples.max()),
+    }
+
+
+async def run_load(
+    url: str, config: LoadTestConfig
+) -> tuple[list[SessionResult], float]:
+    """Run the chat sessions against the server, `concurrency` at a time.
+
+    Args:
+        url (str): URL of the server.
+        config (LoadTestConfig): The load test configuration.
+
+    Returns:
+        tuple[list[SessionResult], float]: Result of every session and the
+            elapsed seconds.
+    """
+    semaphore = asyncio.Semaphore(config.concurrency)
+
+    async with httpx.AsyncClient(
+        base_url=url,
+        timeout=None,
+        limits=httpx.Limits(max_connections=config.concurrency),
+    ) as client:
+
+        async def run_limited_session(session_id: int) -> SessionResult:
+            async with semaphore:
+                return await run_session(
+                    client, session_id, f"load-test-user-{session_id % config.users}"
+                )
+
+        started_at = time.perf_counter()
+        results = await asyncio.gather(
+            *(run_limited_session(session_id) for session_id in range(config.sessions))
+        )
+
+        return results, time.perf_counter() - started_at
+
+
+def run_load_test(config: LoadTestConfig) -> dict:
+    """Load test the chat stream endpoint of the app with fake services.
+
+    Args:
+        config (LoadTestConfig): The load test configuration.
+
+    Returns:
+        dict: The load test report.
+    """
+    server = ServerThread(configure_app(config), config.lag_interval)
+    server.start()
+    server.wait_started()
+
+    try:
+        results, elapsed = asyncio.run(run_load(server.url, config))
+    finally:
+        server.stop()
+
+    completed = [result for result in results if result.ok]
+
+    return {
+        "config": config.__dict__,
+        "sessions": len(results),
+        "completed": len(completed),
+        "failed": len(results) - len(completed),
+        "elapsed_seconds": elapsed,
+        "sessions_per_second": len(completed) / elapsed,
+        "time_to_first_event_ms": summarize(
+            [result.time_to_first_event for result in completed]
+        ),
+        "time_to_first_chunk_ms": summarize(
+            [result.time_to_first_chunk for result in completed]
+        ),
+        "inter_chunk_gap_ms": summarize(
+            [gap for result in completed for gap in result.chunk_gaps]
+        ),
+        "session_duration_ms": summarize([result.duration for result in completed]),
+        "event_loop_lag_ms": summarize(server.lag_monitor.lags),
+    }
+
+
+parser = argparse.ArgumentParser(
+    prog="python -m tests.load_test",
+    description="Load test the chat stream endpoint with a fake LLM, an in-memory "
+    "database and stubbed Auth0 and search.",
+)
+parser.add_argument("--sessions", type=int, default=100, help="Chat sessions to run.")
+parser.add_argument(
+    "--concurrency", type=int, default=10, help="Sessions streaming at a time."
+)
+parser.add_argument(
+    "--users", type=int, default=10, help="Users the sessions are spread over."
+)
+parser.add_argument(
+    "--tokens-per-second", type=float, default=50.0, help="Fake LLM streaming rate."
+)
+parser.add_argument(
+    "--tool-calls", type=int, default=1, help="Tool calls before every answer."
+)
+parser.add_argument(
+    "--tool",
+    choices=("online", "knowledge"),
+    default="online",
+    help="Tool called by the fake LLM.",
+)
+parser.add_argument(
+    "--search-latency", type=float, default=0.2, help="Seconds of every web search."
+)
+parser.add_argument(
+    "--user-manager-latency",
+    type=float,
+    default=0.05,
+    help="Seconds of every Auth0 management API call.",
+)
+parser.add_argument(
+    "--lag-interval",
+    type=float,
+    default=0.01,
+    help="Seconds between event loop lag samples.",
+)
+parser.add_argument(
+    "--output", type=Path, default=None, help="JSON report file, stdout if not set."
+)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    args = parser.parse_args()
+
+    report = json.dumps(
+        run_load_test(
+            LoadTestConfig(
+                sessions=args.sessions,
+                concurrency=args.concurrency,
+                users=args.users,
+                tokens_per_second=args.tokens_per_second,
+                tool_calls=args.tool_calls,
+                tool=args.tool,
+                search_latency=args.search_latency,
+                user_manager_latency=args.user_manager_latency,
+                lag_interval=args.lag_interval,
+            )
+        ),
+        indent=2,
+    )
+
+    if args.output is None:
+        print(report)
+    else:
+        args.output.write_text(report)
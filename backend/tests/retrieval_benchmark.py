@@ -0,0 +1,413 @@
+import argparse
+import csv
+import json
+import logging
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import numpy as np
+from app.chains.retrievers import HybridRetriever
+from app.constants import KNOWLEDGE_BASE_PATH, ROOT_DIR
+from app.ingest.chunks import CHUNK_STORE_FILE_NAME, ChunkStore
+from app.ingest.embeddings import (
+    EMBEDDING_MODEL,
+    CachedEmbeddings,
+    EmbeddingCache,
+    hash_text,
+)
+from app.ingest.index import INDEX_TYPES, IndexConfig
+from app.ingest.lexical import tokenize
+from app.ingest.store import (
+    export_serving_index,
+    get_serving_index_path,
+    load_lexical_index,
+    load_serving_index,
+)
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+logger = logging.getLogger(__name__)
+
+# Labelled questions, with the expected answer of every question.
+TEST_SET_PATH = ROOT_DIR / "data" / "test_data" / "retrieval_qna.csv"
+# Small local model, so the benchmark runs without any API.
+LOCAL_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# Recorded fixtures are never evicted.
+_FIXTURE_MAX_SIZE_BYTES = 2**40
+
+
+class FixtureEmbeddings(Embeddings):
+    """Replays embeddings recorded in an embedding cache."""
+
+    def __init__(self, cache: EmbeddingCache, model: str):
+        """Initialize the fixture embeddings.
+
+        Args:
+            cache (EmbeddingCache): Cache the embeddings were recorded in.
+            model (str): Name of the recorded embedding model.
+        """
+        self.cache = cache
+        self.model = model
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        text_hashes = [hash_text(text) for text in texts]
+        vectors = self.cache.get_many(self.model, text_hashes)
+        missing = len(set(text_hashes) - vectors.keys())
+
+        if missing:
+            raise KeyError(
+                f"{missing} texts have no recorded {self.model} embedding, "
+                "record them with --record"
+            )
+
+        return [vectors[text_hash] for text_hash in text_hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def create_benchmark_embeddings(
+    source: str, model: Optional[str], fixture_path: Optional[Path], record: bool
+) -> tuple[Embeddings, str]:
+    """Create the embeddings used by the benchmark.
+
+    Args:
+        source (str): "local", "openai" or "fixture".
+        model (Optional[str]): Embedding model, the default one of the source if None.
+        fixture_path (Optional[Path]): Embedding cache the fixtures are recorded in.
+        record (bool): Whether to record the computed embeddings into the fixtures.
+
+    Returns:
+        tuple[Embeddings, str]: The embeddings and the name of their model.
+    """
+    if source == "fixture":
+        if fixture_path is None or model is None:
+            raise ValueError("Replaying fixtures needs --fixture and --model")
+
+        cache = EmbeddingCache(fixture_path, _FIXTURE_MAX_SIZE_BYTES)
+        return FixtureEmbeddings(cache, model), model
+
+    if source == "local":
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        model = model or LOCAL_EMBEDDING_MODEL
+        embeddings = HuggingFaceEmbeddings(model_name=model)
+    else:
+        from langchain_openai import OpenAIEmbeddings
+
+        model = model or EMBEDDING_MODEL
+        embeddings = OpenAIEmbeddings(model=model)
+
+    if record:
+        if fixture_path is None:
+            raise ValueError("Recording fixtures needs --fixture")
+
+        cache = EmbeddingCache(fixture_path, _FIXTURE_MAX_SIZE_BYTES)
+        embeddings = CachedEmbeddings(embeddings, cache, model)
+
+    return embeddings, model
+
+
+def get_answer_coverage(answer_terms: set[str], document: Document) -> float:
+    """Get the share of the terms of an answer a chunk contains.
+
+    Args:
+        answer_terms (set[str]): Terms of the expected answer.
+        document (Document): The chunk.
+
+    Returns:
+        float: Share of the answer terms found in the chunk.
+    """
+    if not answer_terms:
+        return 0.0
+
+    return len(answer_terms & set(tokenize(document.page_content))) / len(answer_terms)
+
+
+def evaluate_retriever(
+    retriever: BaseRetriever,
+    questions: list[str],
+    answers_terms: list[set[str]],
+    k: int,
+    relevance_threshold: float,
+) -> dict:
+    """Measure the latency, throughput and quality of a retriever.
+
+    A chunk is relevant to a question if it contains at least
+    `relevance_threshold` of the terms of the expected answer.
+
+    Args:
+        retriever (BaseRetriever): The retriever.
+        questions (list[str]): Questions answerable from the chunks.
+        answers_terms (list[set[str]]): Terms of the expected answer of every question.
+        k (int): Number of retrieved chunks evaluated.
+        relevance_threshold (float): Minimum answer coverage of a relevant chunk.
+
+    Returns:
+        dict: Latency percentiles, throughput, recall@k and MRR.
+    """
+    # Warm up caches and lazily loaded pages.
+    retriever.invoke(questions[0])
+
+    latencies = []
+    hits = 0
+    reciprocal_ranks = 0.0
+    started_at = time.perf_counter()
+
+    for question, answer_terms in zip(questions, answers_terms):
+        retrieval_started_at = time.perf_counter()
+        documents = retriever.invoke(question)
+        latencies.append(time.perf_counter() - retrieval_started_at)
+
+        for rank, document in enumerate(documents[:k]):
+            if get_answer_coverage(answer_terms, document) >= relevance_threshold:
+                hits += 1
+                reciprocal_ranks += 1 / (rank + 1)
+                break
+
+    elapsed = time.perf_counter() - started_at
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99]).tolist()
+
+    return {
+        "latency_ms": {
+            "p50": p50,
+            "p90": p90,
+            "p99": p99,
+            "mean": float(np.mean(latencies) * 1000),
+        },
+        "throughput_qps": len(questions) / elapsed,
+        # Share of the questions with a relevant chunk in the top k.
+        f"recall_at_{k}": hits / len(questions),
+        "mrr": reciprocal_ranks / len(questions),
+    }
+
+
+def get_peak_rss_mb() -> float:
+    """Get the peak resident memory of this process.
+
+    Returns:
+        float: Peak resident set size in MiB.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Reported in bytes on macOS and in KiB elsewhere.
+    return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
+
+
+def get_directory_size(path: Path) -> int:
+    """Get the total size of the files in a directory.
+
+    Args:
+        path (Path): The directory.
+
+    Returns:
+        int: Size in bytes.
+    """
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+def run_benchmark(
+    chunk_store_path: Path,
+    test_set_path: Path,
+    embeddings: Embeddings,
+    model: str,
+    index_types: list[str],
+    k: int,
+    relevance_threshold: float,
+    limit: Optional[int] = None,
+) -> dict:
+    """Benchmark every index type over the ingested chunks.
+
+    Args:
+        chunk_store_path (Path): Chunk store of the ingest command.
+        test_set_path (Path): CSV of labelled questions and answers.
+        embeddings (Embeddings): Embeddings of the chunks and questions.
+        model (str): Name of the embedding model.
+        index_types (list[str]): Index types to benchmark.
+        k (int): Number of retrieved chunks evaluated.
+        relevance_threshold (float): Minimum answer coverage of a relevant chunk.
+        limit (Optional[int]): Maximum number of questions, all if None.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    chunk_store = ChunkStore(chunk_store_path)
+
+    try:
+        documents = [document for document, _ in chunk_store.iter_chunks()]
+    finally:
+        chunk_store.close()
+
+    with open(test_set_path, newline="") as file:
+        test_set = list(csv.DictReader(file))[:limit]
+
+    questions = [row["question"] for row in test_set]
+    answers_terms = [set(tokenize(row["answer"])) for row in test_set]
+
+    # Only questions answerable from the chunks are evaluated.
+    labelled = [
+        (question, answer_terms)
+        for question, answer_terms in zip(questions, answers_terms)
+        if any(
+            get_answer_coverage(answer_terms, document) >= relevance_threshold
+            for document in documents
+        )
+    ]
+
+    if not labelled:
+        raise ValueError("None of the questions can be answered from the chunks")
+
+    questions, answers_terms = map(list, zip(*labelled))
+
+    logger.info("Embedding %d chunks", len(documents))
+    started_at = time.perf_counter()
+    vectors = embeddings.embed_documents(
+        [document.page_content for document in documents]
+    )
+    embedding_seconds = time.perf_counter() - started_at
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        benchmark_store = ChunkStore(Path(directory) / CHUNK_STORE_FILE_NAME)
+        benchmark_store.replace_source("benchmark", "", documents, vectors)
+
+        for index_type in index_types:
+            index_path = Path(directory) / index_type
+            peak_rss_before = get_peak_rss_mb()
+
+            logger.info("Building %s index", index_type)
+            started_at = time.perf_counter()
+            export_serving_index(
+                benchmark_store, index_path, IndexConfig(index_type=index_type)
+            )
+            build_seconds = time.perf_counter() - started_at
+
+            started_at = time.perf_counter()
+            vector_store = load_serving_index(index_path, embeddings)
+            lexical_index = load_lexical_index(vector_store)
+            load_seconds = time.perf_counter() - started_at
+
+            build = {
+                "index_type": index_type,
+                "build_seconds": build_seconds,
+                "load_seconds": load_seconds,
+                "index_size_mb": get_directory_size(get_serving_index_path(index_path))
+                / 2**20,
+                # Peak memory grows only when a build needs more than earlier ones.
+                "peak_rss_mb": get_peak_rss_mb(),
+                "peak_rss_growth_mb": get_peak_rss_mb() - peak_rss_before,
+            }
+
+            retrievers = {
+                "dense": vector_store.as_retriever(search_kwargs={"k": k}),
+                "hybrid": HybridRetriever(
+                    vector_store=vector_store, lexical_index=lexical_index, k=k
+                ),
+            }
+
+            for name, retriever in retrievers.items():
+                logger.info("Evaluating %s retrieval over %s", name, index_type)
+                results.append(
+                    {
+                        **build,
+                        "retriever": name,
+                        **evaluate_retriever(
+                            retriever, questions, answers_terms, k, relevance_threshold
+                        ),
+                    }
+                )
+
+        benchmark_store.close()
+
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "embedding_model": model,
+        "dimension": len(vectors[0]),
+        "chunks": len(documents),
+        "questions": len(questions),
+        "k": k,
+        "relevance_threshold": relevance_threshold,
+        "embedding_seconds": embedding_seconds,
+        "results": results,
+    }
+
+
+parser = argparse.ArgumentParser(
+    prog="python -m tests.retrieval_benchmark",
+    description="Benchmark retrieval latency, throughput and quality of every "
+    "index type over the ingested chunks.",
+)
+parser.add_argument(
+    "--chunk-store",
+    type=Path,
+    default=KNOWLEDGE_BASE_PATH / CHUNK_STORE_FILE_NAME,
+    help="Chunk store written by `python -m app.ingest`.",
+)
+parser.add_argument("--test-set", type=Path, default=TEST_SET_PATH)
+parser.add_argument(
+    "--embeddings",
+    choices=("local", "openai", "fixture"),
+    default="local",
+    help="Local sentence-transformers model, OpenAI or recorded fixtures.",
+)
+parser.add_argument("--model", default=None, help="Embedding model.")
+parser.add_argument(
+    "--fixture", type=Path, default=None, help="Embedding fixture database."
+)
+parser.add_argument(
+    "--record",
+    action="store_true",
+    help="Record the computed embeddings into the fixture database.",
+)
+parser.add_argument(
+    "--index-types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES)
+)
+parser.add_argument("--k", type=int, default=4, help="Number of retrieved chunks.")
+parser.add_argument(
+    "--relevance-threshold",
+    type=float,
+    default=0.5,
+    help="Minimum share of the answer terms in a relevant chunk.",
+)
+parser.add_argument("--limit", type=int, default=None, help="Maximum questions.")
+parser.add_argument(
+    "--output", type=Path, default=None, help="JSON results file, stdout if not set."
+)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    args = parser.parse_args()
+
+    embeddings, model = create_benchmark_embeddings(
+        args.embeddings, args.model, args.fixture, args.record
+    )
+    report = json.dumps(
+        run_benchmark(
+            args.chunk_store,
+            args.test_set,
+            embeddings,
+            model,
+            args.index_types,
+            args.k,
+            args.relevance_threshold,
+            args.limit,
+        ),
+        indent=2,
+    )
+
+    if args.output is None:
+        print(report)
+    else:
+        args.output.write_text(report)